@@ -0,0 +1,77 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Compare encoding each connection's handshake with reusing an endpoint's.
+
+Endpoints encode their greeting, login and request once, so each connection
+only has to look them up; the cost per connection should be about that of
+writing a string which already exists, as in the baseline.
+
+Run with ``python benchmarks/encoding.py``.
+
+"""
+
+from __future__ import print_function
+
+import time
+
+from txsocksx import client
+import txsocksx.constants as c
+
+
+CONNECTIONS = 200000
+METHODS = {'login': ('username', 'password')}
+
+
+class Transport(object):
+    def write(self, data):
+        pass
+
+
+def rate(encode):
+    start = time.time()
+    for x in xrange(CONNECTIONS):
+        encode()
+    return CONNECTIONS / (time.time() - start)
+
+
+def main():
+    transport = Transport()
+    socks5 = client.SOCKS5Sender(transport)
+    socks5Endpoint = client.SOCKS5ClientEndpoint(
+        'example.com', 443, None, METHODS)
+    socks4 = client.SOCKS4Sender(transport)
+    socks4Endpoint = client.SOCKS4ClientEndpoint('127.0.0.1', 443, None)
+    table = client.SOCKS5ClientFactory._methodTable(METHODS)
+    prebuilt = socks5Endpoint._handshakeFrames('example.com').request
+
+    def socks5Encoded():
+        socks5.sendAuthMethods(table)
+        socks5.sendLogin('username', 'password')
+        socks5.sendRequest(c.CMD_CONNECT, 'example.com', 443)
+
+    def socks5Cached():
+        frames = socks5Endpoint._handshakeFrames('example.com')
+        transport.write(frames.greeting)
+        transport.write(frames.login)
+        transport.write(frames.request)
+
+    def socks4Encoded():
+        socks4.sendRequest('127.0.0.1', 443, '')
+
+    def socks4Cached():
+        transport.write(socks4Endpoint._handshakeFrames('127.0.0.1').request)
+
+    results = [
+        ('baseline (one write)', rate(lambda: transport.write(prebuilt))),
+        ('socks5 encoded', rate(socks5Encoded)),
+        ('socks5 cached', rate(socks5Cached)),
+        ('socks4 encoded', rate(socks4Encoded)),
+        ('socks4 cached', rate(socks4Cached)),
+    ]
+    for name, perSecond in results:
+        print('%-22s %8.2f us/connection' % (name, 1e6 / perSecond))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Compare data delivery through a negotiated tunnel with a bare protocol.
+
+Once negotiation has finished, data delivered to the SOCKS protocol should go
+straight to the proxied protocol, so both rates should be the same. The rate
+through a loopback TCP connection is given for scale: relaying shouldn't be
+what limits a real connection.
+
+Run with ``python benchmarks/relay.py``.
+
+"""
+
+from __future__ import print_function
+
+import time
+
+from twisted.internet import defer, interfaces, protocol
+from twisted.test import proto_helpers
+from zope.interface import implementer
+
+from txsocksx import client
+
+
+CHUNK = 'x' * 16384
+CHUNKS = 200000
+LOOPBACK_CHUNKS = 20000
+
+
+class Sink(protocol.Protocol):
+    received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+
+class SinkFactory(protocol.ClientFactory):
+    protocol = Sink
+
+
+class CountingSink(Sink):
+    def dataReceived(self, data):
+        Sink.dataReceived(self, data)
+        if self.received >= self.factory.expected:
+            self.factory.done.callback(time.time())
+
+
+class CountingSinkFactory(protocol.ServerFactory):
+    protocol = CountingSink
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.done = defer.Deferred()
+
+
+@implementer(interfaces.IPullProducer)
+class ChunkProducer(object):
+    def __init__(self, transport, count):
+        self.transport = transport
+        self.remaining = count
+
+    def resumeProducing(self):
+        self.transport.write(CHUNK)
+        self.remaining -= 1
+        if not self.remaining:
+            self.transport.unregisterProducer()
+
+    def stopProducing(self):
+        pass
+
+
+def tunnel(parser):
+    fac = client.SOCKS5ClientFactory('', 0, SinkFactory(), parser=parser)
+    proto = fac.buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    transport.abortConnection = lambda: None
+    proto.makeConnection(transport)
+    proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+    return proto
+
+
+def rate(proto):
+    deliver = proto.dataReceived
+    start = time.time()
+    for x in xrange(CHUNKS):
+        deliver(CHUNK)
+    return CHUNKS * len(CHUNK) / (time.time() - start)
+
+
+def loopbackRate():
+    from twisted.internet import reactor
+    serverFac = CountingSinkFactory(LOOPBACK_CHUNKS * len(CHUNK))
+    port = reactor.listenTCP(0, serverFac, interface='127.0.0.1')
+    creator = protocol.ClientCreator(reactor, protocol.Protocol)
+    d = creator.connectTCP('127.0.0.1', port.getHost().port)
+
+    def send(proto):
+        start = time.time()
+        proto.transport.registerProducer(
+            ChunkProducer(proto.transport, LOOPBACK_CHUNKS), False)
+        serverFac.done.addCallback(lambda end: end - start)
+        serverFac.done.addBoth(
+            lambda result: (proto.transport.loseConnection(), result)[1])
+        return serverFac.done
+
+    results = []
+    d.addCallback(send)
+    d.addBoth(results.append)
+    d.addBoth(lambda ign: port.stopListening())
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
+    [elapsed] = results
+    return LOOPBACK_CHUNKS * len(CHUNK) / elapsed
+
+
+def main():
+    results = [
+        ('loopback TCP', loopbackRate()),
+        ('bare protocol', rate(Sink())),
+        ('tunnel (fast parser)', rate(tunnel('fast'))),
+        ('tunnel (grammar parser)', rate(tunnel('grammar'))),
+    ]
+    for name, bytesPerSecond in results:
+        print('%-24s %12.1f MiB/s' % (name, bytesPerSecond / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
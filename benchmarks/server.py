@@ -0,0 +1,143 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""A minimal in-process SOCKS4/SOCKS5 server for the benchmarks.
+
+Instead of connecting anywhere, the server answers every request itself with
+one of the services below, chosen by the requested port. This keeps the
+benchmarks offline and focused on the client side.
+
+"""
+
+import struct
+from cStringIO import StringIO
+
+from parsley import makeProtocol
+from twisted.internet import protocol
+from twisted.protocols.basic import FileSender
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.web import resource, server
+
+from txsocksx import grammar
+
+
+DISCARD, SOURCE, HTTP, HTTPS = 9, 19, 80, 443
+
+
+class Discard(protocol.Protocol):
+    def dataReceived(self, data):
+        pass
+
+
+class Source(protocol.Protocol):
+    """Sends ``factory.sourceSize`` bytes, then closes the connection."""
+
+    def connectionMade(self):
+        data = StringIO('x' * self.factory.sourceSize)
+        d = FileSender().beginFileTransfer(data, self.transport)
+        d.addCallback(lambda ign: self.transport.loseConnection())
+
+
+class Hello(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return 'hello'
+
+
+class ServicesFactory(protocol.Factory):
+    """Builds the service for a port; also usable as a plain TCP server.
+
+    HTTPS is only served if *serverTLS* context options are given.
+
+    """
+
+    def __init__(self, sourceSize, service=SOURCE, serverTLS=None):
+        self.sourceSize = sourceSize
+        self.service = service
+        self.site = server.Site(Hello())
+        self.site.noisy = False
+        self.tlsSite = None
+        if serverTLS is not None:
+            self.tlsSite = TLSMemoryBIOFactory(serverTLS, False, self.site)
+            self.tlsSite.noisy = False
+
+    def buildService(self, port, addr):
+        if port == HTTP:
+            return self.site.buildProtocol(addr)
+        elif port == HTTPS and self.tlsSite is not None:
+            return self.tlsSite.buildProtocol(addr)
+        proto = (Source if port == SOURCE else Discard)()
+        proto.factory = self
+        return proto
+
+    def buildProtocol(self, addr):
+        return self.buildService(self.service, addr)
+
+
+class _Sender(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+
+class _Receiver(object):
+    upstream = None
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def prepareParsing(self, parser):
+        self.parser = parser
+        self.factory = parser.factory
+
+    def finishParsing(self, reason):
+        if self.upstream is not None:
+            self.upstream.connectionLost(reason)
+
+    def _grant(self, reply, port):
+        transport = self.sender.transport
+        transport.write(reply)
+        self.upstream = self.factory.services.buildService(
+            port, transport.getPeer())
+        self.parser.dataReceived = self.upstream.dataReceived
+        self.parser.connectionLost = self.upstream.connectionLost
+        self.currentRule = 'SOCKSState_readData'
+        self.upstream.makeConnection(transport)
+
+    def dataReceived(self, data):
+        self.upstream.dataReceived(data)
+
+
+class _SOCKS5Receiver(_Receiver):
+    currentRule = 'SOCKS5ServerState_initial'
+
+    def authRequested(self, methods):
+        self.sender.transport.write('\x05\x00')
+        self.currentRule = 'SOCKS5ServerState_readRequest'
+
+    def clientRequest(self, command, address, port):
+        self._grant(
+            '\x05\x00\x00\x01\x7f\x00\x00\x01' + struct.pack('!H', port), port)
+
+
+class _SOCKS4Receiver(_Receiver):
+    currentRule = 'SOCKS4ServerState_initial'
+
+    def clientRequest(self, command, port, host, user):
+        self._grant(
+            '\x00\x5a' + struct.pack('!H', port) + '\x7f\x00\x00\x01', port)
+
+
+class SOCKSServerFactory(protocol.Factory):
+    noisy = False
+
+    def __init__(self, version, services):
+        receiver = _SOCKS5Receiver if version == 5 else _SOCKS4Receiver
+        self.protocol = makeProtocol(
+            grammar.grammarSource, _Sender, receiver, grammar.bindings)
+        self.services = services
+
+    def buildProtocol(self, addr):
+        proto = self.protocol()
+        proto.factory = self
+        return proto
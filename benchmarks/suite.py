@@ -0,0 +1,338 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Throughput and latency benchmarks for the SOCKS client stack.
+
+Everything runs offline against the in-process server in ``server.py``,
+listening on loopback. The results are written as JSON, so runs can be
+compared to catch regressions:
+
+- ``handshakes``: negotiations per second and latency percentiles for each
+  SOCKS version and parser, with plain TCP connects as a baseline.
+- ``relay``: bulk download throughput through a tunnel and over plain TCP.
+- ``memory``: resident memory per open client tunnel.
+- ``agent``: ``SOCKS5Agent`` requests per second over HTTP and, if pyOpenSSL
+  is available, HTTPS.
+
+Run with ``python benchmarks/suite.py [--quick] [--output results.json]``.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import twisted
+from twisted.internet import defer, protocol
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+from twisted.internet.task import react
+from twisted.test import proto_helpers
+from twisted.web.client import HTTPConnectionPool, readBody
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server
+from txsocksx import client, http
+
+
+class Sink(protocol.Protocol):
+    received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason):
+        self.factory.done.callback(self.received)
+
+
+class SinkFactory(protocol.ClientFactory):
+    protocol = Sink
+
+    def __init__(self):
+        self.done = defer.Deferred()
+
+
+def percentiles(latencies, points=(50, 90, 99)):
+    ordered = sorted(latencies)
+    result = {}
+    for point in points:
+        index = min(len(ordered) - 1, int(len(ordered) * point / 100.0))
+        result['p%d_ms' % (point,)] = ordered[index] * 1000
+    return result
+
+
+@defer.inlineCallbacks
+def runConcurrently(count, concurrency, operation):
+    """Run *operation* *count* times, at most *concurrency* at once.
+
+    Returns the total elapsed time and the latency of each run.
+
+    """
+    latencies = []
+
+    def timed():
+        start = time.time()
+        d = operation()
+        d.addCallback(lambda ign: latencies.append(time.time() - start))
+        return d
+
+    semaphore = defer.DeferredSemaphore(concurrency)
+    start = time.time()
+    yield defer.gatherResults(
+        [semaphore.run(timed) for x in xrange(count)], consumeErrors=True)
+    defer.returnValue((time.time() - start, latencies))
+
+
+def summarize(count, elapsed, latencies, unit):
+    result = {'count': count, unit + '_per_sec': count / elapsed}
+    result.update(percentiles(latencies))
+    return result
+
+
+def socksEndpoint(reactor, version, parser, proxyPort, port):
+    proxyEndpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', proxyPort)
+    if version == 5:
+        return client.SOCKS5ClientEndpoint(
+            'bench.invalid', port, proxyEndpoint, parser=parser)
+    return client.SOCKS4ClientEndpoint(
+        'bench.invalid', port, proxyEndpoint, parser=parser)
+
+
+@defer.inlineCallbacks
+def benchHandshakes(reactor, ports, count, concurrency):
+    def handshakes(endpoint):
+        def connect():
+            d = endpoint.connect(SinkFactory())
+            d.addCallback(lambda proto: proto.transport.loseConnection())
+            return d
+        return runConcurrently(count, concurrency, connect)
+
+    results = {}
+    elapsed, latencies = yield handshakes(
+        TCP4ClientEndpoint(reactor, '127.0.0.1', ports['discard']))
+    results['tcp'] = summarize(count, elapsed, latencies, 'connects')
+    for version in (4, 5):
+        for parser in ('fast', 'grammar'):
+            endpoint = socksEndpoint(
+                reactor, version, parser, ports['socks%d' % (version,)],
+                server.DISCARD)
+            elapsed, latencies = yield handshakes(endpoint)
+            results['socks%d_%s' % (version, parser)] = summarize(
+                count, elapsed, latencies, 'handshakes')
+    defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def benchRelay(reactor, ports, size):
+    @defer.inlineCallbacks
+    def download(endpoint):
+        fac = SinkFactory()
+        start = time.time()
+        yield endpoint.connect(fac)
+        received = yield fac.done
+        elapsed = time.time() - start
+        assert received == size, (received, size)
+        defer.returnValue({
+            'bytes': received,
+            'mib_per_sec': received / elapsed / 2 ** 20,
+        })
+
+    results = {}
+    results['tcp'] = yield download(
+        TCP4ClientEndpoint(reactor, '127.0.0.1', ports['source']))
+    for version in (4, 5):
+        for parser in ('fast', 'grammar'):
+            endpoint = socksEndpoint(
+                reactor, version, parser, ports['socks%d' % (version,)],
+                server.SOURCE)
+            results['socks%d_%s' % (version, parser)] = yield download(endpoint)
+    defer.returnValue(results)
+
+
+def residentBytes():
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def openTunnel(parser):
+    fac = client.SOCKS5ClientFactory(
+        'bench.invalid', 80, SinkFactory(), parser=parser)
+    proto = fac.buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    transport.abortConnection = lambda: None
+    proto.makeConnection(transport)
+    proto.dataReceived('\x05\x00\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x50')
+    return proto
+
+
+def benchMemory(count):
+    """Measure the client side of open tunnels, without any sockets.
+
+    This runs first, before the other benchmarks leave freed memory around
+    to be reused. The number of objects tracked by the garbage collector is
+    reported too, since it doesn't depend on the allocator.
+
+    """
+    results = {}
+    for parser in ('fast', 'grammar'):
+        gc.collect()
+        bytesBefore = residentBytes()
+        objectsBefore = len(gc.get_objects())
+        tunnels = [openTunnel(parser) for x in xrange(count)]
+        gc.collect()
+        results['socks5_%s' % (parser,)] = {
+            'tunnels': len(tunnels),
+            'bytes_per_tunnel': (residentBytes() - bytesBefore) / float(count),
+            'objects_per_tunnel': (
+                (len(gc.get_objects()) - objectsBefore) / float(count)),
+        }
+        del tunnels
+    return results
+
+
+def tlsOptions():
+    """Make a self-signed certificate for ``localhost``.
+
+    Returns the server's and the client's TLS options, or ``None`` if
+    pyOpenSSL isn't available.
+
+    """
+    try:
+        from OpenSSL import crypto
+        from twisted.internet import ssl
+    except ImportError:
+        return None
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(-60)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([
+        crypto.X509Extension(b'subjectAltName', False, b'DNS:localhost')])
+    cert.sign(key, 'sha256')
+    serverOptions = ssl.PrivateCertificate.loadPEM(
+        crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+        + crypto.dump_privatekey(crypto.FILETYPE_PEM, key)).options()
+    clientOptions = ssl.optionsForClientTLS(
+        u'localhost', trustRoot=ssl.Certificate(cert))
+    return serverOptions, clientOptions
+
+
+@implementer(IPolicyForHTTPS)
+class TrustingPolicy(object):
+    def __init__(self, options):
+        self.options = options
+
+    def creatorForNetloc(self, hostname, port):
+        return self.options
+
+
+@defer.inlineCallbacks
+def benchAgent(reactor, ports, count, concurrency, clientTLS):
+    def requests(url, contextFactory=None):
+        kwargs = {}
+        if contextFactory is not None:
+            kwargs['contextFactory'] = contextFactory
+        agent = http.SOCKS5Agent(
+            reactor,
+            proxyEndpoint=TCP4ClientEndpoint(
+                reactor, '127.0.0.1', ports['socks5']),
+            pool=HTTPConnectionPool(reactor, persistent=False),
+            **kwargs)
+
+        def request():
+            d = agent.request('GET', url)
+            d.addCallback(readBody)
+            return d
+        return runConcurrently(count, concurrency, request)
+
+    results = {}
+    elapsed, latencies = yield requests('http://bench.invalid/')
+    results['http'] = summarize(count, elapsed, latencies, 'requests')
+    if clientTLS is not None:
+        elapsed, latencies = yield requests(
+            'https://localhost/', TrustingPolicy(clientTLS))
+        results['https'] = summarize(count, elapsed, latencies, 'requests')
+    defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def listen(reactor, factory):
+    port = yield TCP4ServerEndpoint(
+        reactor, 0, interface='127.0.0.1').listen(factory)
+    defer.returnValue(port)
+
+
+@defer.inlineCallbacks
+def main(reactor, argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--quick', action='store_true', help='run smaller workloads')
+    parser.add_argument(
+        '--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+    scale = 10 if args.quick else 1
+
+    tls = tlsOptions()
+    services = server.ServicesFactory(
+        sourceSize=64 * 2 ** 20 // scale,
+        serverTLS=tls and tls[0])
+    listening = {
+        'socks4': (
+            yield listen(reactor, server.SOCKSServerFactory(4, services))),
+        'socks5': (
+            yield listen(reactor, server.SOCKSServerFactory(5, services))),
+        'source': (yield listen(reactor, services)),
+        'discard': (yield listen(
+            reactor, server.ServicesFactory(0, service=server.DISCARD))),
+    }
+    ports = dict(
+        (name, port.getHost().port) for name, port in listening.iteritems())
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'twisted': twisted.__version__,
+            'reactor': type(reactor).__name__,
+        },
+    }
+    try:
+        results['memory'] = benchMemory(20000 // scale)
+        results['handshakes'] = yield benchHandshakes(
+            reactor, ports, count=2000 // scale, concurrency=50)
+        results['relay'] = yield benchRelay(
+            reactor, ports, services.sourceSize)
+        results['agent'] = yield benchAgent(
+            reactor, ports, count=500 // scale, concurrency=20,
+            clientTLS=tls and tls[1])
+    finally:
+        for port in listening.itervalues():
+            yield port.stopListening()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    react(main, [sys.argv[1:]])
@@ -0,0 +1,134 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Caching helpers shared by the resolvers, TLS sessions and agents.
+
+"""
+
+
+from twisted.internet import defer
+
+
+class _ExpiringLRUCache(object):
+    """A mapping of at most *size* entries, each of which can expire.
+
+    Entries are kept in a circular doubly-linked list in order of use, so
+    that finding the least recently used entry to evict doesn't need a scan.
+    *clock* is only needed for entries with a TTL.
+
+    """
+
+    def __init__(self, size, clock):
+        self.size = size
+        self.clock = clock
+        self._entries = {}
+        # Each link is [previous, next, key, value, expires].
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def get(self, key):
+        """Return the value for *key*, or ``None`` if it's missing or expired.
+
+        """
+        link = self._entries.get(key)
+        if link is None:
+            return None
+        if link[4] is not None and link[4] <= self.clock.seconds():
+            self.invalidate(key)
+            return None
+        self._unlink(link)
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0], link[1] = last, root
+        return link[3]
+
+    def set(self, key, value, ttl=None):
+        """Store *value* for *key* for *ttl* seconds, or until it's evicted if
+        *ttl* is ``None``.
+
+        """
+        if self.size <= 0:
+            return
+        self.invalidate(key)
+        if len(self._entries) >= self.size:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._entries[oldest[2]]
+        root = self._root
+        last = root[0]
+        expires = None if ttl is None else self.clock.seconds() + ttl
+        link = [last, root, key, value, expires]
+        last[1] = root[0] = link
+        self._entries[key] = link
+
+    def invalidate(self, key):
+        """Forget *key*, if it's present.
+
+        """
+        link = self._entries.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+
+    def clear(self):
+        """Forget every entry.
+
+        """
+        self._entries.clear()
+        root = self._root
+        root[:] = [root, root, None, None, None]
+
+
+class _Coalescer(object):
+    """Shares one call per key among everyone who asks for it at once.
+
+    Each caller gets its own ``Deferred``. Canceling one only stops the shared
+    call once every caller has canceled.
+
+    """
+
+    coalesced = 0
+
+    def __init__(self):
+        self._inFlight = {}
+
+    def call(self, key, function, *a, **kw):
+        """Return a ``Deferred`` for the result of ``function(*a, **kw)``.
+
+        If a call for *key* is already running, its result is shared instead of
+        calling *function* again.
+
+        """
+        waiter = defer.Deferred(lambda d: self._cancel(key, d))
+        inFlight = self._inFlight.get(key)
+        if inFlight is not None:
+            self.coalesced += 1
+            inFlight[1].append(waiter)
+            return waiter
+        # The waiter is registered first, in case the call finishes at once.
+        inFlight = self._inFlight[key] = [None, [waiter]]
+        inFlight[0] = defer.maybeDeferred(function, *a, **kw)
+        inFlight[0].addBoth(self._finished, key)
+        return waiter
+
+    def _cancel(self, key, waiter):
+        inFlight = self._inFlight.get(key)
+        if inFlight is None:
+            return
+        d, waiters = inFlight
+        waiters.remove(waiter)
+        if not waiters:
+            d.cancel()
+
+    def _finished(self, result, key):
+        d, waiters = self._inFlight.pop(key)
+        for waiter in waiters:
+            waiter.callback(result)
@@ -0,0 +1,260 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""SOCKS5 ``BIND`` support.
+
+"""
+
+
+from twisted.internet import defer, interfaces
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.python import failure, log
+from zope.interface import implementer
+
+import txsocksx.constants as c
+from txsocksx.client import SOCKS5ClientFactory, _makeTimer, validateTimeouts
+
+
+def _address(host, port):
+    if isIPv6Address(host):
+        return IPv6Address('TCP', host, port)
+    return IPv4Address('TCP', host, port)
+
+
+class _SOCKS5BindFactory(SOCKS5ClientFactory):
+    """Negotiates one ``BIND``.
+
+    ``bound`` fires with the factory once the server has replied with the
+    address it's listening on; ``deferred`` fires with the protocol built
+    for the peer once the peer has connected.
+
+    """
+
+    command = c.CMD_BIND
+
+    def __init__(self, *a, **kw):
+        SOCKS5ClientFactory.__init__(self, *a, **kw)
+        self.bound = defer.Deferred(self._cancel)
+
+    def proxyBound(self, proxyProtocol):
+        host, port = self.boundAddress
+        if host in ('0.0.0.0', '::'):
+            # The server is listening on every address; the one we reached it
+            # on is the most likely to be reachable for the peer, too.
+            host = proxyProtocol.sender.transport.getPeer().host
+            self.boundAddress = host, port
+        self.bound.callback(self)
+
+    def proxyConnectionFailed(self, reason):
+        if self.canceled:
+            return
+        if not self.bound.called:
+            self.bound.errback(reason)
+        else:
+            self.deferred.errback(reason)
+
+    def proxyConnectionEstablished(self, proxyProtocol):
+        proto = self.proxiedFactory.buildProtocol(_address(*self.peerAddress))
+        if proto is None:
+            self.deferred.cancel()
+            return
+        proxyProtocol.proxyEstablished(proto)
+        self.deferred.callback(proto)
+
+
+@implementer(interfaces.IListeningPort)
+class SOCKS5BindPort(object):
+    """Outstanding ``BIND`` requests, waiting for peers to connect.
+
+    Each ``BIND`` accepts a single connection; once a peer has connected
+    through one, another is requested so that *backlog* are kept outstanding.
+    If a replacement can't be requested, it's retried after
+    ``initialRetryDelay`` seconds, doubling up to ``maxRetryDelay`` until one
+    succeeds. The ``failures`` attribute counts the replacements which failed.
+
+    """
+
+    stopped = False
+    failures = 0
+    initialRetryDelay = 1
+    maxRetryDelay = 60
+    _retryCall = None
+
+    def __init__(self, endpoint, factory):
+        self.endpoint = endpoint
+        self.factory = factory
+        self._pending = []
+        self._ready = []
+        self._retryDelay = self.initialRetryDelay
+
+    def startListening(self):
+        """Request *backlog* ``BIND``\ s.
+
+        Returns a ``Deferred`` which fires with this port once the server has
+        replied to one of them, or errbacks with the last failure if all of
+        them fail.
+
+        """
+        started = defer.Deferred()
+        outcomes = []
+
+        def firstBound(result):
+            outcomes.append(result)
+            if started.called:
+                return
+            if not isinstance(result, failure.Failure):
+                started.callback(self)
+            elif len(outcomes) == self.endpoint.backlog:
+                started.errback(result)
+
+        for x in xrange(self.endpoint.backlog):
+            self._bind().addBoth(firstBound)
+        return started
+
+    def _bind(self):
+        endpoint = self.endpoint
+        proxyFac = _SOCKS5BindFactory(
+            endpoint.host, endpoint.port, self.factory, endpoint.methods,
+            parser=endpoint.parser)
+        timer = _makeTimer(endpoint.reactor, endpoint.timeouts)
+        proxyFac.timer = timer
+        self._pending.append(proxyFac)
+        d = proxyFac.connecting = endpoint.proxyEndpoint.connect(proxyFac)
+        d.addCallback(lambda proto: proxyFac.bound)
+        if timer is not None:
+            timer.watch(d)
+        d.addCallbacks(self._bound, self._bindFailed, errbackArgs=(proxyFac,))
+        return d
+
+    def _bound(self, proxyFac):
+        self._pending.remove(proxyFac)
+        self._ready.append(proxyFac)
+        self._retryDelay = self.initialRetryDelay
+        proxyFac.deferred.addCallbacks(
+            self._accepted, self._lost,
+            callbackArgs=(proxyFac,), errbackArgs=(proxyFac,))
+        return proxyFac
+
+    def _bindFailed(self, reason, proxyFac):
+        self._pending.remove(proxyFac)
+        return reason
+
+    def _accepted(self, proto, proxyFac):
+        self._ready.remove(proxyFac)
+        self._replenish()
+        return proto
+
+    def _lost(self, reason, proxyFac):
+        # The server gave up on a BIND which had been granted, e.g. after its
+        # own timeout; replace it.
+        self._ready.remove(proxyFac)
+        self._replenish()
+
+    def _replenish(self):
+        if self.stopped:
+            return
+        for x in xrange(
+                self.endpoint.backlog - len(self._pending) - len(self._ready)):
+            self._bind().addErrback(self._replenishFailed)
+
+    def _replenishFailed(self, reason):
+        if self.stopped:
+            return
+        self.failures += 1
+        if self._retryCall is not None:
+            return
+        log.msg('BIND request failed; retrying in %s seconds: %s' % (
+            self._retryDelay, reason.getErrorMessage()))
+        reactor = self.endpoint.reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        self._retryCall = reactor.callLater(self._retryDelay, self._retry)
+        self._retryDelay = min(self._retryDelay * 2, self.maxRetryDelay)
+
+    def _retry(self):
+        self._retryCall = None
+        self._replenish()
+
+    def getHost(self):
+        """Return the address the peer should connect to next.
+
+        This is the address of the oldest ``BIND`` which is still waiting for
+        a peer, or ``None`` if there are none.
+
+        """
+        if not self._ready:
+            return None
+        return _address(*self._ready[0].boundAddress)
+
+    def boundAddresses(self):
+        """Return the addresses of every ``BIND`` waiting for a peer.
+
+        """
+        return [_address(*proxyFac.boundAddress) for proxyFac in self._ready]
+
+    def stopListening(self):
+        """Cancel every outstanding ``BIND``.
+
+        """
+        self.stopped = True
+        if self._retryCall is not None:
+            self._retryCall.cancel()
+            self._retryCall = None
+        for proxyFac in list(self._pending):
+            proxyFac.connecting.cancel()
+        for proxyFac in list(self._ready):
+            proxyFac.deferred.cancel()
+
+    loseConnection = stopListening
+
+
+@implementer(interfaces.IStreamServerEndpoint)
+class SOCKS5BindEndpoint(object):
+    """An endpoint which accepts connections through a SOCKS5 server.
+
+    :param host: The address of the peer expected to connect, as sent in each
+        ``BIND`` request. Servers may restrict the connection to it.
+    :param port: The port of the peer expected to connect.
+    :param proxyEndpoint: The endpoint of the SOCKS5 server. This must provide
+        `IStreamClientEndpoint`__.
+    :param methods: The authentication methods to try, as for
+        |SOCKS5ClientEndpoint|.
+    :param backlog: The number of ``BIND`` requests to keep outstanding, so
+        that a peer never has to wait for a fresh negotiation.
+    :param parser: Which parser to use for the server's replies, as for
+        |SOCKS5ClientEndpoint|.
+    :param timeouts: Handshake timeouts for each ``BIND``, as for
+        |SOCKS5ClientEndpoint|. They don't apply to waiting for the peer.
+    :param reactor: The `IReactorTime`__ used for *timeouts*. Defaults to the
+        global reactor.
+
+    ``listen`` returns a ``Deferred`` which fires with a `SOCKS5BindPort`
+    once the server is listening; its ``getHost`` is the address to give to
+    the peer.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamClientEndpoint.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    def __init__(self, host, port, proxyEndpoint, methods={'anonymous': ()},
+                 backlog=1, parser='grammar', timeouts=None, reactor=None):
+        if not methods:
+            raise ValueError('no auth methods were specified')
+        if backlog < 1:
+            raise ValueError('backlog must be at least 1')
+        validateTimeouts(timeouts)
+        if parser not in SOCKS5ClientFactory.protocols:
+            raise ValueError('unknown parser %r' % (parser,))
+        self.host = host
+        self.port = port
+        self.proxyEndpoint = proxyEndpoint
+        self.methods = methods
+        self.backlog = backlog
+        self.parser = parser
+        self.timeouts = timeouts
+        self.reactor = reactor
+
+    def listen(self, fac):
+        return SOCKS5BindPort(self, fac).startListening()
@@ -8,18 +8,46 @@
 
 import socket
 import struct
+try:
+    from time import monotonic as _now
+except ImportError:
+    from time import time as _now
 
 from parsley import makeProtocol, stack
-from twisted.internet import protocol, defer, interfaces
-from zope.interface import implementer
+from twisted.internet import protocol, defer, error, interfaces
+from twisted.python import failure, log
+from zope.interface import directlyProvides, implementer, providedBy
 
 import txsocksx.constants as c, txsocksx.errors as e
 from txsocksx import grammar
+from txsocksx.parser import FastParserProtocol, makeFastProtocol
 
 
+_addressTypes = [
+    (socket.AF_INET, c.ATYP_IPV4),
+    (socket.AF_INET6, c.ATYP_IPV6),
+]
+
 def socks_host(host):
+    # IP addresses are sent as such, so the server doesn't have to parse or
+    # resolve them; anything else is sent as a hostname.
+    for family, addressType in _addressTypes:
+        try:
+            packed = socket.inet_pton(family, host)
+        except socket.error:
+            continue
+        return chr(addressType) + packed
     return chr(c.ATYP_DOMAINNAME) + chr(len(host)) + host
 
+def _isIPAddress(host):
+    for family, addressType in _addressTypes:
+        try:
+            socket.inet_pton(family, host)
+        except socket.error:
+            continue
+        return True
+    return False
+
 def validateSOCKS4aHost(host):
     try:
         host = socket.inet_pton(socket.AF_INET, host)
@@ -29,12 +57,177 @@ def validateSOCKS4aHost(host):
         raise ValueError('SOCKS4a reserves addresses 0.0.0.1-0.0.0.255')
 
 
+handshakePhases = frozenset(['connect', 'auth', 'request', 'total'])
+
+def validateTimeouts(timeouts, earlyData=False):
+    if timeouts and not handshakePhases.issuperset(timeouts):
+        raise ValueError('unknown handshake phases %r' % (
+            sorted(set(timeouts) - handshakePhases),))
+    # With early data, connect fires as soon as the server is reached, and
+    # nothing is left to cancel when a later phase runs out.
+    if earlyData and timeouts and set(timeouts) - set(['connect']):
+        raise ValueError('only the connect phase can time out with earlyData')
+
+def validateOptimisticMethods(methods, optimistic):
+    if optimistic and len(methods) != 1:
+        raise ValueError(
+            'optimistic negotiation requires exactly one auth method')
+
+
+class _HandshakeTimer(object):
+    """Cancels a negotiation which takes too long in any phase.
+
+    The ``connect`` phase starts immediately. Each later phase replaces the
+    previous phase's deadline, while the ``total`` deadline runs until the
+    watched ``Deferred`` fires.
+
+    """
+
+    timedOut = None
+    deferred = None
+    finished = False
+
+    def __init__(self, reactor, timeouts):
+        self.reactor = reactor
+        self.timeouts = timeouts
+        self._phaseCall = None
+        self._totalCall = None
+        if 'total' in timeouts:
+            self._totalCall = reactor.callLater(
+                timeouts['total'], self._timeout, 'total')
+        self.enterPhase('connect')
+
+    def enterPhase(self, phase):
+        if self.finished:
+            return
+        if self._phaseCall is not None and self._phaseCall.active():
+            self._phaseCall.cancel()
+        self._phaseCall = None
+        if phase in self.timeouts:
+            self._phaseCall = self.reactor.callLater(
+                self.timeouts[phase], self._timeout, phase)
+
+    def watch(self, d):
+        self.deferred = d
+        return d.addBoth(self._finished)
+
+    def _timeout(self, phase):
+        self.timedOut = phase
+        self.deferred.cancel()
+
+    def _finished(self, result):
+        self.finished = True
+        for call in self._phaseCall, self._totalCall:
+            if call is not None and call.active():
+                call.cancel()
+        if (self.timedOut is not None
+                and isinstance(result, failure.Failure)
+                and result.check(defer.CancelledError)):
+            return failure.Failure(e.HandshakeTimeout(self.timedOut))
+        return result
+
+
+def _makeTimer(reactor, timeouts):
+    if not timeouts:
+        return None
+    if reactor is None:
+        from twisted.internet import reactor
+    return _HandshakeTimer(reactor, timeouts)
+
+def _instrument(endpoint, proxyFac, phaseTimes):
+    if endpoint.timingObserver is not None:
+        proxyFac.phaseTimes = phaseTimes
+    if endpoint.metrics is not None:
+        proxyFac.metrics = endpoint.metrics
+        proxyFac.metrics.handshakeStarted()
+        proxyFac.startedAt = _now()
+
+def _instrumented(endpoint, proxyFac, d):
+    if endpoint.timingObserver is not None:
+        d.addBoth(_reportTimings, endpoint, proxyFac)
+    if endpoint.metrics is not None:
+        d.addBoth(_reportMetrics, proxyFac)
+    return d
+
+def _reportMetrics(result, proxyFac):
+    return proxyFac.metrics.handshakeFinished(
+        result, _now() - proxyFac.startedAt)
+
+def _reportTimings(result, endpoint, proxyFac):
+    phaseTimes = proxyFac.phaseTimes + [(None, _now())]
+    phases = {}
+    for (phase, start), (ign, end) in zip(phaseTimes, phaseTimes[1:]):
+        phases[phase] = phases.get(phase, 0) + end - start
+    timings = {
+        'proxyEndpoint': endpoint.proxyEndpoint,
+        'host': endpoint.host,
+        'port': endpoint.port,
+        'phases': phases,
+        'total': phaseTimes[-1][1] - phaseTimes[0][1],
+        'reason': result if isinstance(result, failure.Failure) else None,
+    }
+    try:
+        endpoint.timingObserver(timings)
+    except Exception:
+        log.err(None, 'error in SOCKS handshake timing observer')
+    return result
+
+def logHandshakeTimings(timings):
+    """A *timingObserver* which logs each handshake's timings.
+
+    One event is logged per phase, then one for the whole handshake with a
+    *phase* of ``'total'``. Each event carries *phase* and *seconds* fields
+    alongside *host*, *port*, *proxyEndpoint* and *reason*, so observers of
+    ``twisted.logger`` events can pick them out without parsing the message.
+
+    """
+    fields = dict(
+        (key, timings[key])
+        for key in ['proxyEndpoint', 'host', 'port', 'reason'])
+    phases = sorted(timings['phases'].items())
+    for phase, seconds in phases + [('total', timings['total'])]:
+        log.msg(
+            format='SOCKS handshake with %(host)s:%(port)s via '
+                   '%(proxyEndpoint)r: %(phase)s took %(seconds).4fs',
+            socksHandshake=True, phase=phase, seconds=seconds, **fields)
+
+def _connectThroughProxy(proxyEndpoint, proxyFac, timer):
+    proxyFac.timer = timer
+    d = proxyEndpoint.connect(proxyFac)
+    d.addCallback(lambda proto: proxyFac.deferred)
+    if timer is not None:
+        timer.watch(d)
+    return d
+
+
 class _SOCKSClientFactory(protocol.ClientFactory):
     currentCandidate = None
     canceled = False
+    protocols = {}
+    timer = None
+    phaseTimes = None
+    metrics = None
+    frames = None
+
+    def handshakePhase(self, phase):
+        if self.timer is not None:
+            self.timer.enterPhase(phase)
+        if self.phaseTimes is not None:
+            self.phaseTimes.append((phase, _now()))
+
+    def _setParser(self, parser):
+        # Without an explicit parser, the class's protocol is used, so
+        # subclasses with their own protocol keep it.
+        if parser is None:
+            return
+        try:
+            self.protocol = self.protocols[parser]
+        except KeyError:
+            raise ValueError('unknown parser %r' % (parser,))
 
     def _cancel(self, d):
-        self.currentCandidate.sender.transport.abortConnection()
+        if self.currentCandidate is not None:
+            self.currentCandidate.sender.transport.abortConnection()
         self.canceled = True
 
     def buildProtocol(self, addr):
@@ -60,46 +253,211 @@ class _SOCKSClientFactory(protocol.ClientFactory):
         proxyProtocol.proxyEstablished(proto)
         self.deferred.callback(proto)
 
+@implementer(interfaces.ITransport)
+class _EarlyDataTransport(object):
+    """The transport given to the proxied protocol in early-data mode.
+
+    Writes are buffered until the SOCKS request has been sent, and then passed
+    straight through to the transport of the connection to the proxy, so that
+    they arrive at the proxy right behind the request. It provides the same
+    interfaces as that transport.
+
+    """
+
+    __slots__ = ('_transport', '_buffer', '_closeOnRelease', '__provides__')
+
+    def __init__(self, transport, buffering):
+        directlyProvides(self, providedBy(transport))
+        self._transport = transport
+        self._buffer = [] if buffering else None
+        self._closeOnRelease = False
+
+    def __getattr__(self, attr):
+        return getattr(self._transport, attr)
+
+    def write(self, data):
+        if self._buffer is None:
+            self._transport.write(data)
+        else:
+            self._buffer.append(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def loseConnection(self):
+        if self._buffer is None:
+            self._transport.loseConnection()
+        else:
+            self._closeOnRelease = True
+
+    def release(self, data=''):
+        buffered, self._buffer = self._buffer, None
+        if buffered:
+            data += ''.join(buffered)
+        if data:
+            self._transport.write(data)
+        if self._closeOnRelease:
+            self._transport.loseConnection()
+
+
+@implementer(interfaces.ITransport)
+class _MeteredTransport(object):
+    """The transport given to the proxied protocol when there's a metrics
+    collector, counting the bytes written. It provides the same interfaces as
+    the transport it wraps.
+
+    """
+
+    __slots__ = ('_transport', '_metrics', '__provides__')
+
+    def __init__(self, transport, metrics):
+        directlyProvides(self, providedBy(transport))
+        self._transport = transport
+        self._metrics = metrics
+
+    def __getattr__(self, attr):
+        return getattr(self._transport, attr)
+
+    def write(self, data):
+        self._metrics.bytesSent += len(data)
+        self._transport.write(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+
 class _SOCKSReceiver(object):
+    # One of these lives as long as each tunnel, so they're kept small.
+    __slots__ = (
+        'sender', 'parserProtocol', 'factory', 'otherProtocol',
+        'earlyTransport', 'metrics', 'currentRule')
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.otherProtocol = self.earlyTransport = self.metrics = None
+        self.currentRule = self.initialRule
+
     def proxyEstablished(self, other):
         self.otherProtocol = other
-        other.makeConnection(self.sender.transport)
+        transport = self.earlyTransport or self.sender.transport
+        self.metrics = self.factory.metrics
+        if self.metrics is not None:
+            self.metrics.tunnelOpened()
+            transport = _MeteredTransport(transport, self.metrics)
+        other.makeConnection(transport)
+        if self.earlyTransport is None:
+            self._switchProtocol()
+
+    def _watchParser(self, parser):
+        if isinstance(parser, FastParserProtocol):
+            return
+        # Parsley's parser would pass whatever follows the last reply in the
+        # same chunk to SOCKSState_readData one byte at a time. Feed it the
+        # handshake a byte at a time instead; once _switchProtocol has
+        # replaced dataReceived, the rest goes to the tunnel in one call.
+        parse = parser.dataReceived
+
+        def dataReceived(data):
+            for pos in xrange(len(data)):
+                if parser.dataReceived is not dataReceived:
+                    parser.dataReceived(data[pos:])
+                    return
+                parse(data[pos])
+
+        parser.dataReceived = dataReceived
+
+    def _switchProtocol(self):
+        # From here on, whatever delivers data to the parser (a reactor
+        # transport, a ProtocolWrapper, a test transport, ...) calls the
+        # proxied protocol directly instead of going through the parser.
+        if self.metrics is not None:
+            self.parserProtocol.dataReceived = self.dataReceived
+            self.parserProtocol.connectionLost = self._tunnelLost
+            return
+        other = self.otherProtocol
+        self.parserProtocol.dataReceived = other.dataReceived
+        self.parserProtocol.connectionLost = other.connectionLost
 
         # a bit rude, but a huge performance increase
         if hasattr(self.sender.transport, 'protocol'):
             self.sender.transport.protocol = other
 
+    def _startEarlyData(self, buffering):
+        self.earlyTransport = _EarlyDataTransport(
+            self.sender.transport, buffering)
+        self.factory.proxyConnectionEstablished(self)
+
+    def _proxyGranted(self):
+        if self.earlyTransport is None:
+            self.factory.proxyConnectionEstablished(self)
+        else:
+            self._switchProtocol()
+
+    def _startRelaying(self):
+        self.currentRule = 'SOCKSState_readData'
+        if self.otherProtocol is not None:
+            # Only the relay is needed from here on, so let the factory and
+            # everything it refers to from the handshake go.
+            self.factory = self.parserProtocol.factory = None
+
     def dataReceived(self, data):
+        if self.metrics is not None:
+            self.metrics.bytesReceived += len(data)
         self.otherProtocol.dataReceived(data)
 
+    def _tunnelLost(self, reason):
+        if self.metrics is not None:
+            self.metrics.tunnelClosed()
+        self.otherProtocol.connectionLost(reason)
+
     def finishParsing(self, reason):
         if self.otherProtocol:
-            self.otherProtocol.connectionLost(reason)
+            self._tunnelLost(reason)
         else:
             self.factory.proxyConnectionFailed(reason)
 
 
 class SOCKS5Sender(object):
+    __slots__ = ('transport',)
+
     def __init__(self, transport):
         self.transport = transport
 
-    def sendAuthMethods(self, methods):
-        self.transport.write(
-            struct.pack('!BB', c.VER_SOCKS5, len(methods)) + ''.join(methods))
+    def packAuthMethods(self, methods):
+        return struct.pack('!BB', c.VER_SOCKS5, len(methods)) + ''.join(methods)
 
-    def sendLogin(self, username, password):
-        self.transport.write(
+    def packLogin(self, username, password):
+        return (
             '\x01'
             + chr(len(username)) + username
             + chr(len(password)) + password)
 
-    def sendRequest(self, command, host, port):
+    def packRequest(self, command, host, port):
         data = struct.pack('!BBB', c.VER_SOCKS5, command, c.RSV)
         port = struct.pack('!H', port)
-        self.transport.write(data + socks_host(host) + port)
+        return data + socks_host(host) + port
+
+    def sendAuthMethods(self, methods):
+        self.transport.write(self.packAuthMethods(methods))
+
+    def sendLogin(self, username, password):
+        self.transport.write(self.packLogin(username, password))
+
+    def sendRequest(self, command, host, port):
+        self.transport.write(self.packRequest(command, host, port))
+
+    def sendOptimistic(self, method, args, command, host, port):
+        data = self.packAuthMethods([method])
+        if method == c.AUTH_LOGIN:
+            data += self.packLogin(*args)
+        self.transport.write(data + self.packRequest(command, host, port))
 
 
 class SOCKS5AuthDispatcher(object):
+    __slots__ = ('w',)
+
     def __init__(self, wrapped):
         self.w = wrapped
 
@@ -115,15 +473,31 @@ class SOCKS5AuthDispatcher(object):
 
 
 class SOCKS5Receiver(_SOCKSReceiver):
-    otherProtocol = None
-    currentRule = 'SOCKS5ClientState_initial'
-
-    def __init__(self, sender):
-        self.sender = sender
+    __slots__ = ()
+    initialRule = 'SOCKS5ClientState_initial'
 
     def prepareParsing(self, parser):
+        self.parserProtocol = parser
         self.factory = parser.factory
-        self.sender.sendAuthMethods(self.factory.methods)
+        self._watchParser(parser)
+        frames = self.factory.frames
+        if self.factory.optimistic:
+            if frames is not None and frames.optimistic is not None:
+                # The frames' request is always a CONNECT.
+                assert self.factory.command == c.CMD_CONNECT
+                self.sender.transport.write(frames.optimistic)
+            else:
+                [(method, args)] = self.factory.methods.items()
+                self.sender.sendOptimistic(
+                    method, args, self.factory.command, self.factory.host,
+                    self.factory.port)
+        elif frames is not None:
+            self.sender.transport.write(frames.greeting)
+        else:
+            self.sender.sendAuthMethods(self.factory.methods)
+        self.factory.handshakePhase('auth')
+        if self.factory.earlyData:
+            self._startEarlyData(buffering=not self.factory.optimistic)
 
     authMethodMap = {
         c.AUTH_ANONYMOUS: 'anonymous',
@@ -134,7 +508,12 @@ class SOCKS5Receiver(_SOCKSReceiver):
         self._sendRequest()
 
     def auth_login(self, username, password):
-        self.sender.sendLogin(username, password)
+        if not self.factory.optimistic:
+            frames = self.factory.frames
+            if frames is not None and frames.login is not None:
+                self.sender.transport.write(frames.login)
+            else:
+                self.sender.sendLogin(username, password)
         self.currentRule = 'SOCKS5ClientState_readLoginResponse'
 
     def loginResponse(self, success):
@@ -144,16 +523,39 @@ class SOCKS5Receiver(_SOCKSReceiver):
         self._sendRequest()
 
     def _sendRequest(self):
-        self.sender.sendRequest(
-            c.CMD_CONNECT, self.factory.host, self.factory.port)
+        if self.factory.host is None:
+            self.currentRule = 'SOCKS5ClientState_awaitingRequest'
+            self.factory.proxyAuthenticated(self)
+            return
+        if not self.factory.optimistic:
+            if self.factory.frames is not None:
+                assert self.factory.command == c.CMD_CONNECT
+                request = self.factory.frames.request
+            else:
+                request = self.sender.packRequest(
+                    self.factory.command, self.factory.host, self.factory.port)
+            if self.earlyTransport is not None:
+                # The request and the early data go out in one write.
+                self.earlyTransport.release(request)
+            else:
+                self.sender.transport.write(request)
+        self.factory.handshakePhase('request')
         self.currentRule = 'SOCKS5ClientState_readResponse'
 
     def serverResponse(self, status, address, port):
         if status != c.SOCKS5_GRANTED:
             raise e.socks5ErrorMap.get(status)()
 
-        self.factory.proxyConnectionEstablished(self)
-        self.currentRule = 'SOCKSState_readData'
+        if self.factory.boundAddress is None:
+            self.factory.boundAddress = address, port
+            if self.factory.command == c.CMD_BIND:
+                # The second reply comes once the peer connects.
+                self.factory.proxyBound(self)
+                return
+        else:
+            self.factory.peerAddress = address, port
+        self._proxyGranted()
+        self._startRelaying()
 
 SOCKS5Client = makeProtocol(
     grammar.grammarSource,
@@ -161,37 +563,143 @@ SOCKS5Client = makeProtocol(
     stack(SOCKS5AuthDispatcher, SOCKS5Receiver),
     grammar.bindings)
 
+SOCKS5FastClient = makeFastProtocol(
+    SOCKS5Sender,
+    stack(SOCKS5AuthDispatcher, SOCKS5Receiver))
+
 class SOCKS5ClientFactory(_SOCKSClientFactory):
     protocol = SOCKS5Client
+    command = c.CMD_CONNECT
+    boundAddress = peerAddress = None
+    protocols = {
+        'fast': SOCKS5FastClient,
+        'grammar': SOCKS5Client,
+    }
 
     authMethodMap = {
         'anonymous': c.AUTH_ANONYMOUS,
         'login': c.AUTH_LOGIN,
     }
 
-    def __init__(self, host, port, proxiedFactory, methods={'anonymous': ()}):
+    @classmethod
+    def _methodTable(cls, methods):
+        return dict(
+            (cls.authMethodMap[method], value)
+            for method, value in methods.iteritems())
+
+    def __init__(self, host, port, proxiedFactory, methods={'anonymous': ()},
+                 parser=None, optimistic=False, earlyData=False):
         if not methods:
             raise ValueError('no auth methods were specified')
+        validateOptimisticMethods(methods, optimistic)
+        self._setParser(parser)
         self.host = host
         self.port = port
         self.proxiedFactory = proxiedFactory
-        self.methods = dict(
-            (self.authMethodMap[method], value)
-            for method, value in methods.iteritems())
+        self.methods = self._methodTable(methods)
+        self.optimistic = optimistic
+        self.earlyData = earlyData
         self.deferred = defer.Deferred(self._cancel)
 
 
+class _SOCKS5Frames(object):
+    """What a SOCKS5 client sends to connect to *host* and *port* using
+    *methods*.
+
+    """
+
+    __slots__ = (
+        'host', 'port', 'methods', 'methodTable', 'greeting', 'login',
+        'request', 'optimistic')
+
+    def __init__(self, host, port, methods):
+        self.host = host
+        self.port = port
+        self.methods = dict(methods)
+        packer = SOCKS5Sender(None)
+        table = self.methodTable = SOCKS5ClientFactory._methodTable(methods)
+        self.greeting = packer.packAuthMethods(table)
+        self.login = None
+        if c.AUTH_LOGIN in table:
+            try:
+                self.login = packer.packLogin(*table[c.AUTH_LOGIN])
+            except TypeError:
+                # Leave malformed credentials to fail when they're used.
+                pass
+        self.request = packer.packRequest(c.CMD_CONNECT, host, port)
+        self.optimistic = None
+        if len(table) == 1 and (
+                self.login is not None or c.AUTH_LOGIN not in table):
+            self.optimistic = (
+                packer.packAuthMethods(list(table)) + (self.login or '')
+                + self.request)
+
+    def matches(self, host, port, methods):
+        return (
+            self.host == host and self.port == port
+            and self.methods == methods)
+
+
 @implementer(interfaces.IStreamClientEndpoint)
 class SOCKS5ClientEndpoint(object):
     """An endpoint which does SOCKS5 negotiation.
 
     :param host: The hostname to connect to through the SOCKS5 server. This
         will not be resolved by ``txsocksx`` but will be sent without
-        modification to the SOCKS5 server to be resolved remotely.
+        modification to the SOCKS5 server to be resolved remotely. IPv4 and
+        IPv6 addresses are sent as addresses instead of as hostnames.
     :param port: The port to connect to through the SOCKS5 server.
     :param proxyEndpoint: The endpoint of the SOCKS5 server. This must provide
         `IStreamClientEndpoint`__.
     :param methods: The authentication methods to try.
+    :param parser: Which parser to use for the server's replies.
+        ``'grammar'`` (the default) uses the Parsley grammar, which protocols
+        extending the grammar build on; ``'fast'`` uses the hand-written
+        parsers in ``txsocksx.parser``, which negotiate faster.
+    :param optimistic: If true, don't wait for the server's reply to each step
+        of the negotiation. The greeting, the credentials and the ``CONNECT``
+        request are sent in a single write, and the server's replies are
+        checked in order as they arrive, which makes the negotiation take one
+        round trip instead of two or three. Only use this with a server known
+        to accept the authentication method: *methods* must contain exactly
+        one method.
+    :param prewarmed: A ``txsocksx.pool.PrewarmedProxyConnections`` for the
+        same *proxyEndpoint* and *methods*. If it has a connection which has
+        already been authenticated, ``connect`` only has to send the request.
+        This can't be combined with *optimistic* or *earlyData*.
+    :param earlyData: If true, the provided factory's ``buildProtocol`` is
+        called as soon as the SOCKS5 request has been written, without waiting
+        for the server's reply. Anything the protocol writes is sent right
+        behind the request. If the server then rejects the request, the
+        protocol's ``connectionLost`` is called with the SOCKS error.
+    :param timeouts: A dict mapping handshake phases to the number of seconds
+        each may take. The phases are ``'connect'`` (connecting to the SOCKS5
+        server), ``'auth'`` (selecting an authentication method and logging
+        in), ``'request'`` (waiting for the reply to the request) and
+        ``'total'`` (the whole negotiation). If a phase takes too long, the
+        negotiation is canceled and the ``Deferred`` returned by ``connect``
+        errbacks with ``txsocksx.errors.HandshakeTimeout``. With *earlyData*,
+        ``connect`` fires before the later phases, so only ``'connect'`` may
+        be given.
+    :param reactor: The `IReactorTime`__ used for *timeouts*. Defaults to the
+        global reactor.
+    :param timingObserver: A callable which is called once each negotiation
+        finishes, with a dict of its timings. ``phases`` maps each phase that
+        was entered (``'connect'``, ``'auth'`` and ``'request'``, as for
+        *timeouts*) to the number of seconds spent in it and ``total`` is the
+        sum. ``proxyEndpoint``, ``host`` and ``port`` are the endpoint's, and
+        ``reason`` is the ``Failure`` if the negotiation failed or ``None``.
+        With *earlyData*, the negotiation counts as finished once the
+        protocol has been built. ``txsocksx.client.logHandshakeTimings``
+        logs them.
+    :param metrics: A ``txsocksx.metrics.MetricsCollector`` to count
+        negotiations, failures, open tunnels and relayed bytes in.
+    :param resolver: An `IResolverSimple`__ provider used to resolve *host*
+        before each connection, so that the request names an address
+        instead. Share one ``txsocksx.resolver.CachingResolver`` between
+        endpoints to look each name up only once for all of them. By default,
+        the SOCKS5 server resolves *host*. *timeouts* don't include the
+        lookup.
 
     Authentication methods are specified as a dict mapping from method names to
     tuples. By default, the only method tried is anonymous authentication, so
@@ -203,16 +711,64 @@ class SOCKS5ClientEndpoint(object):
     tuple of ``(username, password)``.
 
     __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamClientEndpoint.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IResolverSimple.html
 
     """
 
-    def __init__(self, host, port, proxyEndpoint, methods={'anonymous': ()}):
+    def __init__(self, host, port, proxyEndpoint, methods={'anonymous': ()},
+                 parser='grammar', optimistic=False, earlyData=False,
+                 prewarmed=None, timeouts=None, reactor=None,
+                 timingObserver=None, metrics=None, resolver=None):
         if not methods:
             raise ValueError('no auth methods were specified')
+        validateOptimisticMethods(methods, optimistic)
+        validateTimeouts(timeouts, earlyData)
+        if prewarmed is not None and (
+                prewarmed.proxyEndpoint is not proxyEndpoint
+                or prewarmed.methods != methods):
+            raise ValueError(
+                'prewarmed connections must use the same proxy and methods')
+        if prewarmed is not None and (optimistic or earlyData):
+            raise ValueError(
+                'prewarmed connections are already authenticated; they '
+                "can't be used optimistically or with early data")
+        if parser not in SOCKS5ClientFactory.protocols:
+            raise ValueError('unknown parser %r' % (parser,))
         self.host = host
         self.port = port
         self.proxyEndpoint = proxyEndpoint
         self.methods = methods
+        self.parser = parser
+        self.optimistic = optimistic
+        self.earlyData = earlyData
+        self.prewarmed = prewarmed
+        self.timeouts = timeouts
+        self.reactor = reactor
+        self.timingObserver = timingObserver
+        self.metrics = metrics
+        self.resolver = resolver
+        self._frames = None
+
+    def _handshakeFrames(self, host):
+        # Encoded once and reused for every connection, until the host, port
+        # or methods are changed.
+        frames = self._frames
+        if frames is None or not frames.matches(
+                host, self.port, self.methods):
+            frames = self._frames = _SOCKS5Frames(
+                host, self.port, self.methods)
+        return frames
+
+    def _identity(self):
+        return (
+            'socks5', self.proxyEndpoint, self.host, self.port,
+            tuple(sorted(self.methods.iteritems())))
+
+    def _proxyIdentity(self):
+        return (
+            'socks5', self.proxyEndpoint,
+            tuple(sorted(self.methods.iteritems())))
 
     def connect(self, fac):
         """Connect over SOCKS5.
@@ -227,6 +783,8 @@ class SOCKS5ClientEndpoint(object):
         2. If the SOCKS5 server gave a non-success response.
         3. If the SOCKS5 server did not reply with valid SOCKS5.
         4. If the ``Deferred`` returned from ``connect`` was cancelled.
+        5. If the negotiation took longer than *timeouts* allow.
+        6. If *resolver* couldn't resolve the host.
 
         The returned ``Deferred`` is cancelable during negotiation: the
         connection will immediately close and the ``Deferred`` will errback
@@ -239,17 +797,42 @@ class SOCKS5ClientEndpoint(object):
 
         """
 
-        proxyFac = SOCKS5ClientFactory(self.host, self.port, fac, self.methods)
-        d = self.proxyEndpoint.connect(proxyFac)
-        d.addCallback(lambda proto: proxyFac.deferred)
-        return d
+        if self.resolver is not None and not _isIPAddress(self.host):
+            d = self.resolver.getHostByName(self.host)
+            return d.addCallback(self._connect, fac)
+        return self._connect(self.host, fac)
+
+    def _connect(self, host, fac):
+        timer = _makeTimer(self.reactor, self.timeouts)
+        if self.prewarmed is not None:
+            proxyFac = self.prewarmed.take()
+            if proxyFac is not None:
+                proxyFac.timer = timer
+                proxyFac.frames = self._handshakeFrames(host)
+                _instrument(self, proxyFac, [])
+                d = proxyFac.requestConnection(host, self.port, fac)
+                if timer is not None:
+                    timer.watch(d)
+                return _instrumented(self, proxyFac, d)
+        proxyFac = SOCKS5ClientFactory(
+            host, self.port, fac, self.methods, parser=self.parser,
+            optimistic=self.optimistic, earlyData=self.earlyData)
+        proxyFac.frames = self._handshakeFrames(host)
+        # Every tunnel from this endpoint shares one method table, which is
+        # never modified.
+        proxyFac.methods = proxyFac.frames.methodTable
+        _instrument(self, proxyFac, [('connect', _now())])
+        d = _connectThroughProxy(self.proxyEndpoint, proxyFac, timer)
+        return _instrumented(self, proxyFac, d)
 
 
 class SOCKS4Sender(object):
+    __slots__ = ('transport',)
+
     def __init__(self, transport):
         self.transport = transport
 
-    def sendRequest(self, host, port, user):
+    def packRequest(self, host, port, user):
         data = struct.pack('!BBH', c.VER_SOCKS4, c.CMD_CONNECT, port)
         try:
             host = socket.inet_pton(socket.AF_INET, host)
@@ -257,26 +840,35 @@ class SOCKS4Sender(object):
             host, suffix = '\0\0\0\1', host + '\0'
         else:
             suffix = ''
-        self.transport.write(data + host + user + '\0' + suffix)
+        return data + host + user + '\0' + suffix
 
+    def sendRequest(self, host, port, user):
+        self.transport.write(self.packRequest(host, port, user))
 
-class SOCKS4Receiver(_SOCKSReceiver):
-    otherProtocol = None
-    currentRule = 'SOCKS4ClientState_initial'
 
-    def __init__(self, sender):
-        self.sender = sender
+class SOCKS4Receiver(_SOCKSReceiver):
+    __slots__ = ()
+    initialRule = 'SOCKS4ClientState_initial'
 
     def prepareParsing(self, parser):
+        self.parserProtocol = parser
         self.factory = parser.factory
-        self.sender.sendRequest(self.factory.host, self.factory.port, self.factory.user)
+        self._watchParser(parser)
+        if self.factory.frames is not None:
+            self.sender.transport.write(self.factory.frames.request)
+        else:
+            self.sender.sendRequest(
+                self.factory.host, self.factory.port, self.factory.user)
+        self.factory.handshakePhase('request')
+        if self.factory.earlyData:
+            self._startEarlyData(buffering=False)
 
     def serverResponse(self, status, host, port):
         if status != c.SOCKS4_GRANTED:
             raise e.socks4ErrorMap.get(status)()
 
-        self.factory.proxyConnectionEstablished(self)
-        self.currentRule = 'SOCKSState_readData'
+        self._proxyGranted()
+        self._startRelaying()
 
 SOCKS4Client = makeProtocol(
     grammar.grammarSource,
@@ -284,18 +876,46 @@ SOCKS4Client = makeProtocol(
     SOCKS4Receiver,
     grammar.bindings)
 
+SOCKS4FastClient = makeFastProtocol(
+    SOCKS4Sender,
+    SOCKS4Receiver)
+
 class SOCKS4ClientFactory(_SOCKSClientFactory):
     protocol = SOCKS4Client
+    protocols = {
+        'fast': SOCKS4FastClient,
+        'grammar': SOCKS4Client,
+    }
 
-    def __init__(self, host, port, proxiedFactory, user=''):
+    def __init__(self, host, port, proxiedFactory, user='', parser=None,
+                 earlyData=False):
         validateSOCKS4aHost(host)
+        self._setParser(parser)
         self.host = host
         self.port = port
         self.user = user
+        self.earlyData = earlyData
         self.proxiedFactory = proxiedFactory
         self.deferred = defer.Deferred(self._cancel)
 
 
+class _SOCKS4Frames(object):
+    """What a SOCKS4 client sends to connect to *host* and *port* as *user*.
+
+    """
+
+    __slots__ = ('host', 'port', 'user', 'request')
+
+    def __init__(self, host, port, user):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.request = SOCKS4Sender(None).packRequest(host, port, user)
+
+    def matches(self, host, port, user):
+        return self.host == host and self.port == port and self.user == user
+
+
 @implementer(interfaces.IStreamClientEndpoint)
 class SOCKS4ClientEndpoint(object):
     """An endpoint which does SOCKS4 or SOCKS4a negotiation.
@@ -310,17 +930,72 @@ class SOCKS4ClientEndpoint(object):
     :param proxyEndpoint: The endpoint of the SOCKS4 server. This must provide
         `IStreamClientEndpoint`__.
     :param user: The user ID to send to the SOCKS4 server.
+    :param parser: Which parser to use for the server's replies.
+        ``'grammar'`` (the default) uses the Parsley grammar, which protocols
+        extending the grammar build on; ``'fast'`` uses the hand-written
+        parsers in ``txsocksx.parser``, which negotiate faster.
+    :param earlyData: If true, the provided factory's ``buildProtocol`` is
+        called as soon as the SOCKS4 request has been written, without waiting
+        for the server's reply. Anything the protocol writes is sent right
+        behind the request. If the server then rejects the request, the
+        protocol's ``connectionLost`` is called with the SOCKS error.
+    :param timeouts: A dict mapping handshake phases to the number of seconds
+        each may take. The phases are ``'connect'`` (connecting to the SOCKS4
+        server), ``'request'`` (waiting for the reply to the request) and
+        ``'total'`` (the whole negotiation). If a phase takes too long, the
+        negotiation is canceled and the ``Deferred`` returned by ``connect``
+        errbacks with ``txsocksx.errors.HandshakeTimeout``. As for
+        |SOCKS5ClientEndpoint|, only ``'connect'`` may be given with
+        *earlyData*.
+    :param reactor: The `IReactorTime`__ used for *timeouts*. Defaults to the
+        global reactor.
+    :param timingObserver: A callable which is called with the timings of each
+        negotiation, as for |SOCKS5ClientEndpoint|. The phases are
+        ``'connect'`` and ``'request'``.
+    :param metrics: A ``txsocksx.metrics.MetricsCollector``, as for
+        |SOCKS5ClientEndpoint|.
+    :param resolver: An `IResolverSimple`__ provider used to resolve *host*,
+        as for |SOCKS5ClientEndpoint|. This makes hostnames usable with SOCKS4
+        servers which don't support SOCKS4a. The host must resolve to an IPv4
+        address.
 
     __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamClientEndpoint.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IResolverSimple.html
 
     """
 
-    def __init__(self, host, port, proxyEndpoint, user=''):
+    def __init__(self, host, port, proxyEndpoint, user='', parser='grammar',
+                 earlyData=False, timeouts=None, reactor=None,
+                 timingObserver=None, metrics=None, resolver=None):
         validateSOCKS4aHost(host)
+        validateTimeouts(timeouts, earlyData)
+        if parser not in SOCKS4ClientFactory.protocols:
+            raise ValueError('unknown parser %r' % (parser,))
         self.host = host
         self.port = port
         self.proxyEndpoint = proxyEndpoint
         self.user = user
+        self.parser = parser
+        self.earlyData = earlyData
+        self.timeouts = timeouts
+        self.reactor = reactor
+        self.timingObserver = timingObserver
+        self.metrics = metrics
+        self.resolver = resolver
+        self._frames = None
+
+    def _handshakeFrames(self, host):
+        frames = self._frames
+        if frames is None or not frames.matches(host, self.port, self.user):
+            frames = self._frames = _SOCKS4Frames(host, self.port, self.user)
+        return frames
+
+    def _identity(self):
+        return ('socks4', self.proxyEndpoint, self.host, self.port, self.user)
+
+    def _proxyIdentity(self):
+        return ('socks4', self.proxyEndpoint, self.user)
 
     def connect(self, fac):
         """Connect over SOCKS4.
@@ -335,6 +1010,8 @@ class SOCKS4ClientEndpoint(object):
         2. If the SOCKS4 server gave a non-success response.
         3. If the SOCKS4 server did not reply with valid SOCKS4.
         4. If the ``Deferred`` returned from ``connect`` was cancelled.
+        5. If the negotiation took longer than *timeouts* allow.
+        6. If *resolver* couldn't resolve the host.
 
         The returned ``Deferred`` is cancelable during negotiation: the
         connection will immediately close and the ``Deferred`` will errback
@@ -347,7 +1024,26 @@ class SOCKS4ClientEndpoint(object):
 
         """
 
-        proxyFac = SOCKS4ClientFactory(self.host, self.port, fac, self.user)
-        d = self.proxyEndpoint.connect(proxyFac)
-        d.addCallback(lambda proto: proxyFac.deferred)
-        return d
+        if self.resolver is not None and not _isIPAddress(self.host):
+            d = self.resolver.getHostByName(self.host)
+            d.addCallback(self._checkIPv4)
+            return d.addCallback(self._connect, fac)
+        return self._connect(self.host, fac)
+
+    def _checkIPv4(self, address):
+        try:
+            socket.inet_pton(socket.AF_INET, address)
+        except socket.error:
+            raise error.DNSLookupError(
+                '%s: no IPv4 address (got %s)' % (self.host, address))
+        return address
+
+    def _connect(self, host, fac):
+        proxyFac = SOCKS4ClientFactory(
+            host, self.port, fac, self.user, parser=self.parser,
+            earlyData=self.earlyData)
+        proxyFac.frames = self._handshakeFrames(host)
+        timer = _makeTimer(self.reactor, self.timeouts)
+        _instrument(self, proxyFac, [('connect', _now())])
+        d = _connectThroughProxy(self.proxyEndpoint, proxyFac, timer)
+        return _instrumented(self, proxyFac, d)
@@ -5,6 +5,8 @@ VER_SOCKS4, VER_SOCKS5 = 4, 5
 AUTH_ANONYMOUS, AUTH_LOGIN = '\x00', '\x02'
 ATYP_IPV4, ATYP_DOMAINNAME, ATYP_IPV6 = 1, 3, 4
 CMD_CONNECT, CMD_BIND, CMD_UDP_ASSOCIATE = 1, 2, 3
+# Tor's extensions; see socks-extensions.txt in the Tor specifications.
+CMD_TOR_RESOLVE, CMD_TOR_RESOLVE_PTR = 0xf0, 0xf1
 NO_ACCEPTABLE_METHODS = 255
 RSV = 0
 
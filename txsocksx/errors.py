@@ -118,3 +118,15 @@ socks4ErrorMap = {
     c.SOCKS4_IDENTD_UNREACHABLE: IdentdUnreachable,
     c.SOCKS4_IDENTD_MISMATCH: IdentdMismatch,
 }
+
+
+class HandshakeTimeout(SOCKSError):
+    """
+    The SOCKS negotiation did not finish in time. The ``phase`` attribute names
+    the phase which stalled: ``'connect'``, ``'auth'``, ``'request'`` or
+    ``'total'``.
+    """
+
+    def __init__(self, phase):
+        SOCKSError.__init__(self, 'timed out in the %s phase' % (phase,))
+        self.phase = phase
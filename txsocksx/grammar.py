@@ -28,7 +28,11 @@ SOCKS4ServerState_initial = SOCKS4Request:request -> receiver.clientRequest(*req
 SOCKS4ClientState_initial = SOCKS4Response:response -> receiver.serverResponse(*response)
 
 
-SOCKS5Command = (SOCKS4Command | '\x03' -> 'udp-associate')
+SOCKS5Command = ( SOCKS4Command
+                | '\x03' -> 'udp-associate'
+                | '\xf0' -> 'tor-resolve'
+                | '\xf1' -> 'tor-resolve-ptr'
+                )
 SOCKS5Hostname = byte:length <anything{length}>:host -> host
 SOCKS5Address = ( '\x01' ipv4Address:address -> address
                 | '\x03' SOCKS5Hostname:host -> host
@@ -49,6 +53,7 @@ SOCKS5ServerState_readRequest = SOCKS5ClientRequest:request -> receiver.clientRe
 SOCKS5ClientState_initial = SOCKS5ServerAuthSelection:selection -> receiver.authSelected(selection)
 SOCKS5ClientState_readLoginResponse = SOCKS5ServerLoginResponse:response -> receiver.loginResponse(response)
 SOCKS5ClientState_readResponse = SOCKS5ServerResponse:response -> receiver.serverResponse(*response)
+SOCKS5ClientState_awaitingRequest = ~anything
 
 
 SOCKSState_readData = anything:data -> receiver.dataReceived(data)
@@ -9,9 +9,12 @@ This requires Twisted 12.1 or greater to use.
 
 
 import twisted
+from twisted.internet import defer
+from twisted.python import failure
 from twisted.python.versions import Version
 from twisted.web.client import Agent, SchemeNotSupported
 
+from txsocksx._cache import _ExpiringLRUCache
 from txsocksx.client import SOCKS4ClientEndpoint, SOCKS5ClientEndpoint
 from txsocksx.tls import TLSWrapClientEndpoint
 
@@ -19,6 +22,13 @@ from txsocksx.tls import TLSWrapClientEndpoint
 _twisted_12_1 = Version('twisted', 12, 1, 0)
 _twisted_14_0 = Version('twisted', 14, 0, 0)
 _twisted_15_0 = Version('twisted', 15, 0, 0)
+_twisted_21_0 = Version('twisted', 21, 0, 0)
+
+# SOCKSHTTPConnectionPool builds on HTTPConnectionPool's private
+# _newConnection, _putConnection, _removeConnection, _connections and
+# _timeouts, which it's tested against from Twisted 12.1 up to 20.3, the last
+# release for Python 2.
+_poolSupported = _twisted_12_1 <= twisted.version < _twisted_21_0
 
 
 if twisted.version >= _twisted_15_0:
@@ -46,6 +56,212 @@ if twisted.version >= _twisted_15_0:
             return self._getEndpoint(uri.scheme, uri.host, uri.port)
 
 
+def _proxyIdentity(endpoint):
+    # Look through wrapping endpoints, such as TLSWrapClientEndpoint, for the
+    # SOCKS endpoint.
+    while endpoint is not None:
+        if hasattr(endpoint, '_proxyIdentity'):
+            return endpoint._proxyIdentity()
+        endpoint = getattr(endpoint, 'wrappedEndpoint', None)
+    return None
+
+
+class _LossWatchingEndpoint(object):
+    # Tells the pool about each connection it makes, and when it's lost. The
+    # protocol's connectionLost is replaced as soon as it's built, since a
+    # SOCKS tunnel looks it up when it hands the connection over.
+
+    def __init__(self, endpoint, connectionMade, connectionLost):
+        self.endpoint = endpoint
+        self.connectionMade = connectionMade
+        self.connectionLost = connectionLost
+
+    def __repr__(self):
+        return repr(self.endpoint)
+
+    def connect(self, fac):
+        buildProtocol = fac.buildProtocol
+
+        def build(addr):
+            proto = buildProtocol(addr)
+            if proto is not None:
+                self._watch(proto)
+            return proto
+
+        fac.buildProtocol = build
+        return self.endpoint.connect(fac)
+
+    def _watch(self, proto):
+        connectionLost = proto.connectionLost
+
+        def lost(reason):
+            try:
+                return connectionLost(reason)
+            finally:
+                self.connectionLost(proto)
+
+        proto.connectionLost = lost
+        self.connectionMade(proto)
+
+
+if _poolSupported:
+    from twisted.web.client import HTTPConnectionPool
+
+    class SOCKSHTTPConnectionPool(HTTPConnectionPool):
+        """A pool of persistent HTTP connections made through SOCKS proxies.
+
+        `HTTPConnectionPool`__ keys connections on the scheme, host and port
+        alone, so an agent sharing it could be handed a connection made
+        through another proxy, or with other credentials (for example,
+        another Tor isolation username). This pool also keys connections on
+        the proxy endpoint and the authentication details.
+
+        :param reactor: An `IReactorTime`__ provider, used for idle timeouts.
+        :param persistent: Whether connections are kept for reuse at all.
+        :param maxPersistentPerHost: The number of idle connections to keep for
+            each destination through each proxy.
+        :param maxPersistentPerProxy: The number of idle connections to keep
+            through each proxy, across every destination, or ``None`` for no
+            limit. When there are more, the connections idle the longest are
+            closed first.
+        :param cachedConnectionTimeout: The number of seconds after which an
+            idle connection is closed.
+        :param maxConnectionsPerHost: The number of connections to open at
+            once to each destination through each proxy, or ``None`` for no
+            limit. Requests beyond it wait for a connection to become free and
+            reuse it, instead of each starting a SOCKS handshake; a burst of
+            requests to one host then costs at most this many handshakes. If
+            a connection can't be made, the requests waiting for it fail the
+            same way. This requires *persistent* connections.
+
+        The ``coalesced`` attribute counts the requests which had to wait, and
+        ``sharedFailures`` counts those which failed without a connection
+        attempt of their own.
+
+        This is only available on Twisted 12.1 to 20.3, since it extends
+        private parts of ``HTTPConnectionPool``.
+
+        __ http://twistedmatrix.com/documents/current/api/twisted.web.client.HTTPConnectionPool.html
+        __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+        """
+
+        coalesced = sharedFailures = 0
+
+        def __init__(self, reactor, persistent=True, maxPersistentPerHost=2,
+                     maxPersistentPerProxy=None, cachedConnectionTimeout=240,
+                     maxConnectionsPerHost=None):
+            if maxConnectionsPerHost is not None:
+                if maxConnectionsPerHost < 1:
+                    raise ValueError(
+                        'maxConnectionsPerHost must be at least 1')
+                if not persistent:
+                    raise ValueError(
+                        'maxConnectionsPerHost requires persistent '
+                        'connections')
+            HTTPConnectionPool.__init__(self, reactor, persistent)
+            self.maxPersistentPerHost = maxPersistentPerHost
+            self.maxPersistentPerProxy = maxPersistentPerProxy
+            self.cachedConnectionTimeout = cachedConnectionTimeout
+            self.maxConnectionsPerHost = maxConnectionsPerHost
+            self._connecting = {}
+            self._live = {}
+            self._waiting = {}
+
+        def getConnection(self, key, endpoint):
+            key = tuple(key) + (_proxyIdentity(endpoint),)
+            if self.maxConnectionsPerHost is None or self._free(key):
+                return HTTPConnectionPool.getConnection(self, key, endpoint)
+            self.coalesced += 1
+            queued = [None, endpoint, None]
+
+            def cancel(waiter):
+                if queued[2] is not None:
+                    queued[2].cancel()
+                else:
+                    self._waiting[key].remove(queued)
+                    if not self._waiting[key]:
+                        del self._waiting[key]
+
+            queued[0] = defer.Deferred(cancel)
+            self._waiting.setdefault(key, []).append(queued)
+            return queued[0]
+
+        def _free(self, key):
+            idle = self._connections.get(key, ())
+            if idle:
+                return True
+            inUse = self._connecting.get(key, 0) + len(self._live.get(key, ()))
+            return inUse < self.maxConnectionsPerHost
+
+        def _serveWaiting(self, key):
+            waiting = self._waiting.get(key)
+            while waiting and self._free(key):
+                queued = waiting.pop(0)
+                waiter, endpoint, ign = queued
+                queued[2] = d = HTTPConnectionPool.getConnection(
+                    self, key, endpoint)
+                d.chainDeferred(waiter)
+            if not waiting:
+                self._waiting.pop(key, None)
+
+        def _newConnection(self, key, endpoint):
+            if self.maxConnectionsPerHost is None:
+                return HTTPConnectionPool._newConnection(self, key, endpoint)
+            self._connecting[key] = self._connecting.get(key, 0) + 1
+            watching = _LossWatchingEndpoint(
+                endpoint,
+                lambda connection: self._live.setdefault(key, set()).add(
+                    connection),
+                lambda connection: self._connectionLost(key, connection))
+            d = HTTPConnectionPool._newConnection(self, key, watching)
+            d.addBoth(self._connected, key)
+            return d
+
+        def _connectionLost(self, key, connection):
+            live = self._live.get(key, set())
+            live.discard(connection)
+            if not live:
+                self._live.pop(key, None)
+            self._serveWaiting(key)
+
+        def _connected(self, result, key):
+            self._connecting[key] -= 1
+            if not self._connecting[key]:
+                del self._connecting[key]
+            if not isinstance(result, failure.Failure):
+                return result
+            if result.check(defer.CancelledError):
+                self._serveWaiting(key)
+            else:
+                waiting = self._waiting.pop(key, [])
+                self.sharedFailures += len(waiting)
+                for waiter, endpoint, ign in waiting:
+                    waiter.errback(result)
+            return result
+
+        def _putConnection(self, key, connection):
+            HTTPConnectionPool._putConnection(self, key, connection)
+            if self._waiting.get(key):
+                # The connection is still finishing its last response.
+                self._reactor.callLater(0, self._serveWaiting, key)
+            if self.maxPersistentPerProxy is None:
+                return
+            proxy = key[-1]
+            cached = [
+                (self._timeouts[c].getTime(), k, c)
+                for k, connections in self._connections.iteritems()
+                if k[-1] == proxy
+                for c in connections]
+            excess = len(cached) - self.maxPersistentPerProxy
+            if excess <= 0:
+                return
+            cached.sort(key=lambda entry: entry[0])
+            for expires, k, c in cached[:excess]:
+                self._timeouts[c].cancel()
+                self._removeConnection(k, c)
+
+
 class _SOCKSAgent(Agent):
     endpointFactory = None
     _tlsWrapper = TLSWrapClientEndpoint
@@ -55,23 +271,75 @@ class _SOCKSAgent(Agent):
             raise NotImplementedError('txsocksx.http requires twisted 12.1 or greater')
         self.proxyEndpoint = kw.pop('proxyEndpoint')
         self.endpointArgs = kw.pop('endpointArgs', {})
+        self.connector = kw.pop('connector', None)
+        self.tlsSessionCache = kw.pop('tlsSessionCache', None)
+        self.metrics = kw.pop('metrics', None)
+        self._tlsPolicies = _ExpiringLRUCache(
+            kw.pop('tlsPolicyCacheSize', 128), None)
+        if len(a) < 5 and kw.get('pool') is None and _poolSupported:
+            # Agent would make an HTTPConnectionPool, which doesn't tell
+            # connections through different proxies apart.
+            if a:
+                reactor = a[0]
+            else:
+                reactor = kw.get('reactor')
+            kw['pool'] = SOCKSHTTPConnectionPool(reactor, persistent=False)
         super(_SOCKSAgent, self).__init__(*a, **kw)
 
     def _getEndpoint(self, scheme, host, port):
         if scheme not in ('http', 'https'):
             raise SchemeNotSupported('unsupported scheme', scheme)
+        endpointArgs = self.endpointArgs
+        tlsArgs = {}
+        if self.metrics is not None:
+            endpointArgs = dict(endpointArgs, metrics=self.metrics)
+            tlsArgs['metrics'] = self.metrics
         endpoint = self.endpointFactory(
-            host, port, self.proxyEndpoint, **self.endpointArgs)
+            host, port, self.proxyEndpoint, **endpointArgs)
+        if self.connector is not None:
+            endpoint = self.connector.endpointFor(endpoint)
         if scheme == 'https':
-            if _twisted_12_1 <= twisted.version < _twisted_14_0:
-                tlsPolicy = self._wrapContextFactory(host, port)
-            elif _twisted_14_0 <= twisted.version:
-                tlsPolicy = self._policyForHTTPS.creatorForNetloc(host, port)
+            tlsPolicy = self._tlsPolicyFor(host, port)
+            if self.tlsSessionCache is None:
+                endpoint = self._tlsWrapper(tlsPolicy, endpoint, **tlsArgs)
             else:
-                raise NotImplementedError("can't figure out how to make a context factory")
-            endpoint = self._tlsWrapper(tlsPolicy, endpoint)
+                # A resumed session links the connections to the server, so
+                # don't resume across proxies or credentials.
+                sessionKey = host, port, _proxyIdentity(endpoint)
+                endpoint = self._tlsWrapper(
+                    tlsPolicy, endpoint, self.tlsSessionCache, sessionKey,
+                    **tlsArgs)
         return endpoint
 
+    def _tlsPolicyFor(self, host, port):
+        # Building a policy means building an OpenSSL context and loading the
+        # trust roots into it, and the result can be used for any number of
+        # connections, so it's only done once per netloc.
+        tlsPolicy = self._tlsPolicies.get((host, port))
+        if tlsPolicy is not None:
+            return tlsPolicy
+        if _twisted_12_1 <= twisted.version < _twisted_14_0:
+            tlsPolicy = self._wrapContextFactory(host, port)
+        elif _twisted_14_0 <= twisted.version:
+            tlsPolicy = self._policyForHTTPS.creatorForNetloc(host, port)
+        else:
+            raise NotImplementedError("can't figure out how to make a context factory")
+        self._tlsPolicies.set((host, port), tlsPolicy)
+        return tlsPolicy
+
+    def invalidateTLSPolicies(self, host=None, port=None):
+        """Forget the cached TLS configuration for *host* and *port*, or for
+        every netloc if neither is given.
+
+        Call this after changing the agent's HTTPS policy or the trust roots
+        it uses.
+
+        """
+        if host is None and port is None:
+            self._tlsPolicies.clear()
+        else:
+            self._tlsPolicies.invalidate((host, port))
+
 class SOCKS4Agent(_SOCKSAgent):
     """An `Agent`__ which connects over SOCKS4.
 
@@ -93,6 +361,27 @@ class SOCKS5Agent(_SOCKSAgent):
     :param endpointArgs: A dict of keyword arguments which will be passed when
         constructing the |SOCKS5ClientEndpoint|. For example, this could be
         ``{'methods': {'anonymous': ()}}``.
+    :param pool: As for ``Agent``. When the pool is persistent, use a
+        ``SOCKSHTTPConnectionPool``, particularly if it's shared with other
+        agents, so that connections made through different proxies or with
+        different credentials are never mixed up. Without one, the agent makes
+        a non-persistent ``SOCKSHTTPConnectionPool`` (on Twisted 12.1 to
+        20.3) or ``HTTPConnectionPool``.
+    :param connector: An object whose ``endpointFor`` method wraps each
+        |SOCKS5ClientEndpoint| before it's used, such as a
+        ``txsocksx.pool.SOCKSConnectionPool``.
+
+    :param tlsSessionCache: A ``txsocksx.tls.TLSSessionCache``. If given,
+        HTTPS connections resume TLS sessions from earlier connections to the
+        same host and port through the same proxy with the same credentials.
+
+    :param tlsPolicyCacheSize: The number of netlocs whose TLS configuration
+        (from the agent's HTTPS policy) is kept for later requests. Use
+        ``invalidateTLSPolicies`` to forget them.
+
+    :param metrics: A ``txsocksx.metrics.MetricsCollector`` which the
+        |SOCKS5ClientEndpoint| and, for HTTPS, the ``TLSWrapClientEndpoint`` of
+        each connection report into.
 
     The rest of the parameters, methods, and overall behavior is identical to
     `Agent`__. The ``connectTimeout`` and ``bindAddress`` arguments will be
@@ -0,0 +1,173 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Counters and histograms of SOCKS connections, for monitoring.
+
+"""
+
+
+from bisect import bisect_left
+
+from twisted.internet import defer, error
+from twisted.python import failure
+
+import txsocksx.errors as e
+
+
+defaultLatencyBuckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_failureLabels = dict(
+    (cls, cls.__name__)
+    for cls in e.socks5ErrorMap.values() + e.socks4ErrorMap.values() + [
+        e.MethodsNotAcceptedError, e.LoginAuthenticationFailed,
+        e.HandshakeTimeout, defer.CancelledError])
+
+failureReasons = tuple(sorted(_failureLabels.values())) + (
+    'ConnectError', 'other')
+
+
+def _failureLabel(reason):
+    label = _failureLabels.get(reason.type)
+    if label is not None:
+        return label
+    elif reason.check(error.ConnectError):
+        return 'ConnectError'
+    return 'other'
+
+
+class Histogram(object):
+    """Counts of observed values, by the smallest of *buckets* they fit in.
+
+    ``counts`` has one entry per bucket, plus one for values larger than the
+    largest bucket; ``sum`` and ``count`` are the sum and number of every value
+    observed.
+
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsCollector(object):
+    """Statistics reported by the endpoints and agents given it as *metrics*.
+
+    Every counter is allocated up front, so reporting a connection only
+    increments integers.
+
+    :param latencyBuckets: The upper bounds, in seconds, of the buckets of
+        ``handshakeLatency``.
+
+    The counters are:
+
+    - ``connectsAttempted``, ``connectsSucceeded`` and ``connectsFailed``: SOCKS
+      negotiations started, and those which ended with a tunnel or a failure.
+    - ``failures``: failed negotiations by reason. For replies from the
+      server, this is the name of the exception the reply code maps to in
+      ``txsocksx.errors``, such as ``'HostUnreachable'``; it's
+      ``'ConnectError'`` when the proxy couldn't be reached at all, and
+      ``'other'`` for anything not in `failureReasons`.
+    - ``handshakeLatency``: a `Histogram` of the seconds successful
+      negotiations took.
+    - ``openTunnels``: tunnels which haven't closed yet.
+    - ``bytesSent`` and ``bytesReceived``: bytes relayed through tunnels.
+    - ``tlsConnectsAttempted`` and ``tlsConnectsFailed``: connections made by
+      ``TLSWrapClientEndpoint``\ s, counted once the wrapped endpoint has
+      connected or failed, and those which failed.
+
+    """
+
+    connectsAttempted = connectsSucceeded = connectsFailed = 0
+    openTunnels = 0
+    bytesSent = bytesReceived = 0
+    tlsConnectsAttempted = tlsConnectsFailed = 0
+
+    def __init__(self, latencyBuckets=defaultLatencyBuckets):
+        self.failures = dict.fromkeys(failureReasons, 0)
+        self.handshakeLatency = Histogram(latencyBuckets)
+
+    def handshakeStarted(self):
+        self.connectsAttempted += 1
+
+    def handshakeFinished(self, result, duration):
+        if isinstance(result, failure.Failure):
+            self.connectsFailed += 1
+            self.failures[_failureLabel(result)] += 1
+        else:
+            self.connectsSucceeded += 1
+            self.handshakeLatency.observe(duration)
+        return result
+
+    def tunnelOpened(self):
+        self.openTunnels += 1
+
+    def tunnelClosed(self):
+        self.openTunnels -= 1
+
+    def tlsConnectFinished(self, result):
+        self.tlsConnectsAttempted += 1
+        if isinstance(result, failure.Failure):
+            self.tlsConnectsFailed += 1
+        return result
+
+    def exposition(self, prefix='txsocksx'):
+        """Return the statistics in the Prometheus text exposition format.
+
+        Each metric's name starts with *prefix*.
+
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            name = prefix + '_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s%s %s' % (name, suffix, labels, value))
+
+        def single(name, kind, help, value):
+            metric(name, kind, help, [('', '', value)])
+
+        single('connects_attempted_total', 'counter',
+               'SOCKS negotiations started.', self.connectsAttempted)
+        single('connects_succeeded_total', 'counter',
+               'SOCKS negotiations which opened a tunnel.',
+               self.connectsSucceeded)
+        metric('connect_failures_total', 'counter',
+               'SOCKS negotiations which failed, by reason.', [
+                   ('', '{reason="%s"}' % (reason,), self.failures[reason])
+                   for reason in failureReasons])
+        histogram = self.handshakeLatency
+        samples = []
+        cumulative = 0
+        for bound, count in zip(
+                histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            if bound != '+Inf':
+                bound = repr(float(bound))
+            samples.append(('_bucket', '{le="%s"}' % (bound,), cumulative))
+        samples.append(('_sum', '', repr(float(histogram.sum))))
+        samples.append(('_count', '', histogram.count))
+        metric('handshake_seconds', 'histogram',
+               'Time taken by successful SOCKS negotiations.', samples)
+        single('open_tunnels', 'gauge', 'Tunnels currently open.',
+               self.openTunnels)
+        single('sent_bytes_total', 'counter',
+               'Bytes sent through tunnels.', self.bytesSent)
+        single('received_bytes_total', 'counter',
+               'Bytes received through tunnels.', self.bytesReceived)
+        single('tls_connects_attempted_total', 'counter',
+               'Connections started by TLS-wrapping endpoints.',
+               self.tlsConnectsAttempted)
+        single('tls_connects_failed_total', 'counter',
+               'Connections by TLS-wrapping endpoints which failed.',
+               self.tlsConnectsFailed)
+        return '\n'.join(lines) + '\n'
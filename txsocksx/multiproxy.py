@@ -0,0 +1,274 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Endpoints which spread connections over several SOCKS servers.
+
+"""
+
+
+from twisted.internet import defer, interfaces, protocol
+from twisted.python import failure
+from zope.interface import implementer
+
+from txsocksx.client import SOCKS5ClientEndpoint
+
+
+class _FirstOnlyFactory(protocol.ClientFactory):
+    """Only lets the first negotiation to finish build a protocol.
+
+    Any later negotiation gets ``None`` from ``buildProtocol``, which makes
+    its connection close immediately.
+
+    """
+
+    built = False
+
+    def __init__(self, wrappedFactory):
+        self.wrappedFactory = wrappedFactory
+
+    def buildProtocol(self, addr):
+        if self.built:
+            return None
+        self.built = True
+        return self.wrappedFactory.buildProtocol(addr)
+
+
+class _Race(object):
+    def __init__(self, endpoints, fac, reactor, delay):
+        self.endpoints = list(endpoints)
+        self.fac = _FirstOnlyFactory(fac)
+        self.reactor = reactor
+        self.delay = delay
+        self.attempts = []
+        self.nextAttempt = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def start(self):
+        self._startNext()
+        return self.deferred
+
+    def _startNext(self):
+        if self.nextAttempt is not None and self.nextAttempt.active():
+            self.nextAttempt.cancel()
+        self.nextAttempt = None
+        if not self.endpoints or self.deferred.called:
+            return
+        endpoint = self.endpoints.pop(0)
+        d = endpoint.connect(self.fac)
+        self.attempts.append(d)
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(d,), errbackArgs=(d,))
+        if self.endpoints and not self.deferred.called:
+            self.nextAttempt = self.reactor.callLater(
+                self.delay, self._startNext)
+
+    def _succeeded(self, proto, d):
+        self.attempts.remove(d)
+        if self.deferred.called:
+            return
+        self.deferred.callback(proto)
+        self._stop()
+
+    def _failed(self, reason, d):
+        self.attempts.remove(d)
+        if self.deferred.called:
+            return
+        if self.endpoints:
+            self._startNext()
+        elif not self.attempts:
+            self.deferred.errback(reason)
+
+    def _stop(self):
+        if self.nextAttempt is not None and self.nextAttempt.active():
+            self.nextAttempt.cancel()
+        self.endpoints = []
+        for d in list(self.attempts):
+            d.cancel()
+
+    def _cancel(self, d):
+        self._stop()
+
+
+@implementer(interfaces.IStreamClientEndpoint)
+class RacingSOCKSClientEndpoint(object):
+    """An endpoint which races negotiations through several SOCKS servers.
+
+    Negotiations are started one at a time, *delay* seconds apart, in the order
+    of *proxyEndpoints*, as in RFC 8305. If one fails, the next starts
+    immediately. The first one to be granted is used and the rest are
+    canceled.
+
+    :param host: The hostname to connect to through the SOCKS servers.
+    :param port: The port to connect to through the SOCKS servers.
+    :param proxyEndpoints: A list of endpoints of SOCKS servers.
+    :param endpointFactory: The endpoint class to use for each SOCKS server.
+        Defaults to |SOCKS5ClientEndpoint|.
+    :param endpointArgs: A dict of keyword arguments which will be passed when
+        constructing each endpoint.
+    :param delay: The number of seconds to wait for a negotiation before
+        starting the next.
+    :param reactor: The `IReactorTime`__ used to stagger the negotiations.
+        Defaults to the global reactor.
+
+    If every negotiation fails, the ``Deferred`` returned by ``connect``
+    errbacks with the last failure. Canceling it cancels every outstanding
+    negotiation.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    def __init__(self, host, port, proxyEndpoints,
+                 endpointFactory=SOCKS5ClientEndpoint, endpointArgs={},
+                 delay=0.25, reactor=None):
+        if not proxyEndpoints:
+            raise ValueError('no proxy endpoints were specified')
+        if reactor is None:
+            from twisted.internet import reactor
+        self.endpoints = [
+            endpointFactory(host, port, proxyEndpoint, **endpointArgs)
+            for proxyEndpoint in proxyEndpoints]
+        self.delay = delay
+        self.reactor = reactor
+
+    def connect(self, fac):
+        return _Race(self.endpoints, fac, self.reactor, self.delay).start()
+
+
+class _ProxyState(object):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.retryAt = None
+        self.probing = False
+
+    def available(self, now):
+        if self.retryAt is None:
+            return True
+        return now >= self.retryAt and not self.probing
+
+
+@implementer(interfaces.IStreamClientEndpoint)
+class ProxyPool(object):
+    """An endpoint which spreads connections over several SOCKS servers.
+
+    Use this as the *proxyEndpoint* of a |SOCKS5ClientEndpoint|,
+    ``SOCKS4ClientEndpoint`` or |SOCKS5Agent|. Each connection goes to the
+    SOCKS server chosen by *strategy*:
+
+    ``'least-outstanding'``
+        The server with the fewest negotiations in progress.
+    ``'ewma'``
+        The server with the lowest exponentially weighted moving average of
+        negotiation time, scaled by its negotiations in progress. Servers with
+        no measurements yet are tried first.
+
+    After *maxFailures* consecutive failures (a connection error, a handshake
+    timeout or any error reply from the SOCKS server), a server is marked
+    unhealthy and skipped for *retryAfter* seconds. After that, one
+    connection is let through as a probe: if it succeeds, the server is
+    healthy again; otherwise it is skipped for another *retryAfter* seconds.
+    If every server is unhealthy, they are all used anyway.
+
+    :param proxyEndpoints: A list of endpoints of SOCKS servers.
+    :param strategy: ``'least-outstanding'`` or ``'ewma'``.
+    :param maxFailures: The number of consecutive failures after which a
+        server is marked unhealthy.
+    :param retryAfter: The number of seconds to skip an unhealthy server for.
+    :param decay: The weight of each new measurement in the moving average.
+    :param reactor: The `IReactorTime`__ used to measure negotiation time and
+        health. Defaults to the global reactor.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    strategies = frozenset(['least-outstanding', 'ewma'])
+
+    def __init__(self, proxyEndpoints, strategy='least-outstanding',
+                 maxFailures=3, retryAfter=30, decay=0.3, reactor=None):
+        if not proxyEndpoints:
+            raise ValueError('no proxy endpoints were specified')
+        if strategy not in self.strategies:
+            raise ValueError('unknown strategy %r' % (strategy,))
+        if reactor is None:
+            from twisted.internet import reactor
+        self.proxies = [_ProxyState(endpoint) for endpoint in proxyEndpoints]
+        self.strategy = strategy
+        self.maxFailures = maxFailures
+        self.retryAfter = retryAfter
+        self.decay = decay
+        self.reactor = reactor
+
+    def healthy(self, proxyEndpoint):
+        """Return whether *proxyEndpoint* is currently considered healthy.
+
+        """
+        for state in self.proxies:
+            if state.endpoint is proxyEndpoint:
+                return state.retryAt is None
+        raise KeyError(proxyEndpoint)
+
+    def _weight(self, state):
+        if self.strategy == 'ewma':
+            return (state.latency or 0) * (state.outstanding + 1)
+        return state.outstanding
+
+    def _choose(self):
+        now = self.reactor.seconds()
+        candidates = [s for s in self.proxies if s.available(now)]
+        if not candidates:
+            candidates = self.proxies
+        state = min(candidates, key=self._weight)
+        if state.retryAt is not None:
+            state.probing = True
+        return state
+
+    def connect(self, fac):
+        """Connect *fac* through the chosen SOCKS server.
+
+        If *fac* is a SOCKS client factory, the outcome of its negotiation is
+        what's measured; otherwise only the connection is.
+
+        """
+        state = self._choose()
+        state.outstanding += 1
+        start = self.reactor.seconds()
+
+        def connected(proto):
+            negotiation = getattr(fac, 'deferred', None)
+            if negotiation is None:
+                self._finished(proto, state, start, fac)
+            else:
+                negotiation.addBoth(self._finished, state, start, fac)
+            return proto
+
+        d = state.endpoint.connect(fac)
+        d.addCallbacks(
+            connected, self._finished, errbackArgs=(state, start, fac))
+        return d
+
+    def _timedOut(self, fac):
+        timer = getattr(fac, 'timer', None)
+        return timer is not None and timer.timedOut is not None
+
+    def _finished(self, result, state, start, fac):
+        state.outstanding -= 1
+        state.probing = False
+        if not isinstance(result, failure.Failure):
+            elapsed = self.reactor.seconds() - start
+            if state.latency is None:
+                state.latency = elapsed
+            else:
+                state.latency += self.decay * (elapsed - state.latency)
+            state.failures = 0
+            state.retryAt = None
+        elif not result.check(defer.CancelledError) or self._timedOut(fac):
+            # Only cancellations by the caller don't count; the handshake
+            # timer cancels too, when the server stalls.
+            state.failures += 1
+            if state.failures >= self.maxFailures:
+                state.retryAt = self.reactor.seconds() + self.retryAfter
+        return result
@@ -0,0 +1,192 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Hand-written incremental parsers for the client side of the handshake.
+
+The rules in ``txsocksx.grammar`` remain the reference implementation. The
+parsers here accept and reject exactly the same server replies, but they work
+on whole buffers with ``struct`` instead of interpreting the grammar one byte
+at a time.
+
+"""
+
+
+import functools
+import socket
+import struct
+
+from twisted.internet import protocol
+from twisted.python import failure
+
+import txsocksx.errors as e
+
+
+_short = struct.Struct('!H')
+_socks4Response = struct.Struct('!xBH4s')
+
+_SOCKS5AddressLengths = {'\x01': 4, '\x04': 16}
+_SOCKS5AddressFamilies = {'\x01': socket.AF_INET, '\x04': socket.AF_INET6}
+
+
+def _mismatch(rule, data, pos):
+    raise e.ParsingError(
+        '%s: unexpected byte %r at offset %d' % (rule, data[pos], pos))
+
+
+def parseSOCKS4Response(data, pos):
+    """Parse ``SOCKS4Response``.
+
+    Returns ``None`` if more data is needed, or a tuple of the position after
+    the reply and the arguments for ``serverResponse``.
+
+    """
+    if len(data) > pos and data[pos] != '\x00':
+        _mismatch('SOCKS4Response', data, pos)
+    end = pos + 8
+    if len(data) < end:
+        return None
+    status, port, packed = _socks4Response.unpack_from(data, pos)
+    return end, (status, socket.inet_ntop(socket.AF_INET, packed), port)
+
+
+def parseSOCKS5ServerAuthSelection(data, pos):
+    """Parse ``SOCKS5ServerAuthSelection``."""
+    if len(data) > pos and data[pos] != '\x05':
+        _mismatch('SOCKS5ServerAuthSelection', data, pos)
+    end = pos + 2
+    if len(data) < end:
+        return None
+    return end, (data[pos + 1],)
+
+
+def parseSOCKS5ServerLoginResponse(data, pos):
+    """Parse ``SOCKS5ServerLoginResponse``."""
+    end = pos + 2
+    if len(data) < end:
+        return None
+    return end, (data[pos + 1] == '\x00',)
+
+
+def parseSOCKS5ServerResponse(data, pos):
+    """Parse ``SOCKS5ServerResponse``."""
+    available = len(data) - pos
+    if available > 0 and data[pos] != '\x05':
+        _mismatch('SOCKS5ServerResponse', data, pos)
+    if available > 2 and data[pos + 2] != '\x00':
+        _mismatch('SOCKS5ServerResponse', data, pos + 2)
+    if available < 4:
+        return None
+    addressType = data[pos + 3]
+    if addressType == '\x03':
+        if available < 5:
+            return None
+        addressStart = pos + 5
+        addressEnd = addressStart + ord(data[pos + 4])
+        if len(data) < addressEnd + 2:
+            return None
+        address = data[addressStart:addressEnd]
+    elif addressType in _SOCKS5AddressLengths:
+        addressStart = pos + 4
+        addressEnd = addressStart + _SOCKS5AddressLengths[addressType]
+        if len(data) < addressEnd + 2:
+            return None
+        address = socket.inet_ntop(
+            _SOCKS5AddressFamilies[addressType],
+            data[addressStart:addressEnd])
+    else:
+        _mismatch('SOCKS5ServerResponse', data, pos + 3)
+    port, = _short.unpack_from(data, addressEnd)
+    return addressEnd + 2, (ord(data[pos + 1]), address, port)
+
+
+def parseNothing(data, pos):
+    """Parse ``SOCKS5ClientState_awaitingRequest``, which accepts no data."""
+    if len(data) > pos:
+        _mismatch('SOCKS5ClientState_awaitingRequest', data, pos)
+    return None
+
+
+clientRules = {
+    'SOCKS4ClientState_initial': (parseSOCKS4Response, 'serverResponse'),
+    'SOCKS5ClientState_initial': (
+        parseSOCKS5ServerAuthSelection, 'authSelected'),
+    'SOCKS5ClientState_readLoginResponse': (
+        parseSOCKS5ServerLoginResponse, 'loginResponse'),
+    'SOCKS5ClientState_readResponse': (
+        parseSOCKS5ServerResponse, 'serverResponse'),
+    'SOCKS5ClientState_awaitingRequest': (parseNothing, None),
+}
+
+
+class FastParserProtocol(protocol.Protocol):
+    """A drop-in replacement for Parsley's ``ParserProtocol``.
+
+    Senders and receivers are used exactly as they are by ``ParserProtocol``:
+    the receiver's ``currentRule`` selects the parser for the next reply, and
+    the parsed values are passed to the same receiver method the grammar rule
+    would have called. ``SOCKSState_readData`` passes all remaining data
+    through to ``receiver.dataReceived`` unparsed.
+
+    """
+
+    def __init__(self, senderFactory, receiverFactory, rules):
+        self._senderFactory = senderFactory
+        self._receiverFactory = receiverFactory
+        self._rules = rules
+        self._buffer = ''
+        self._disconnecting = False
+
+    def connectionMade(self):
+        self.sender = self._senderFactory(self.transport)
+        self.receiver = self._receiverFactory(self.sender)
+        self.receiver.prepareParsing(self)
+
+    def dataReceived(self, data):
+        if self._disconnecting:
+            return
+
+        try:
+            self._parse(data)
+        except Exception:
+            self.connectionLost(failure.Failure())
+            self.transport.abortConnection()
+            return
+
+    def _parse(self, data):
+        if self._buffer:
+            data = self._buffer + data
+            self._buffer = ''
+        receiver = self.receiver
+        pos = 0
+        while pos < len(data):
+            rule = receiver.currentRule
+            if rule == 'SOCKSState_readData':
+                receiver.dataReceived(data[pos:] if pos else data)
+                return
+            try:
+                parse, action = self._rules[rule]
+            except KeyError:
+                raise e.ParsingError('no parser for rule %r' % (rule,))
+            result = parse(data, pos)
+            if result is None:
+                self._buffer = data[pos:]
+                return
+            pos, args = result
+            getattr(receiver, action)(*args)
+
+    def connectionLost(self, reason):
+        if self._disconnecting:
+            return
+        self.receiver.finishParsing(reason)
+        self._disconnecting = True
+
+
+def makeFastProtocol(senderFactory, receiverFactory, rules=clientRules):
+    """Create a protocol factory using the hand-written parsers.
+
+    This is the counterpart of ``parsley.makeProtocol``: it returns a nullary
+    callable which will return a `FastParserProtocol`.
+
+    """
+    return functools.partial(
+        FastParserProtocol, senderFactory, receiverFactory, rules)
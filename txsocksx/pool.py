@@ -0,0 +1,352 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""A pool of pre-negotiated SOCKS tunnels.
+
+"""
+
+
+from twisted.internet import defer, interfaces, protocol, task
+from twisted.python import log
+from zope.interface import implementer
+
+from txsocksx.client import SOCKS5ClientFactory
+
+
+class _WarmTunnel(protocol.Protocol):
+    """Holds a negotiated tunnel until it's handed out.
+
+    Anything the far end sends while the tunnel is idle is buffered and
+    delivered to the protocol the tunnel is eventually handed to.
+
+    """
+
+    wrappedProtocol = None
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.idleSince = None
+        self._buffer = []
+
+    def handOff(self, fac):
+        proto = fac.buildProtocol(self.transport.getPeer())
+        if proto is None:
+            self.transport.loseConnection()
+            return None
+        self.wrappedProtocol = proto
+        proto.makeConnection(self.transport)
+        if getattr(self.transport, 'protocol', None) is self:
+            self.transport.protocol = proto
+        buffered, self._buffer = self._buffer, None
+        if buffered:
+            proto.dataReceived(''.join(buffered))
+        return proto
+
+    def dataReceived(self, data):
+        if self.wrappedProtocol is None:
+            self._buffer.append(data)
+        else:
+            self.wrappedProtocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self.wrappedProtocol is None:
+            self.pool._tunnelLost(self)
+        else:
+            self.wrappedProtocol.connectionLost(reason)
+
+
+class _WarmTunnelFactory(protocol.ClientFactory):
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    def buildProtocol(self, addr):
+        return _WarmTunnel(self.pool, self.key)
+
+
+@implementer(interfaces.IStreamClientEndpoint)
+class _PooledEndpoint(object):
+    def __init__(self, pool, endpoint):
+        self.pool = pool
+        self.wrappedEndpoint = endpoint
+
+    def connect(self, fac):
+        return self.pool.connect(self.wrappedEndpoint, fac)
+
+
+class SOCKSConnectionPool(object):
+    """A pool of SOCKS tunnels which have already been negotiated.
+
+    Tunnels are keyed on the proxy endpoint, the destination host and port,
+    and the authentication details of a |SOCKS5ClientEndpoint| or
+    ``SOCKS4ClientEndpoint``. Up to *size* idle tunnels are kept for each key.
+
+    :param reactor: An `IReactorTime`__ provider used for idle eviction.
+    :param size: The number of idle tunnels to keep for each key.
+    :param idleTimeout: The number of seconds after which an idle tunnel is
+        closed.
+    :param evictionInterval: How often, in seconds, to look for idle tunnels
+        to close.
+
+    The ``hits`` and ``misses`` attributes count the calls to `connect` which
+    were and were not satisfied from the pool. ``evictions`` counts the idle
+    tunnels closed for being idle too long, and ``failures`` the tunnels
+    which couldn't be opened in the background.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    hits = misses = evictions = failures = 0
+    closed = False
+
+    def __init__(self, reactor, size=2, idleTimeout=60, evictionInterval=5):
+        self.reactor = reactor
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self._idle = {}
+        self._pending = {}
+        self._evictionCall = task.LoopingCall(self._evictIdle)
+        self._evictionCall.clock = reactor
+        self._evictionCall.start(evictionInterval, now=False)
+
+    def _key(self, endpoint):
+        return endpoint._identity()
+
+    def endpointFor(self, endpoint):
+        """Wrap a SOCKS endpoint so that its connections come from this pool.
+
+        :returns: An ``IStreamClientEndpoint`` whose ``connect`` calls
+            `connect` with *endpoint*.
+
+        """
+        return _PooledEndpoint(self, endpoint)
+
+    def connect(self, endpoint, fac):
+        """Connect *fac* through *endpoint*, using a pooled tunnel if possible.
+
+        If there is an idle tunnel for *endpoint*, the returned ``Deferred``
+        fires immediately with the protocol built by *fac*. Otherwise, this is
+        the same as ``endpoint.connect(fac)``. Either way, the pool then opens
+        enough tunnels in the background to have *size* idle tunnels ready.
+
+        """
+        key = self._key(endpoint)
+        idle = self._idle.get(key)
+        if idle:
+            self.hits += 1
+            tunnel = idle.pop()
+            self._replenish(key, endpoint)
+            proto = tunnel.handOff(fac)
+            if proto is None:
+                return defer.fail(defer.CancelledError())
+            return defer.succeed(proto)
+        self.misses += 1
+        d = endpoint.connect(fac)
+        self._replenish(key, endpoint)
+        return d
+
+    def prime(self, endpoint):
+        """Open tunnels for *endpoint* before the first call to `connect`.
+
+        """
+        self._replenish(self._key(endpoint), endpoint)
+
+    def _replenish(self, key, endpoint):
+        if self.closed:
+            return
+        wanted = (
+            self.size - len(self._idle.get(key, ()))
+            - len(self._pending.get(key, ())))
+        for x in xrange(wanted):
+            d = endpoint.connect(_WarmTunnelFactory(self, key))
+            self._pending.setdefault(key, []).append(d)
+            d.addBoth(self._tunnelFinished, key, d)
+
+    def _tunnelFinished(self, result, key, d):
+        pending = self._pending.get(key, [])
+        if d in pending:
+            pending.remove(d)
+            if not pending:
+                del self._pending[key]
+        if isinstance(result, _WarmTunnel):
+            if self.closed:
+                result.transport.loseConnection()
+                return
+            result.idleSince = self.reactor.seconds()
+            self._idle.setdefault(key, []).append(result)
+        elif not self.closed:
+            # Failures aren't retried here; the next connect will try again.
+            self.failures += 1
+            log.msg('failed to open a pooled SOCKS tunnel: %s' % (
+                result.getErrorMessage(),))
+
+    def _tunnelLost(self, tunnel):
+        idle = self._idle.get(tunnel.key)
+        if idle and tunnel in idle:
+            idle.remove(tunnel)
+            if not idle:
+                del self._idle[tunnel.key]
+
+    def _evictIdle(self):
+        deadline = self.reactor.seconds() - self.idleTimeout
+        for key, idle in self._idle.items():
+            expired = [t for t in idle if t.idleSince <= deadline]
+            for tunnel in expired:
+                idle.remove(tunnel)
+                self.evictions += 1
+                tunnel.transport.loseConnection()
+            if not idle:
+                del self._idle[key]
+
+    def close(self):
+        """Stop evicting, close every idle tunnel and stop opening new ones.
+
+        Tunnels still being negotiated are canceled. `connect` still works
+        afterwards, but no longer uses or refills the pool.
+
+        """
+        self.closed = True
+        if self._evictionCall.running:
+            self._evictionCall.stop()
+        idle, self._idle = self._idle, {}
+        for tunnels in idle.itervalues():
+            for tunnel in tunnels:
+                tunnel.transport.loseConnection()
+        pending, self._pending = self._pending, {}
+        for ds in pending.itervalues():
+            for d in ds:
+                d.cancel()
+
+
+class _PrewarmedSOCKS5ClientFactory(SOCKS5ClientFactory):
+    idle = False
+
+    def __init__(self, pool):
+        SOCKS5ClientFactory.__init__(
+            self, None, None, None, pool.methods, parser=pool.parser)
+        self.methods = pool._methodTable
+        self.pool = pool
+
+    def proxyAuthenticated(self, proxyProtocol):
+        self.idle = True
+        self.deferred.callback(self)
+
+    def proxyConnectionFailed(self, reason):
+        if self.idle:
+            self.idle = False
+            self.pool._connectionLost(self)
+        else:
+            SOCKS5ClientFactory.proxyConnectionFailed(self, reason)
+
+    def requestConnection(self, host, port, proxiedFactory):
+        self.idle = False
+        self.host = host
+        self.port = port
+        self.proxiedFactory = proxiedFactory
+        self.deferred = defer.Deferred(self._cancel)
+        self.currentCandidate.receiver._sendRequest()
+        return self.deferred
+
+
+class PrewarmedProxyConnections(object):
+    """Authenticated SOCKS5 connections waiting to be told where to connect.
+
+    Connecting to a SOCKS5 server, selecting an authentication method and
+    logging in don't depend on the destination, so they can be done ahead of
+    time. Pass this as *prewarmed* to a |SOCKS5ClientEndpoint| with the same
+    *proxyEndpoint* and *methods*, and its ``connect`` will only have to send
+    the request.
+
+    :param proxyEndpoint: The endpoint of the SOCKS5 server.
+    :param methods: The authentication methods to try, as for
+        |SOCKS5ClientEndpoint|.
+    :param size: The number of authenticated connections to keep ready.
+    :param parser: Which parser to use for the server's replies. Only
+        ``'fast'`` is supported: Parsley's parser can't be moved on to the
+        reply once it's waiting for the request to be sent.
+
+    Call `start` to open the first connections; a ready connection which is
+    lost is replaced. The ``hits`` and ``misses`` attributes count the
+    connects which did and did not find a connection ready.
+
+    """
+
+    hits = misses = 0
+    closed = False
+
+    def __init__(self, proxyEndpoint, methods={'anonymous': ()}, size=2,
+                 parser='fast'):
+        if parser != 'fast':
+            raise ValueError(
+                'prewarmed connections require the fast parser, not %r' % (
+                    parser,))
+        self.proxyEndpoint = proxyEndpoint
+        self.methods = methods
+        self._methodTable = SOCKS5ClientFactory._methodTable(methods)
+        self.size = size
+        self.parser = parser
+        self._idle = []
+        self._pending = []
+
+    def start(self):
+        """Open connections until *size* are ready or being negotiated.
+
+        """
+        if self.closed:
+            return
+        for x in xrange(self.size - len(self._idle) - len(self._pending)):
+            proxyFac = _PrewarmedSOCKS5ClientFactory(self)
+            d = self.proxyEndpoint.connect(proxyFac)
+            d.addCallback(lambda proto, proxyFac=proxyFac: proxyFac.deferred)
+            self._pending.append(d)
+            d.addBoth(self._connectionFinished, d)
+
+    def take(self):
+        """Take an authenticated connection, if one is ready.
+
+        :returns: An object with a ``requestConnection(host, port, fac)``
+            method which sends the request and returns a ``Deferred`` like
+            ``SOCKS5ClientEndpoint.connect`` does, or ``None`` if no
+            connection is ready.
+
+        """
+        if not self._idle:
+            self.misses += 1
+            self.start()
+            return None
+        self.hits += 1
+        proxyFac = self._idle.pop()
+        self.start()
+        return proxyFac
+
+    def _connectionFinished(self, result, d):
+        if d in self._pending:
+            self._pending.remove(d)
+        if not isinstance(result, _PrewarmedSOCKS5ClientFactory):
+            return
+        if self.closed:
+            result.currentCandidate.transport.loseConnection()
+        else:
+            self._idle.append(result)
+
+    def _connectionLost(self, proxyFac):
+        if proxyFac in self._idle:
+            self._idle.remove(proxyFac)
+            self.start()
+
+    def close(self):
+        """Close every connection, canceling those still being negotiated.
+
+        Nothing is opened afterwards.
+
+        """
+        self.closed = True
+        idle, self._idle = self._idle, []
+        for proxyFac in idle:
+            proxyFac.currentCandidate.transport.loseConnection()
+        pending, self._pending = self._pending, []
+        for d in pending:
+            d.cancel()
+
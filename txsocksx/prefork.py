@@ -0,0 +1,322 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Run a SOCKS server in several processes sharing one listening socket.
+
+One Twisted reactor only uses one core. `SOCKSServerWorkers` opens the
+listening socket, then starts worker processes which each adopt it with
+``adoptStreamPort`` and serve a ``txsocksx.server.SOCKSServerFactory``; the
+kernel spreads incoming clients over them.
+
+To run a server from the command line::
+
+  python -m txsocksx.prefork --port 1080 --workers 4
+
+It only listens on the loopback interface unless ``--interface`` or
+``--all-interfaces`` is given.
+
+"""
+
+
+import json
+import os
+import socket
+import sys
+
+from twisted.internet import defer, protocol, stdio, task
+from twisted.internet.abstract import isIPv6Address
+from twisted.python import log, usage
+
+import txsocksx
+from txsocksx.server import SOCKSServerFactory
+
+
+statsCounters = ('openTunnels', 'totalTunnels', 'refusedTunnels')
+
+# Computed on import, in case the working directory changes later.
+_packageParent = os.path.dirname(os.path.dirname(os.path.abspath(
+    txsocksx.__file__)))
+
+
+def _cpuCount():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    """The parent's view of one worker.
+
+    Workers report their stats as one JSON object per line on stdout.
+
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.stats = {}
+        self.ended = defer.Deferred()
+        self._buffer = ''
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            try:
+                self.stats = json.loads(line)
+            except ValueError:
+                log.msg('bad stats line from worker: %r' % (line,))
+
+    def processEnded(self, reason):
+        self.workers._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class SOCKSServerWorkers(object):
+    """A SOCKS server running in several worker processes.
+
+    :param port: The port to listen on. If it's 0, the port chosen by the
+        kernel is available from `getPort` after `start`.
+    :param interface: The address to listen on. The server relays to any
+        destination without authentication, so by default it only listens on
+        the loopback interface; pass ``''`` to listen on every interface.
+    :param workers: The number of worker processes. Defaults to the number of
+        CPUs.
+    :param serverArgs: A dict of keyword arguments for each worker's
+        ``SOCKSServerFactory``. It must be serializable as JSON.
+    :param statsInterval: How often, in seconds, workers report their stats.
+    :param restartDelay: The number of seconds to wait before restarting a
+        worker which exited.
+    :param backlog: The listen backlog of the socket.
+    :param reactor: An `IReactorProcess`__ provider. Defaults to the global
+        reactor.
+
+    A worker which exits for any reason before `stop` is called is restarted;
+    ``restarts`` counts how many times that has happened.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorProcess.html
+
+    """
+
+    restarts = 0
+    running = False
+
+    def __init__(self, port, interface='127.0.0.1', workers=None, serverArgs={},
+                 statsInterval=5, restartDelay=1, backlog=50, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.port = port
+        self.interface = interface
+        self.workers = workers or _cpuCount()
+        self.serverArgs = serverArgs
+        self.statsInterval = statsInterval
+        self.restartDelay = restartDelay
+        self.backlog = backlog
+        self.reactor = reactor
+        self.socket = None
+        self.processes = []
+        self._retired = dict.fromkeys(statsCounters[1:], 0)
+
+    def _family(self):
+        if isIPv6Address(self.interface):
+            return socket.AF_INET6
+        return socket.AF_INET
+
+    def start(self):
+        """Open the listening socket and start the workers.
+
+        """
+        self.socket = socket.socket(self._family(), socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.interface, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        self.running = True
+        for x in xrange(self.workers):
+            self._spawn()
+
+    def getPort(self):
+        """Return the port being listened on.
+
+        """
+        return self.socket.getsockname()[1]
+
+    def _workerArgs(self):
+        fd = self.socket.fileno()
+        family = 'inet6' if self._family() == socket.AF_INET6 else 'inet'
+        return [
+            sys.executable, '-m', 'txsocksx.prefork', '--worker',
+            '--fd', str(fd),
+            '--family', family,
+            '--stats-interval', str(self.statsInterval),
+            '--server-args', json.dumps(self.serverArgs),
+        ]
+
+    def _spawn(self):
+        fd = self.socket.fileno()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [_packageParent, env.get('PYTHONPATH')]))
+        proto = _WorkerProcess(self)
+        self.reactor.spawnProcess(
+            proto, sys.executable, self._workerArgs(), env=env,
+            childFDs={0: 'w', 1: 'r', 2: 2, fd: fd})
+        self.processes.append(proto)
+
+    def _workerEnded(self, proto, reason):
+        self.processes.remove(proto)
+        for counter in self._retired:
+            self._retired[counter] += proto.stats.get(counter, 0)
+        if not self.running:
+            return
+        log.msg('SOCKS worker exited; restarting: %s' % (
+            reason.getErrorMessage(),))
+        self.restarts += 1
+        self.reactor.callLater(self.restartDelay, self._restart)
+
+    def _restart(self):
+        if self.running:
+            self._spawn()
+
+    def stats(self):
+        """Return the workers' stats, as last reported.
+
+        :returns: A dict with the number of running ``workers``, the number of
+            ``restarts``, the totals of each worker's ``openTunnels``,
+            ``totalTunnels`` and ``refusedTunnels`` (including workers which
+            have exited), and a list of each running worker's stats under
+            ``perWorker``.
+
+        """
+        result = {
+            'workers': len(self.processes),
+            'restarts': self.restarts,
+            'perWorker': [proto.stats for proto in self.processes],
+        }
+        for counter in statsCounters:
+            result[counter] = self._retired.get(counter, 0) + sum(
+                proto.stats.get(counter, 0) for proto in self.processes)
+        return result
+
+    def stop(self):
+        """Stop the workers and close the listening socket.
+
+        :returns: A ``Deferred`` which fires when every worker has exited.
+
+        """
+        self.running = False
+        ended = []
+        for proto in list(self.processes):
+            ended.append(proto.ended)
+            proto.transport.signalProcess('TERM')
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        return defer.gatherResults(ended)
+
+
+class _WorkerControl(protocol.Protocol):
+    """The worker's end of the pipes to the parent.
+
+    The worker reports its stats periodically, and exits when the parent's end
+    of stdin closes.
+
+    """
+
+    def __init__(self, reactor, factory, interval):
+        self.reactor = reactor
+        self.factory = factory
+        self.interval = interval
+
+    def connectionMade(self):
+        self._reportCall = task.LoopingCall(self.report)
+        self._reportCall.clock = self.reactor
+        self._reportCall.start(self.interval)
+
+    def report(self):
+        stats = {'pid': os.getpid()}
+        for counter in statsCounters:
+            stats[counter] = getattr(self.factory, counter)
+        self.transport.write(json.dumps(stats) + '\n')
+
+    def connectionLost(self, reason):
+        if self._reportCall.running:
+            self._reportCall.stop()
+        if self.reactor.running:
+            self.reactor.stop()
+
+
+def runWorker(reactor, fd, family, statsInterval, serverArgs):
+    """Serve SOCKS on the inherited listening socket *fd*.
+
+    """
+    factory = SOCKSServerFactory(reactor=reactor, **serverArgs)
+    reactor.adoptStreamPort(fd, family, factory)
+    os.close(fd)
+    stdio.StandardIO(_WorkerControl(reactor, factory, statsInterval))
+
+
+class Options(usage.Options):
+    optFlags = [
+        ['all-interfaces', None,
+         'Listen on every interface, not just --interface. Anyone who can '
+         'reach the port can relay through the server.'],
+        ['worker', None, 'Run as a worker process (internal).'],
+    ]
+
+    optParameters = [
+        ['port', 'p', 1080, 'The port to listen on.', int],
+        ['interface', 'i', '127.0.0.1', 'The address to listen on.'],
+        ['workers', 'w', None, 'The number of workers (default: CPUs).', int],
+        ['max-tunnels', None, None, 'Clients per worker.', int],
+        ['buffer-size', None, 65536, 'Bytes buffered per connection.', int],
+        ['stats-interval', None, 5, 'Seconds between stats reports.', float],
+        ['fd', None, None, 'The inherited socket (internal).', int],
+        ['family', None, 'inet', 'The inherited socket family (internal).'],
+        ['server-args', None, '{}', 'Factory arguments (internal).'],
+    ]
+
+    def postOptions(self):
+        if self['all-interfaces']:
+            if self['interface'] != '127.0.0.1':
+                raise usage.UsageError(
+                    '--all-interfaces and --interface are exclusive')
+            self['interface'] = ''
+
+
+def main(argv=None):
+    from twisted.internet import reactor
+
+    config = Options()
+    config.parseOptions(argv)
+    if config['worker']:
+        serverArgs = dict(
+            (str(key), value)
+            for key, value in json.loads(config['server-args']).iteritems())
+        family = {'inet': socket.AF_INET, 'inet6': socket.AF_INET6}[
+            config['family']]
+        runWorker(
+            reactor, config['fd'], family, config['stats-interval'],
+            serverArgs)
+        reactor.run()
+        return
+
+    log.startLogging(sys.stdout)
+    workers = SOCKSServerWorkers(
+        config['port'], config['interface'], config['workers'],
+        serverArgs={
+            'maxTunnels': config['max-tunnels'],
+            'bufferSize': config['buffer-size'],
+        },
+        statsInterval=config['stats-interval'], reactor=reactor)
+    workers.start()
+    statsCall = task.LoopingCall(
+        lambda: log.msg('SOCKS workers: %s' % (json.dumps(workers.stats()),)))
+    statsCall.start(config['stats-interval'], now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', workers.stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Name resolution through Tor's SOCKS5 ``RESOLVE`` extensions, and a cache
+for resolving names locally before connecting.
+
+"""
+
+
+from twisted.internet import defer, error, interfaces
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from zope.interface import implementer
+
+import txsocksx.constants as c
+import txsocksx.errors as e
+from txsocksx._cache import _Coalescer, _ExpiringLRUCache
+from txsocksx.client import (
+    SOCKS5ClientFactory, _connectThroughProxy, _makeTimer, validateTimeouts)
+
+
+class _SOCKS5ResolveFactory(SOCKS5ClientFactory):
+    """Sends one ``RESOLVE`` or ``RESOLVE_PTR`` request.
+
+    ``deferred`` fires with the address or hostname from the server's reply,
+    and the connection is then closed.
+
+    """
+
+    def __init__(self, command, host, methods, parser):
+        SOCKS5ClientFactory.__init__(
+            self, host, 0, None, methods, parser=parser)
+        self.command = command
+
+    def proxyConnectionFailed(self, reason):
+        if not self.deferred.called:
+            SOCKS5ClientFactory.proxyConnectionFailed(self, reason)
+
+    def proxyConnectionEstablished(self, proxyProtocol):
+        self.deferred.callback(self.boundAddress[0])
+        proxyProtocol.sender.transport.loseConnection()
+
+
+@implementer(interfaces.IResolverSimple)
+class SOCKS5Resolver(object):
+    """Resolves names through Tor's SOCKS5 port.
+
+    Each lookup is a ``RESOLVE`` (or, for `getNameByAddress`, a
+    ``RESOLVE_PTR``) request on its own connection to the SOCKS5 server.
+    Results are cached for *cacheTTL* seconds, and lookups for a name which is
+    already being looked up share the pending request instead of sending
+    another.
+
+    :param proxyEndpoint: The endpoint of Tor's SOCKS port. This must provide
+        `IStreamClientEndpoint`__.
+    :param methods: The authentication methods to try, as for
+        |SOCKS5ClientEndpoint|.
+    :param cacheSize: The number of results to keep. The least recently used
+        results are evicted first.
+    :param cacheTTL: The number of seconds to keep each result. Tor doesn't
+        pass along the TTLs of the DNS records it resolved.
+    :param parser: Which parser to use for the server's replies, as for
+        |SOCKS5ClientEndpoint|.
+    :param timeouts: Handshake timeouts for each request, as for
+        |SOCKS5ClientEndpoint|.
+    :param reactor: The `IReactorTime`__ used for the cache and *timeouts*.
+        Defaults to the global reactor.
+
+    The ``hits`` and ``misses`` attributes count the lookups which were and
+    were not answered from the cache; ``coalesced`` counts the misses which
+    shared a request already in flight.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamClientEndpoint.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    hits = misses = 0
+
+    def __init__(self, proxyEndpoint, methods={'anonymous': ()},
+                 cacheSize=1000, cacheTTL=60, parser='grammar', timeouts=None,
+                 reactor=None):
+        if not methods:
+            raise ValueError('no auth methods were specified')
+        validateTimeouts(timeouts)
+        if parser not in SOCKS5ClientFactory.protocols:
+            raise ValueError('unknown parser %r' % (parser,))
+        if reactor is None:
+            from twisted.internet import reactor
+        self.proxyEndpoint = proxyEndpoint
+        self.methods = methods
+        self.cacheTTL = cacheTTL
+        self.parser = parser
+        self.timeouts = timeouts
+        self.reactor = reactor
+        self.cache = _ExpiringLRUCache(cacheSize, reactor)
+        self._coalescer = _Coalescer()
+
+    @property
+    def coalesced(self):
+        return self._coalescer.coalesced
+
+    def getHostByName(self, name, timeout=None):
+        """Resolve *name* to an IPv4 or IPv6 address.
+
+        Returns a ``Deferred`` which fires with the address as a string, or
+        errbacks with ``DNSLookupError`` if the server couldn't resolve *name*.
+        IP addresses are returned as-is without asking the server. *timeout*
+        is ignored; use the *timeouts* of the resolver instead.
+
+        """
+        if isIPAddress(name) or isIPv6Address(name):
+            return defer.succeed(name)
+        return self._lookup(c.CMD_TOR_RESOLVE, name.lower())
+
+    def getNameByAddress(self, address):
+        """Resolve the IP address *address* to a hostname.
+
+        Returns a ``Deferred`` which fires with the hostname, or errbacks with
+        ``DNSLookupError`` if the server couldn't resolve *address*.
+
+        """
+        return self._lookup(c.CMD_TOR_RESOLVE_PTR, address)
+
+    def _lookup(self, command, name):
+        key = command, name
+        result = self.cache.get(key)
+        if result is not None:
+            self.hits += 1
+            return defer.succeed(result)
+        self.misses += 1
+        return self._coalescer.call(key, self._request, command, name)
+
+    def _request(self, command, name):
+        proxyFac = _SOCKS5ResolveFactory(
+            command, name, self.methods, self.parser)
+        d = _connectThroughProxy(
+            self.proxyEndpoint, proxyFac,
+            _makeTimer(self.reactor, self.timeouts))
+        d.addCallbacks(self._resolved, self._failed,
+                       callbackArgs=(command, name), errbackArgs=(name,))
+        return d
+
+    def _resolved(self, result, command, name):
+        self.cache.set((command, name), result, self.cacheTTL)
+        return result
+
+    def _failed(self, reason, name):
+        reason.trap(*e.socks5ErrorMap.values())
+        raise error.DNSLookupError(
+            '%s: %s' % (name, reason.value.__class__.__name__))
+
+    def invalidate(self, name):
+        """Forget the cached results for *name*, a hostname or an address.
+
+        """
+        self.cache.invalidate((c.CMD_TOR_RESOLVE, name.lower()))
+        self.cache.invalidate((c.CMD_TOR_RESOLVE_PTR, name))
+
+
+@implementer(interfaces.IResolverSimple)
+class CachingResolver(object):
+    """Caches the addresses another resolver looks up.
+
+    This is meant to be shared between the endpoints given it as *resolver*,
+    so that connecting to the same host through any of them looks its name
+    up once. Results are cached for *cacheTTL* seconds, and lookups for a name
+    which is already being looked up share the pending lookup. Failures
+    aren't cached.
+
+    :param resolver: The `IResolverSimple`__ provider to look names up with.
+        Defaults to the resolver of *reactor*.
+    :param cacheSize: The number of results to keep. The least recently used
+        results are evicted first.
+    :param cacheTTL: The number of seconds to keep each result.
+        ``IResolverSimple`` doesn't pass along the TTLs of DNS records.
+    :param reactor: The `IReactorTime`__ used for the cache. Defaults to the
+        global reactor.
+
+    The ``hits``, ``misses`` and ``coalesced`` attributes count lookups as for
+    `SOCKS5Resolver`.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IResolverSimple.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    hits = misses = 0
+
+    def __init__(self, resolver=None, cacheSize=1000, cacheTTL=60,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.resolver = resolver
+        self.cacheTTL = cacheTTL
+        self.reactor = reactor
+        self.cache = _ExpiringLRUCache(cacheSize, reactor)
+        self._coalescer = _Coalescer()
+
+    @property
+    def coalesced(self):
+        return self._coalescer.coalesced
+
+    def getHostByName(self, name, timeout=None):
+        """Resolve *name* to an address.
+
+        Returns a ``Deferred`` which fires with the address as a string, or
+        errbacks with whatever the underlying resolver failed with. IP
+        addresses are returned as-is. *timeout* is passed to the underlying
+        resolver on a cache miss.
+
+        """
+        if isIPAddress(name) or isIPv6Address(name):
+            return defer.succeed(name)
+        name = name.lower()
+        result = self.cache.get(name)
+        if result is not None:
+            self.hits += 1
+            return defer.succeed(result)
+        self.misses += 1
+        return self._coalescer.call(name, self._lookup, name, timeout)
+
+    def _lookup(self, name, timeout):
+        resolver = self.resolver
+        if resolver is None:
+            resolver = self.reactor.resolver
+        if timeout is None:
+            d = resolver.getHostByName(name)
+        else:
+            d = resolver.getHostByName(name, timeout)
+        d.addCallback(self._resolved, name)
+        return d
+
+    def _resolved(self, result, name):
+        self.cache.set(name, result, self.cacheTTL)
+        return result
+
+    def invalidate(self, name):
+        """Forget the cached result for *name*.
+
+        """
+        self.cache.invalidate(name.lower())
@@ -0,0 +1,315 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""A SOCKS4/4a and SOCKS5 server.
+
+"""
+
+
+import socket
+import struct
+
+from parsley import makeProtocol
+from twisted.internet import defer, error, protocol
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint
+
+import txsocksx.constants as c
+from txsocksx import grammar
+
+
+socks5ReplyMap = [
+    (error.ConnectionRefusedError, c.SOCKS5_CONNECTION_REFUSED),
+    (error.DNSLookupError, c.SOCKS5_HOST_UNREACHABLE),
+    (error.NoRouteError, c.SOCKS5_HOST_UNREACHABLE),
+    (error.TimeoutError, c.SOCKS5_TTL_EXPIRED),
+    (error.TCPTimedOutError, c.SOCKS5_TTL_EXPIRED),
+]
+
+def socks5ReplyFor(reason):
+    for exceptionType, status in socks5ReplyMap:
+        if reason.check(exceptionType):
+            return status
+    return c.SOCKS5_GENERAL_FAILURE
+
+
+class _UpstreamProtocol(protocol.Protocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connectionMade(self):
+        self.transport.bufferSize = self.server.factory.bufferSize
+
+    def dataReceived(self, data):
+        self.server.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.server._peerLost(self.server.transport)
+
+
+class _UpstreamFactory(protocol.ClientFactory):
+    noisy = False
+
+    def __init__(self, server):
+        self.server = server
+
+    def buildProtocol(self, addr):
+        return _UpstreamProtocol(self.server)
+
+
+class _SOCKSServerReceiver(object):
+    pending = None
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._earlyData = []
+        self._earlyLength = 0
+
+    def prepareParsing(self, parser):
+        self.server = parser.server
+        self.factory = parser.factory
+
+    def finishParsing(self, reason):
+        if self.pending is not None:
+            self.pending.cancel()
+
+    def dataReceived(self, data):
+        if self._earlyData is None:
+            self.server.upstream.write(data)
+            return
+        # Data sent before the upstream connection is made is held here, up
+        # to the same limit as any other buffer.
+        self._earlyData.append(data)
+        self._earlyLength += len(data)
+        if self._earlyLength > self.factory.bufferSize:
+            self.sender.transport.abortConnection()
+
+    def _connect(self, host, port):
+        self.currentRule = 'SOCKSState_readData'
+        self.pending = self.factory.connectUpstream(
+            host, port, _UpstreamFactory(self.server))
+        self.pending.addCallbacks(self._connected, self._failed)
+
+    def _connected(self, upstream):
+        self.pending = None
+        self.sendGranted(upstream.transport.getHost())
+        earlyData, self._earlyData = ''.join(self._earlyData), None
+        self.server.splice(upstream, earlyData)
+
+    def _failed(self, reason):
+        self.pending = None
+        if reason.check(defer.CancelledError):
+            return
+        self.sendRejected(reason)
+        self.sender.transport.loseConnection()
+
+
+class SOCKS5ServerSender(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendAuthMethod(self, method):
+        self.transport.write(struct.pack('!BB', c.VER_SOCKS5, method))
+
+    def sendReply(self, status, address=None):
+        if address is not None and isIPv6Address(address.host):
+            host = chr(c.ATYP_IPV6) + socket.inet_pton(
+                socket.AF_INET6, address.host)
+        else:
+            host = chr(c.ATYP_IPV4) + socket.inet_aton(
+                address.host if address is not None else '0.0.0.0')
+        port = struct.pack('!H', address.port if address is not None else 0)
+        self.transport.write(
+            struct.pack('!BBB', c.VER_SOCKS5, status, c.RSV) + host + port)
+
+
+class SOCKS5ServerReceiver(_SOCKSServerReceiver):
+    currentRule = 'SOCKS5ServerState_initial'
+
+    def authRequested(self, methods):
+        if ord(c.AUTH_ANONYMOUS) not in methods:
+            self.sender.sendAuthMethod(c.NO_ACCEPTABLE_METHODS)
+            self.sender.transport.loseConnection()
+            return
+        self.sender.sendAuthMethod(ord(c.AUTH_ANONYMOUS))
+        self.currentRule = 'SOCKS5ServerState_readRequest'
+
+    def clientRequest(self, command, address, port):
+        if command != 'tcp-connect':
+            self.sender.sendReply(c.SOCKS5_COMMAND_NOT_SUPPORTED)
+            self.sender.transport.loseConnection()
+            return
+        self._connect(address, port)
+
+    def sendGranted(self, address):
+        self.sender.sendReply(c.SOCKS5_GRANTED, address)
+
+    def sendRejected(self, reason):
+        self.sender.sendReply(socks5ReplyFor(reason))
+
+
+SOCKS5Server = makeProtocol(
+    grammar.grammarSource,
+    SOCKS5ServerSender,
+    SOCKS5ServerReceiver,
+    grammar.bindings)
+
+
+class SOCKS4ServerSender(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendReply(self, status, address=None):
+        if address is not None and not isIPv6Address(address.host):
+            host, port = socket.inet_aton(address.host), address.port
+        else:
+            host, port = '\0\0\0\0', 0
+        self.transport.write(struct.pack('!BBH', 0, status, port) + host)
+
+
+class SOCKS4ServerReceiver(_SOCKSServerReceiver):
+    currentRule = 'SOCKS4ServerState_initial'
+
+    def clientRequest(self, command, port, host, user):
+        if command != 'tcp-connect':
+            self.sender.sendReply(c.SOCKS4_REJECTED_OR_FAILED)
+            self.sender.transport.loseConnection()
+            return
+        self._connect(host, port)
+
+    def sendGranted(self, address):
+        self.sender.sendReply(c.SOCKS4_GRANTED, address)
+
+    def sendRejected(self, reason):
+        self.sender.sendReply(c.SOCKS4_REJECTED_OR_FAILED)
+
+
+SOCKS4Server = makeProtocol(
+    grammar.grammarSource,
+    SOCKS4ServerSender,
+    SOCKS4ServerReceiver,
+    grammar.bindings)
+
+
+class SOCKSServerProtocol(protocol.Protocol):
+    """One client of a `SOCKSServerFactory`.
+
+    The first byte the client sends selects the SOCKS version, and the
+    negotiation is parsed by the grammar's server rules. Once the upstream
+    connection is made, the two connections are spliced together: each
+    transport's ``write`` becomes the other protocol's ``dataReceived``, and
+    each transport is registered as the other's producer so that a slow
+    reader pauses the fast writer instead of buffering without bound.
+
+    """
+
+    versions = {
+        chr(c.VER_SOCKS4): SOCKS4Server,
+        chr(c.VER_SOCKS5): SOCKS5Server,
+    }
+
+    parserProtocol = None
+    upstream = None
+
+    def connectionMade(self):
+        self.transport.bufferSize = self.factory.bufferSize
+
+    def dataReceived(self, data):
+        if self.parserProtocol is None:
+            parserClass = self.versions.get(data[0])
+            if parserClass is None:
+                self.transport.abortConnection()
+                return
+            self.parserProtocol = parserClass()
+            self.parserProtocol.factory = self.factory
+            self.parserProtocol.server = self
+            self.parserProtocol.makeConnection(self.transport)
+        self.parserProtocol.dataReceived(data)
+
+    def splice(self, upstream, earlyData=''):
+        self.upstream = upstream.transport
+        if earlyData:
+            self.upstream.write(earlyData)
+        self.dataReceived = self.upstream.write
+        upstream.dataReceived = self.transport.write
+        self.transport.registerProducer(self.upstream, True)
+        self.upstream.registerProducer(self.transport, True)
+
+    def _peerLost(self, transport):
+        # A paused producer keeps a disconnecting transport from closing once
+        # its buffer is drained, so take it away first.
+        if transport.producer is not None:
+            transport.unregisterProducer()
+        transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.parserProtocol is not None:
+            self.parserProtocol.connectionLost(reason)
+        if self.upstream is not None:
+            self._peerLost(self.upstream)
+        self.factory._connectionLost(self)
+
+
+class SOCKSServerFactory(protocol.Factory):
+    """A factory for a SOCKS4, SOCKS4a and SOCKS5 server.
+
+    Only the ``CONNECT`` command and anonymous SOCKS5 authentication are
+    supported. Once a connection has been granted, data is relayed between
+    the client and the destination without going through any parser.
+
+    :param reactor: The reactor used to connect to destinations. Defaults to
+        the global reactor.
+    :param maxTunnels: The maximum number of clients to serve at once, or
+        ``None`` for no limit. Clients beyond the limit are disconnected
+        immediately.
+    :param bufferSize: The number of bytes to read at once from each
+        connection, and to buffer for each connection before the other one is
+        paused.
+    :param connectTimeout: The number of seconds to wait for connections to
+        destinations.
+
+    The ``openTunnels`` attribute counts the clients being served,
+    ``totalTunnels`` the clients served so far, and ``refusedTunnels`` the
+    clients disconnected because of *maxTunnels*.
+
+    """
+
+    protocol = SOCKSServerProtocol
+    openTunnels = totalTunnels = refusedTunnels = 0
+
+    def __init__(self, reactor=None, maxTunnels=None, bufferSize=65536,
+                 connectTimeout=30):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.maxTunnels = maxTunnels
+        self.bufferSize = bufferSize
+        self.connectTimeout = connectTimeout
+
+    def buildProtocol(self, addr):
+        if self.maxTunnels is not None and self.openTunnels >= self.maxTunnels:
+            self.refusedTunnels += 1
+            return None
+        self.openTunnels += 1
+        self.totalTunnels += 1
+        return protocol.Factory.buildProtocol(self, addr)
+
+    def _connectionLost(self, proto):
+        self.openTunnels -= 1
+
+    def endpointFor(self, host, port):
+        """Return the endpoint a client's request for *host* and *port* will
+        connect to.
+
+        Override this to restrict or redirect where clients can connect.
+
+        """
+        if isIPv6Address(host):
+            endpointClass = TCP6ClientEndpoint
+        else:
+            endpointClass = TCP4ClientEndpoint
+        return endpointClass(
+            self.reactor, host, port, timeout=self.connectTimeout)
+
+    def connectUpstream(self, host, port, fac):
+        return self.endpointFor(host, port).connect(fac)
@@ -0,0 +1,230 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, protocol, task
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.python import failure
+
+from txsocksx.test.util import FakeEndpoint, SyncDeferredsTestCase
+from txsocksx import bind, errors
+
+
+class RecordingProtocol(protocol.Protocol):
+    def __init__(self, addr):
+        self.addr = addr
+        self.data = ''
+
+    def dataReceived(self, data):
+        self.data += data
+
+
+class RecordingFactory(protocol.Factory):
+    def __init__(self):
+        self.protocols = []
+
+    def buildProtocol(self, addr):
+        proto = RecordingProtocol(addr)
+        self.protocols.append(proto)
+        return proto
+
+
+boundReply = '\x05\x00\x00\x01\x0a\x00\x00\x02\x9c\x40'
+peerReply = '\x05\x00\x00\x01\x0a\x00\x00\x09\x00\x15'
+
+
+class SOCKS5BindEndpointTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.proxy = FakeEndpoint()
+        self.factory = RecordingFactory()
+        self.endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy)
+
+    def listen(self, reply=boundReply):
+        return self.listenOn(self.endpoint, reply)
+
+    def listenOn(self, endpoint, reply=boundReply):
+        d = endpoint.listen(self.factory)
+        self.proxy.proto.dataReceived('\x05\x00' + reply)
+        return d
+
+    def test_request(self):
+        self.endpoint.listen(self.factory)
+        self.proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            self.proxy.transport.value(),
+            '\x05\x01\x00' '\x05\x02\x00\x01\x0a\x00\x00\x09\x00\x15')
+
+    def test_listen(self):
+        port = self.successResultOf(self.listen())
+        self.assertEqual(port.getHost().host, '10.0.0.2')
+        self.assertEqual(port.getHost().port, 40000)
+        self.assertEqual(
+            [(a.host, a.port) for a in port.boundAddresses()],
+            [('10.0.0.2', 40000)])
+
+    def test_unspecifiedBoundAddress(self):
+        port = self.successResultOf(
+            self.listen('\x05\x00\x00\x01\x00\x00\x00\x00\x9c\x40'))
+        self.assertEqual(port.getHost().host, '192.168.1.1')
+
+    def test_accept(self):
+        port = self.successResultOf(self.listen())
+        proxyProto, transport = self.proxy.proto, self.proxy.transport
+        proxyProto.dataReceived(peerReply + 'spam')
+        [proto] = self.factory.protocols
+        self.assertEqual((proto.addr.host, proto.addr.port), ('10.0.0.9', 21))
+        self.assertEqual(proto.data, 'spam')
+        proxyProto.dataReceived('eggs')
+        self.assertEqual(proto.data, 'spameggs')
+        proto.transport.write('ham')
+        self.assertEqual(transport.value()[-3:], 'ham')
+        # Another BIND has been requested for the next peer.
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.assertEqual(port.getHost(), None)
+        self.proxy.proto.dataReceived('\x05\x00' + boundReply)
+        self.assertEqual(port.getHost().port, 40000)
+
+    def test_rejected(self):
+        d = self.listen('\x05\x07\x00\x01\0\0\0\0\0\0')
+        self.failureResultOf(d, errors.CommandNotSupported)
+        self.assertEqual(len(self.proxy.connections), 1)
+
+    def test_proxyConnectionFailed(self):
+        self.proxy.failure = failure.Failure(ConnectionRefusedError())
+        d = self.endpoint.listen(self.factory)
+        self.failureResultOf(d, ConnectionRefusedError)
+
+    def test_grantedBindLost(self):
+        port = self.successResultOf(self.listen())
+        self.proxy.proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(port.getHost(), None)
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.assertEqual(self.factory.protocols, [])
+
+    def test_secondReplyRejected(self):
+        port = self.successResultOf(self.listen())
+        self.proxy.proto.dataReceived('\x05\x04\x00\x01\0\0\0\0\0\0')
+        self.assertEqual(self.factory.protocols, [])
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.assertEqual(port.getHost(), None)
+
+    def test_replacementRetried(self):
+        clock = task.Clock()
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, reactor=clock)
+        port = self.successResultOf(self.listenOn(endpoint))
+        self.proxy.failure = failure.Failure(ConnectionRefusedError())
+        self.proxy.proto.dataReceived(peerReply)
+        self.assertEqual(port.failures, 1)
+        clock.advance(1)
+        self.assertEqual(port.failures, 2)
+        self.proxy.failure = None
+        clock.advance(1)
+        self.assertEqual(len(self.proxy.connections), 1)
+        clock.advance(1)
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.proxy.proto.dataReceived('\x05\x00' + boundReply)
+        self.assertEqual(port._retryDelay, port.initialRetryDelay)
+
+    def test_stopListeningCancelsRetry(self):
+        clock = task.Clock()
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, reactor=clock)
+        port = self.successResultOf(self.listenOn(endpoint))
+        self.proxy.failure = failure.Failure(ConnectionRefusedError())
+        self.proxy.proto.dataReceived(peerReply)
+        port.stopListening()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_cancelBoundBeforeProxyConnects(self):
+        proxyFac = bind._SOCKS5BindFactory(
+            '10.0.0.9', 21, self.factory, {'anonymous': ()})
+        proxyFac.bound.addErrback(lambda reason: None)
+        proxyFac.bound.cancel()
+        self.assert_(proxyFac.canceled)
+
+    def test_backlog(self):
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, backlog=3)
+        d = endpoint.listen(self.factory)
+        self.assertEqual(len(self.proxy.connections), 3)
+        self.assertNoResult(d)
+        proxyProto, transport = self.proxy.connections[1]
+        proxyProto.dataReceived('\x05\x00' + boundReply)
+        port = self.successResultOf(d)
+        self.assertEqual(len(port.boundAddresses()), 1)
+        for proxyProto, transport in self.proxy.connections[::2]:
+            proxyProto.dataReceived(
+                '\x05\x00\x05\x00\x00\x01\x0a\x00\x00\x02\x9c\x41')
+        self.assertEqual(
+            [a.port for a in port.boundAddresses()], [40000, 40001, 40001])
+
+    def test_backlogAllFail(self):
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, backlog=2)
+        d = endpoint.listen(self.factory)
+        for proxyProto, transport in self.proxy.connections:
+            self.assertNoResult(d)
+            proxyProto.dataReceived('\x05\x00\x05\x05\x00\x01\0\0\0\0\0\0')
+        self.failureResultOf(d, errors.ConnectionRefused)
+
+    def test_stopListening(self):
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, backlog=2)
+        d = endpoint.listen(self.factory)
+        self.proxy.connections[0][0].dataReceived('\x05\x00' + boundReply)
+        port = self.successResultOf(d)
+        port.stopListening()
+        self.assertEqual(len(self.proxy.aborted), 2)
+        for proxyProto, transport in self.proxy.connections:
+            proxyProto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.assertEqual(port.boundAddresses(), [])
+
+    def test_stopListeningBeforeProxyConnects(self):
+        canceled = []
+        self.proxy.deferred = defer.Deferred(canceled.append)
+        port = bind.SOCKS5BindPort(self.endpoint, self.factory)
+        d = port.startListening()
+        port.stopListening()
+        self.assertEqual(len(canceled), 1)
+        self.failureResultOf(d, defer.CancelledError)
+
+    def test_timeout(self):
+        clock = task.Clock()
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, timeouts={'total': 5},
+            reactor=clock)
+        d = endpoint.listen(self.factory)
+        clock.advance(5)
+        self.failureResultOf(d, errors.HandshakeTimeout)
+
+    def test_timeoutDoesNotApplyToPeer(self):
+        clock = task.Clock()
+        endpoint = bind.SOCKS5BindEndpoint(
+            '10.0.0.9', 21, self.proxy, timeouts={'total': 5},
+            reactor=clock)
+        d = endpoint.listen(self.factory)
+        self.proxy.proto.dataReceived('\x05\x00' + boundReply)
+        port = self.successResultOf(d)
+        clock.advance(60)
+        self.assertEqual(self.proxy.aborted, [])
+        self.proxy.proto.dataReceived(peerReply)
+        self.assertEqual(len(self.factory.protocols), 1)
+
+    def test_invalidArguments(self):
+        self.assertRaises(
+            ValueError, bind.SOCKS5BindEndpoint, 'spam', 1, self.proxy,
+            methods={})
+        self.assertRaises(
+            ValueError, bind.SOCKS5BindEndpoint, 'spam', 1, self.proxy,
+            backlog=0)
+        self.assertRaises(
+            ValueError, bind.SOCKS5BindEndpoint, 'spam', 1, self.proxy,
+            parser='spam')
+
+
+class SOCKS5BindEndpointGrammarTestCase(SOCKS5BindEndpointTestCase):
+    def setUp(self):
+        SOCKS5BindEndpointTestCase.setUp(self)
+        self.endpoint.parser = 'grammar'
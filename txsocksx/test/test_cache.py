@@ -0,0 +1,93 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, task
+
+from txsocksx.test.util import SyncDeferredsTestCase
+from txsocksx._cache import _Coalescer, _ExpiringLRUCache
+
+
+class ExpiringLRUCacheTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = _ExpiringLRUCache(2, self.clock)
+
+    def test_getAndSet(self):
+        self.assertEqual(self.cache.get('spam'), None)
+        self.cache.set('spam', 'eggs', 10)
+        self.assertEqual(self.cache.get('spam'), 'eggs')
+        self.assertEqual(len(self.cache), 1)
+
+    def test_expiry(self):
+        self.cache.set('spam', 'eggs', 10)
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get('spam'), 'eggs')
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get('spam'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_evictsLeastRecentlyUsed(self):
+        self.cache.set('a', 1, 10)
+        self.cache.set('b', 2, 10)
+        self.cache.get('a')
+        self.cache.set('c', 3, 10)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_replace(self):
+        self.cache.set('a', 1, 10)
+        self.cache.set('a', 2, 10)
+        self.cache.set('b', 3, 10)
+        self.assertEqual(self.cache.get('a'), 2)
+        self.assertEqual(self.cache.get('b'), 3)
+
+    def test_invalidateAndClear(self):
+        self.cache.set('a', 1, 10)
+        self.cache.set('b', 2, 10)
+        self.cache.invalidate('a')
+        self.cache.invalidate('spam')
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.clear()
+        self.assertEqual(self.cache.get('b'), None)
+        self.cache.set('c', 3, 10)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_noTTL(self):
+        cache = _ExpiringLRUCache(2, None)
+        cache.set('spam', 'eggs')
+        self.assertEqual(cache.get('spam'), 'eggs')
+
+    def test_zeroSize(self):
+        cache = _ExpiringLRUCache(0, self.clock)
+        cache.set('a', 1, 10)
+        self.assertEqual(cache.get('a'), None)
+
+
+class CoalescerTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.coalescer = _Coalescer()
+        self.calls = []
+
+    def call(self, result):
+        self.calls.append(result)
+        return result
+
+    def test_shared(self):
+        d = defer.Deferred()
+        d1 = self.coalescer.call('spam', self.call, d)
+        d2 = self.coalescer.call('spam', self.call, d)
+        self.assertEqual(self.calls, [d])
+        self.assertEqual(self.coalescer.coalesced, 1)
+        d.callback('eggs')
+        self.assertEqual(self.successResultOf(d1), 'eggs')
+        self.assertEqual(self.successResultOf(d2), 'eggs')
+
+    def test_raises(self):
+        def fail():
+            raise ValueError()
+        self.failureResultOf(self.coalescer.call('spam', fail), ValueError)
+        self.assertEqual(self.coalescer._inFlight, {})
+        d = self.coalescer.call('spam', self.call, 'eggs')
+        self.assertEqual(self.successResultOf(d), 'eggs')
@@ -1,15 +1,23 @@
 # Copyright (c) Aaron Gallagher <_@habnab.it>
 # See COPYING for details.
 
+import gc
+import platform
+import sys
+import weakref
+
 from parsley import makeProtocol, stack
-from twisted.internet.error import ConnectionLost, ConnectionRefusedError
-from twisted.internet import defer, protocol
+from twisted.internet.error import (
+    ConnectionLost, ConnectionRefusedError, DNSLookupError)
+from twisted.internet import defer, interfaces, protocol, task
 from twisted.python import failure, log
 from twisted.trial import unittest
 from twisted.test import proto_helpers
+from zope.interface import directlyProvides
 
-from txsocksx.test.util import FakeEndpoint
-from txsocksx import client, errors, grammar
+from txsocksx.test.util import (
+    FakeEndpoint, FakeResolver, SyncDeferredsTestCase)
+from txsocksx import client, errors, grammar, resolver
 import txsocksx.constants as c
 
 
@@ -19,6 +27,12 @@ connectionRefusedFailure = failure.Failure(ConnectionRefusedError())
 
 class FakeSOCKS5ClientFactory(protocol.ClientFactory):
     protocol = client.SOCKS5Client
+    command = c.CMD_CONNECT
+    boundAddress = None
+    optimistic = False
+    earlyData = False
+    metrics = None
+    frames = None
 
     def __init__(self, host='', port=0, methods={c.AUTH_ANONYMOUS: ()}):
         self.host = host
@@ -37,9 +51,15 @@ class FakeSOCKS5ClientFactory(protocol.ClientFactory):
     def proxyConnectionEstablished(self, proxyProtocol):
         proxyProtocol.proxyEstablished(self.accum)
 
+    def handshakePhase(self, phase):
+        pass
+
 
 class FakeSOCKS4ClientFactory(protocol.ClientFactory):
     protocol = client.SOCKS4Client
+    earlyData = False
+    metrics = None
+    frames = None
 
     def __init__(self, host='', port=0, user=''):
         self.host = host
@@ -58,6 +78,9 @@ class FakeSOCKS4ClientFactory(protocol.ClientFactory):
     def proxyConnectionEstablished(self, proxyProtocol):
         proxyProtocol.proxyEstablished(self.accum)
 
+    def handshakePhase(self, phase):
+        pass
+
 
 authAdditionGrammar = """
 
@@ -101,8 +124,10 @@ AdditionAuthSOCKS5Client = makeProtocol(
 
 
 class TestSOCKS5Client(unittest.TestCase):
+    protocolClass = client.SOCKS5Client
+
     def makeProto(self, *a, **kw):
-        protoClass = kw.pop('_protoClass', client.SOCKS5Client)
+        protoClass = kw.pop('_protoClass', self.protocolClass)
         fac = FakeSOCKS5ClientFactory(*a, **kw)
         fac.protocol = protoClass
         proto = fac.buildProtocol(None)
@@ -247,10 +272,36 @@ class TestSOCKS5Client(unittest.TestCase):
         proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
         self.assertEqual(proto.transport.protocol, fac.accum)
 
+    def test_parserBypassedAfterNegotiation(self):
+        fac, proto = self.makeProto()
+        proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+        self.assertEqual(proto.dataReceived, fac.accum.dataReceived)
+        self.assertEqual(proto.connectionLost, fac.accum.connectionLost)
+        proto.dataReceived('xxxxx')
+        self.assertEqual(fac.accum.data, 'xxxxx')
+
+    def test_parserNotBypassedDuringNegotiation(self):
+        fac, proto = self.makeProto()
+        proto.dataReceived('\x05\x00\x05\x00')
+        self.assertNotEqual(proto.dataReceived, fac.accum.dataReceived)
+
+    def test_dataAfterReplyDeliveredAtOnce(self):
+        fac, proto = self.makeProto()
+        received = []
+        fac.accum.dataReceived = received.append
+        proto.dataReceived('\x05\x00\x05\x00\x00\x01444422' + 'x' * 100)
+        self.assertEqual(received, ['x' * 100])
+
+
+class TestSOCKS5FastClient(TestSOCKS5Client):
+    protocolClass = client.SOCKS5FastClient
+
 
 class TestSOCKS4Client(unittest.TestCase):
+    protocolClass = client.SOCKS4Client
+
     def makeProto(self, *a, **kw):
-        protoClass = kw.pop('_protoClass', client.SOCKS4Client)
+        protoClass = kw.pop('_protoClass', self.protocolClass)
         fac = FakeSOCKS4ClientFactory(*a, **kw)
         fac.protocol = protoClass
         proto = fac.buildProtocol(None)
@@ -335,6 +386,24 @@ class TestSOCKS4Client(unittest.TestCase):
         proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00')
         self.assertEqual(proto.transport.protocol, fac.accum)
 
+    def test_parserBypassedAfterNegotiation(self):
+        fac, proto = self.makeProto()
+        proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(proto.dataReceived, fac.accum.dataReceived)
+        proto.dataReceived('xxxxx')
+        self.assertEqual(fac.accum.data, 'xxxxx')
+
+    def test_dataAfterReplyDeliveredAtOnce(self):
+        fac, proto = self.makeProto()
+        received = []
+        fac.accum.dataReceived = received.append
+        proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00' + 'x' * 100)
+        self.assertEqual(received, ['x' * 100])
+
+
+class TestSOCKS4FastClient(TestSOCKS4Client):
+    protocolClass = client.SOCKS4FastClient
+
 
 class FakeFactory(protocol.ClientFactory):
     protocol = proto_helpers.AccumulatingProtocol
@@ -388,7 +457,7 @@ class _TestSOCKSClientFactoryCommon(object):
         return self.assertFailure(fac.deferred, ConnectionRefusedError)
 
 
-class TestSOCKS5ClientFactory(_TestSOCKSClientFactoryCommon, unittest.TestCase):
+class TestSOCKS5ClientFactory(_TestSOCKSClientFactoryCommon, SyncDeferredsTestCase):
     factory = client.SOCKS5ClientFactory
 
     def test_defaultFactory(self):
@@ -407,6 +476,23 @@ class TestSOCKS5ClientFactory(_TestSOCKSClientFactoryCommon, unittest.TestCase):
         self.assertRaises(
             ValueError, client.SOCKS5ClientFactory, None, None, None, methods={})
 
+    def test_parserSelection(self):
+        fac = client.SOCKS5ClientFactory('', 0, None)
+        self.assertIdentical(fac.protocol, client.SOCKS5Client)
+        fac = client.SOCKS5ClientFactory('', 0, None, parser='fast')
+        self.assertIdentical(fac.protocol, client.SOCKS5FastClient)
+        self.assertRaises(
+            ValueError, client.SOCKS5ClientFactory, '', 0, None, parser='spam')
+
+    def test_subclassProtocol(self):
+        class FastFactory(client.SOCKS5ClientFactory):
+            protocol = client.SOCKS5FastClient
+
+        fac = FastFactory('', 0, None)
+        self.assertIdentical(fac.protocol, client.SOCKS5FastClient)
+        fac = FastFactory('', 0, None, parser='grammar')
+        self.assertIdentical(fac.protocol, client.SOCKS5Client)
+
     def test_loginAuth(self):
         fac, proto = self.makeProto('', 0, None, methods={'login': ('spam', 'eggs')})
         proto.transport.clear()
@@ -426,6 +512,115 @@ class TestSOCKS5ClientFactory(_TestSOCKSClientFactoryCommon, unittest.TestCase):
         proto.dataReceived('\x05\x00\x05\x00\x00\x01444422xxxxx')
         self.assertEqual(wrappedFac.proto.data, 'xxxxx')
 
+    def test_optimisticAnonymous(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('host', 0x47, wrappedFac, optimistic=True)
+        self.assertEqual(proto.transport.value(),
+                         '\x05\x01\x00\x05\x01\x00\x03\x04host\x00\x47')
+        proto.transport.clear()
+        proto.dataReceived('\x05\x00')
+        self.assertEqual(proto.transport.value(), '')
+        proto.dataReceived('\x05\x00\x00\x01444422xxxxx')
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+        self.assertEqual(proto.transport.value(), '')
+
+    def test_optimisticLogin(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto(
+            'host', 0x47, wrappedFac, methods={'login': ('spam', 'eggs')},
+            optimistic=True)
+        self.assertEqual(proto.transport.value(),
+                         '\x05\x01\x02\x01\x04spam\x04eggs'
+                         '\x05\x01\x00\x03\x04host\x00\x47')
+        proto.transport.clear()
+        proto.dataReceived('\x05\x02\x01\x00\x05\x00\x00\x01444422xxxxx')
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+        self.assertEqual(proto.transport.value(), '')
+
+    def test_optimisticLoginFailed(self):
+        fac, proto = self.makeProto(
+            '', 0, None, methods={'login': ('spam', 'eggs')}, optimistic=True)
+        proto.dataReceived('\x05\x02\x01\x01\x05\x00\x00\x01444422')
+        self.assert_(self.aborted)
+        return self.assertFailure(fac.deferred, errors.LoginAuthenticationFailed)
+
+    def test_optimisticMethodRejected(self):
+        fac, proto = self.makeProto('', 0, None, optimistic=True)
+        proto.dataReceived('\x05\xff')
+        self.assert_(self.aborted)
+        return self.assertFailure(fac.deferred, errors.MethodsNotAcceptedError)
+
+    def test_optimisticRequiresOneMethod(self):
+        self.assertRaises(
+            ValueError, client.SOCKS5ClientFactory, '', 0, None,
+            methods={'anonymous': (), 'login': ('spam', 'eggs')},
+            optimistic=True)
+
+    def test_earlyData(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('host', 0x47, wrappedFac, earlyData=True)
+        self.assertEqual(self.successResultOf(fac.deferred), wrappedFac.proto)
+        wrappedFac.proto.transport.write('early')
+        self.assertEqual(proto.transport.value(), '\x05\x01\x00')
+        proto.dataReceived('\x05\x00')
+        self.assertEqual(proto.transport.value(),
+                         '\x05\x01\x00\x05\x01\x00\x03\x04host\x00\x47early')
+        proto.transport.clear()
+        wrappedFac.proto.transport.write('late')
+        self.assertEqual(proto.transport.value(), 'late')
+        proto.dataReceived('\x05\x00\x00\x01444422xxxxx')
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+
+    def test_earlyDataTransportInterfaces(self):
+        wrappedFac = FakeFactory()
+        fac = self.factory('host', 0x47, wrappedFac, earlyData=True)
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        directlyProvides(transport, interfaces.ITLSTransport)
+        proto.makeConnection(transport)
+        early = wrappedFac.proto.transport
+        self.assertIsInstance(early, client._EarlyDataTransport)
+        for iface in [interfaces.ITLSTransport, interfaces.IConsumer,
+                      interfaces.IPushProducer]:
+            self.assert_(iface.providedBy(early), iface)
+        self.assert_(interfaces.ITransport.providedBy(
+            client._EarlyDataTransport(object(), False)))
+
+    def test_earlyDataOptimistic(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto(
+            'host', 0x47, wrappedFac, optimistic=True, earlyData=True)
+        wrappedFac.proto.transport.write('early')
+        self.assertEqual(proto.transport.value(),
+                         '\x05\x01\x00\x05\x01\x00\x03\x04host\x00\x47early')
+
+    def test_earlyDataLoseConnection(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('host', 0x47, wrappedFac, earlyData=True)
+        wrappedFac.proto.transport.write('early')
+        wrappedFac.proto.transport.loseConnection()
+        self.assertFalse(proto.transport.disconnecting)
+        proto.dataReceived('\x05\x00')
+        self.assert_(proto.transport.value().endswith('early'))
+        self.assert_(proto.transport.disconnecting)
+
+    def test_earlyDataParserBypassedOnlyWhenGranted(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('', 0, wrappedFac, earlyData=True)
+        proto.dataReceived('\x05\x00')
+        self.assertNotEqual(proto.dataReceived, wrappedFac.proto.dataReceived)
+        proto.dataReceived('\x05\x00\x00\x01444422')
+        self.assertEqual(proto.dataReceived, wrappedFac.proto.dataReceived)
+
+    def test_earlyDataRejected(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('', 0, wrappedFac, earlyData=True)
+        self.successResultOf(fac.deferred)
+        proto.dataReceived('\x05\x00\x05\x01\x00\x01444422')
+        self.assert_(self.aborted)
+        self.failUnlessIsInstance(
+            wrappedFac.proto.closedReason.value, errors.ServerFailure)
+
     def test_noProtocolFromWrappedFactory(self):
         wrappedFac = FakeFactory(returnNoProtocol=True)
         fac, proto = self.makeProto('', 0, wrappedFac)
@@ -442,7 +637,7 @@ class TestSOCKS5ClientFactory(_TestSOCKSClientFactoryCommon, unittest.TestCase):
         self.assertEqual(proto.transport.value(), 'xxxxx')
 
 
-class TestSOCKS4ClientFactory(_TestSOCKSClientFactoryCommon, unittest.TestCase):
+class TestSOCKS4ClientFactory(_TestSOCKSClientFactoryCommon, SyncDeferredsTestCase):
     factory = client.SOCKS4ClientFactory
 
     def test_defaultFactory(self):
@@ -482,8 +677,43 @@ class TestSOCKS4ClientFactory(_TestSOCKSClientFactoryCommon, unittest.TestCase):
         self.assertRaises(ValueError, client.SOCKS4ClientFactory, '0.0.0.1', 0, None)
         self.assertRaises(ValueError, client.SOCKS4ClientFactory, '0.0.0.255', 0, None)
 
+    def test_earlyData(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('127.0.0.1', 0, wrappedFac, earlyData=True)
+        self.assertEqual(self.successResultOf(fac.deferred), wrappedFac.proto)
+        wrappedFac.proto.transport.write('early')
+        self.assertEqual(proto.transport.value(),
+                         '\x04\x01\x00\x00\x7f\x00\x00\x01\x00early')
+        proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00xxxxx')
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+
+    def test_earlyDataRejected(self):
+        wrappedFac = FakeFactory()
+        fac, proto = self.makeProto('127.0.0.1', 0, wrappedFac, earlyData=True)
+        proto.dataReceived('\x00\x5b\x00\x00\x00\x00\x00\x00')
+        self.assert_(self.aborted)
+        self.failUnlessIsInstance(
+            wrappedFac.proto.closedReason.value, errors.RequestRejectedOrFailed)
+
+    def test_parserSelection(self):
+        fac = client.SOCKS4ClientFactory('', 0, None)
+        self.assertIdentical(fac.protocol, client.SOCKS4Client)
+        fac = client.SOCKS4ClientFactory('', 0, None, parser='fast')
+        self.assertIdentical(fac.protocol, client.SOCKS4FastClient)
+        self.assertRaises(
+            ValueError, client.SOCKS4ClientFactory, '', 0, None, parser='spam')
+
+    def test_subclassProtocol(self):
+        class FastFactory(client.SOCKS4ClientFactory):
+            protocol = client.SOCKS4FastClient
+
+        fac = FastFactory('', 0, None)
+        self.assertIdentical(fac.protocol, client.SOCKS4FastClient)
+        fac = FastFactory('', 0, None, parser='grammar')
+        self.assertIdentical(fac.protocol, client.SOCKS4Client)
+
 
-class TestSOCKS5ClientEndpoint(unittest.TestCase):
+class TestSOCKS5ClientEndpoint(SyncDeferredsTestCase):
     def test_clientConnectionFailed(self):
         proxy = FakeEndpoint(failure=connectionRefusedFailure)
         endpoint = client.SOCKS5ClientEndpoint('', 0, proxy)
@@ -512,6 +742,342 @@ class TestSOCKS5ClientEndpoint(unittest.TestCase):
         self.assertRaises(
             ValueError, client.SOCKS5ClientEndpoint, None, None, None, methods={})
 
+    def test_grammarParser(self):
+        wrappedFac = FakeFactory()
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint('', 0, proxy, parser='grammar')
+        d = endpoint.connect(wrappedFac)
+        self.assertIdentical(proxy.factory.protocol, client.SOCKS5Client)
+        proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422xxxxx')
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+        return d
+
+    def test_unknownParserFails(self):
+        self.assertRaises(
+            ValueError, client.SOCKS5ClientEndpoint, '', 0, None, parser='spam')
+
+    def test_optimistic(self):
+        wrappedFac = FakeFactory()
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, proxy, optimistic=True)
+        d = endpoint.connect(wrappedFac)
+        self.assertEqual(proxy.transport.value(),
+                         '\x05\x01\x00\x05\x01\x00\x03\x04host\x00\x47')
+        proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422xxxxx')
+        d.addCallback(self.assertEqual, wrappedFac.proto)
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+        return d
+
+    def test_optimisticRequiresOneMethod(self):
+        self.assertRaises(
+            ValueError, client.SOCKS5ClientEndpoint, '', 0, None,
+            methods={'anonymous': (), 'login': ('spam', 'eggs')},
+            optimistic=True)
+
+    def test_timeoutDuringConnect(self):
+        clock = task.Clock()
+        proxy = FakeEndpoint()
+        proxy.deferred = defer.Deferred()
+        endpoint = client.SOCKS5ClientEndpoint(
+            '', 0, proxy, timeouts={'connect': 5}, reactor=clock)
+        d = endpoint.connect(FakeFactory())
+        clock.advance(5)
+        f = self.failureResultOf(d, errors.HandshakeTimeout)
+        self.assertEqual(f.value.phase, 'connect')
+
+    def test_timeoutPhases(self):
+        cases = [
+            ('auth', {'connect': 1, 'auth': 5}, ''),
+            ('request', {'auth': 5, 'request': 10}, '\x05\x00'),
+            ('total', {'auth': 100, 'total': 12}, ''),
+        ]
+        for phase, timeouts, replies in cases:
+            clock = task.Clock()
+            proxy = FakeEndpoint()
+            endpoint = client.SOCKS5ClientEndpoint(
+                '', 0, proxy, timeouts=timeouts, reactor=clock)
+            d = endpoint.connect(FakeFactory())
+            proxy.proto.dataReceived(replies)
+            clock.advance(4)
+            self.assertNoResult(d)
+            clock.advance(10)
+            f = self.failureResultOf(d, errors.HandshakeTimeout)
+            self.assertEqual(f.value.phase, phase)
+            self.assert_(proxy.aborted)
+
+    def test_timeoutsCanceledOnSuccess(self):
+        clock = task.Clock()
+        proxy = FakeEndpoint()
+        wrappedFac = FakeFactory()
+        endpoint = client.SOCKS5ClientEndpoint(
+            '', 0, proxy, timeouts={'request': 5, 'total': 10}, reactor=clock)
+        d = endpoint.connect(wrappedFac)
+        proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+        self.assertIdentical(self.successResultOf(d), wrappedFac.proto)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_unknownTimeoutPhase(self):
+        self.assertRaises(
+            ValueError, client.SOCKS5ClientEndpoint, '', 0, None,
+            timeouts={'spam': 5})
+
+    def test_earlyDataTimeouts(self):
+        for phase in ['auth', 'request', 'total']:
+            self.assertRaises(
+                ValueError, client.SOCKS5ClientEndpoint, '', 0, None,
+                earlyData=True, timeouts={phase: 5})
+            self.assertRaises(
+                ValueError, client.SOCKS4ClientEndpoint, '', 0, None,
+                earlyData=True, timeouts={phase: 5})
+        clock = task.Clock()
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, proxy, earlyData=True, timeouts={'connect': 5},
+            reactor=clock)
+        self.successResultOf(endpoint.connect(FakeFactory()))
+        proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_phaseAfterTimerFinished(self):
+        clock = task.Clock()
+        timer = client._HandshakeTimer(clock, {'request': 5})
+        d = defer.Deferred()
+        timer.watch(d)
+        d.callback(None)
+        timer.enterPhase('request')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_IPv4Request(self):
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint('10.0.0.5', 0x47, proxy)
+        endpoint.connect(None)
+        proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            proxy.transport.value(),
+            '\x05\x01\x00' '\x05\x01\x00\x01\x0a\x00\x00\x05\x00\x47')
+
+    def test_IPv6Request(self):
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint('2001:db8::1', 0x47, proxy)
+        endpoint.connect(None)
+        proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            proxy.transport.value(),
+            '\x05\x01\x00' '\x05\x01\x00\x04'
+            ' \x01\x0d\xb8' + '\x00' * 11 + '\x01\x00\x47')
+
+    def test_resolver(self):
+        proxy = FakeEndpoint()
+        names = FakeResolver()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'spam.com', 0x47, proxy, resolver=names)
+        d = endpoint.connect(FakeFactory())
+        self.assertEqual(proxy.connections, [])
+        [(name, timeout, lookup)] = names.lookups
+        self.assertEqual(name, 'spam.com')
+        lookup.callback('10.0.0.5')
+        proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            proxy.transport.value(),
+            '\x05\x01\x00' '\x05\x01\x00\x01\x0a\x00\x00\x05\x00\x47')
+        proxy.proto.dataReceived('\x05\x00\x00\x01444422')
+        self.successResultOf(d)
+
+    def test_resolverNotUsedForAddresses(self):
+        names = FakeResolver()
+        endpoint = client.SOCKS5ClientEndpoint(
+            '10.0.0.5', 0x47, FakeEndpoint(), resolver=names)
+        endpoint.connect(None)
+        self.assertEqual(names.lookups, [])
+
+    def test_resolverFailed(self):
+        proxy = FakeEndpoint()
+        names = FakeResolver()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'spam.com', 0x47, proxy, resolver=names)
+        d = endpoint.connect(None)
+        names.lookups[0][2].errback(DNSLookupError('spam.com'))
+        self.failureResultOf(d, DNSLookupError)
+        self.assertEqual(proxy.connections, [])
+
+    def test_resolverCanceled(self):
+        names = FakeResolver()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'spam.com', 0x47, FakeEndpoint(), resolver=names)
+        d = endpoint.connect(None)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(names.canceled, ['spam.com'])
+
+    def test_sharedResolverCache(self):
+        names = FakeResolver()
+        cache = resolver.CachingResolver(names, reactor=task.Clock())
+        proxy = FakeEndpoint()
+        socks5 = client.SOCKS5ClientEndpoint(
+            'spam.com', 0x47, proxy, resolver=cache)
+        socks4 = client.SOCKS4ClientEndpoint(
+            'spam.com', 0x47, proxy, resolver=cache)
+        socks5.connect(None)
+        socks4.connect(None)
+        self.assertEqual(len(names.lookups), 1)
+        names.lookups[0][2].callback('10.0.0.5')
+        self.assertEqual(len(proxy.connections), 2)
+        socks4.connect(None)
+        self.assertEqual(len(names.lookups), 1)
+        self.assertEqual(
+            proxy.transport.value(), '\x04\x01\x00\x47\x0a\x00\x00\x05\x00')
+
+    def test_hostnameLikeAddressRequest(self):
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint('10.0.5', 0x47, proxy)
+        endpoint.connect(None)
+        proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            proxy.transport.value(),
+            '\x05\x01\x00' '\x05\x01\x00\x03\x0610.0.5\x00\x47')
+
+    def test_framesReused(self):
+        proxy = FakeEndpoint()
+        methods = {'login': ('spam', 'eggs')}
+        endpoint = client.SOCKS5ClientEndpoint('host', 0x47, proxy, methods)
+        endpoint.connect(FakeFactory())
+        frames = proxy.factory.frames
+        endpoint.connect(FakeFactory())
+        self.assertIdentical(proxy.factory.frames, frames)
+        self.assertEqual(frames.greeting, '\x05\x01\x02')
+        self.assertEqual(frames.login, '\x01\x04spam\x04eggs')
+        self.assertEqual(
+            frames.request, '\x05\x01\x00\x03\x04host\x00\x47')
+        self.assertEqual(
+            frames.optimistic, frames.greeting + frames.login + frames.request)
+
+    def test_framesOnlyForConnect(self):
+        proxyFac = client.SOCKS5ClientFactory('host', 0x47, FakeFactory())
+        proxyFac.command = c.CMD_BIND
+        proxyFac.frames = client._SOCKS5Frames(
+            'host', 0x47, {'anonymous': ()})
+        proto = proxyFac.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        transport.abortConnection = lambda: None
+        proto.makeConnection(transport)
+        proto.dataReceived('\x05\x00')
+        self.failureResultOf(proxyFac.deferred, AssertionError)
+
+    def test_framesInvalidated(self):
+        proxy = FakeEndpoint()
+        methods = {'login': ('spam', 'eggs')}
+        endpoint = client.SOCKS5ClientEndpoint('host', 0x47, proxy, methods)
+        endpoint.connect(FakeFactory())
+        endpoint.host = 'other'
+        endpoint.connect(FakeFactory())
+        self.assertEqual(
+            proxy.factory.frames.request,
+            '\x05\x01\x00\x03\x05other\x00\x47')
+        methods['login'] = ('ham', 'eggs')
+        endpoint.connect(FakeFactory())
+        proxy.proto.dataReceived('\x05\x02')
+        self.assertEqual(
+            proxy.transport.value(), '\x05\x01\x02\x01\x03ham\x04eggs')
+
+    def test_timingObserver(self):
+        clock = task.Clock()
+        self.patch(client, '_now', clock.seconds)
+        timings = []
+        proxy = FakeEndpoint()
+        proxy.deferred = defer.Deferred()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, proxy, timingObserver=timings.append)
+        d = endpoint.connect(FakeFactory())
+        clock.advance(1)
+        proto = proxy.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        proxy.deferred.callback(proto)
+        clock.advance(2)
+        proto.dataReceived('\x05\x00')
+        clock.advance(4)
+        self.assertEqual(timings, [])
+        proto.dataReceived('\x05\x00\x00\x01444422')
+        self.successResultOf(d)
+        [result] = timings
+        self.assertEqual(result, {
+            'proxyEndpoint': proxy,
+            'host': 'host',
+            'port': 0x47,
+            'phases': {'connect': 1, 'auth': 2, 'request': 4},
+            'total': 7,
+            'reason': None,
+        })
+
+    def test_timingObserverOnFailure(self):
+        clock = task.Clock()
+        self.patch(client, '_now', clock.seconds)
+        timings = []
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            '', 0, proxy, timingObserver=timings.append)
+        d = endpoint.connect(FakeFactory())
+        clock.advance(3)
+        proxy.proto.dataReceived('\x05\xff')
+        f = self.failureResultOf(d, errors.MethodsNotAcceptedError)
+        [result] = timings
+        self.assertEqual(result['phases'], {'connect': 0, 'auth': 3})
+        self.assertEqual(result['total'], 3)
+        self.assertIdentical(result['reason'], f)
+
+    def test_timingObserverError(self):
+        def observer(timings):
+            raise ValueError('spam')
+        proxy = FakeEndpoint()
+        wrappedFac = FakeFactory()
+        endpoint = client.SOCKS5ClientEndpoint(
+            '', 0, proxy, timingObserver=observer)
+        d = endpoint.connect(wrappedFac)
+        proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+        self.assertIdentical(self.successResultOf(d), wrappedFac.proto)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_noTimingsWithoutObserver(self):
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint('', 0, proxy)
+        endpoint.connect(FakeFactory())
+        self.assertIdentical(proxy.factory.phaseTimes, None)
+
+    def test_logHandshakeTimings(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, proxy, timingObserver=client.logHandshakeTimings)
+        d = endpoint.connect(FakeFactory())
+        proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+        self.successResultOf(d)
+        handshakeEvents = [e for e in events if e.get('socksHandshake')]
+        self.assertEqual(
+            [e['phase'] for e in handshakeEvents],
+            ['auth', 'connect', 'request', 'total'])
+        for event in handshakeEvents:
+            self.assertEqual(event['host'], 'host')
+            self.assertEqual(event['port'], 0x47)
+            self.assertIsInstance(event['seconds'], float)
+            self.assertNotIn('phases', event)
+        self.assertIn('SOCKS handshake with host:71',
+                      log.textFromEventDict(handshakeEvents[-1]))
+        self.assertIn('total took', log.textFromEventDict(handshakeEvents[-1]))
+
+    def test_earlyData(self):
+        wrappedFac = FakeFactory()
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, proxy, optimistic=True, earlyData=True)
+        d = endpoint.connect(wrappedFac)
+        d.addCallback(self.assertEqual, wrappedFac.proto)
+        wrappedFac.proto.transport.write('early')
+        self.assertEqual(proxy.transport.value(),
+                         '\x05\x01\x00\x05\x01\x00\x03\x04host\x00\x47early')
+        return d
+
     def test_buildingWrappedFactory(self):
         wrappedFac = FakeFactory()
         proxy = FakeEndpoint()
@@ -533,7 +1099,7 @@ class TestSOCKS5ClientEndpoint(unittest.TestCase):
         self.assertEqual(proxy.proto.transport.value(), 'xxxxx')
 
 
-class TestSOCKS4ClientEndpoint(unittest.TestCase):
+class TestSOCKS4ClientEndpoint(SyncDeferredsTestCase):
     def test_clientConnectionFailed(self):
         proxy = FakeEndpoint(failure=connectionRefusedFailure)
         endpoint = client.SOCKS4ClientEndpoint('', 0, proxy)
@@ -578,6 +1144,190 @@ class TestSOCKS4ClientEndpoint(unittest.TestCase):
         wrappedFac.proto.transport.write('xxxxx')
         self.assertEqual(proxy.proto.transport.value(), 'xxxxx')
 
+    def test_timeout(self):
+        clock = task.Clock()
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS4ClientEndpoint(
+            '127.0.0.1', 0, proxy, timeouts={'request': 5}, reactor=clock)
+        d = endpoint.connect(FakeFactory())
+        clock.advance(5)
+        f = self.failureResultOf(d, errors.HandshakeTimeout)
+        self.assertEqual(f.value.phase, 'request')
+        self.assert_(proxy.aborted)
+
+    def test_framesReused(self):
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS4ClientEndpoint('spam.com', 0, proxy)
+        endpoint.connect(None)
+        frames = proxy.factory.frames
+        endpoint.connect(None)
+        self.assertIdentical(proxy.factory.frames, frames)
+        endpoint.user = 'spam'
+        endpoint.connect(None)
+        self.assertEqual(
+            proxy.transport.value(),
+            '\x04\x01\x00\x00\x00\x00\x00\x01spam\x00spam.com\x00')
+
+    def test_timingObserver(self):
+        clock = task.Clock()
+        self.patch(client, '_now', clock.seconds)
+        timings = []
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS4ClientEndpoint(
+            '127.0.0.1', 0, proxy, timingObserver=timings.append)
+        d = endpoint.connect(FakeFactory())
+        clock.advance(5)
+        proxy.proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00')
+        self.successResultOf(d)
+        [result] = timings
+        self.assertEqual(result['phases'], {'connect': 0, 'request': 5})
+        self.assertEqual(result['total'], 5)
+
+    def test_earlyData(self):
+        wrappedFac = FakeFactory()
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS4ClientEndpoint(
+            '127.0.0.1', 0, proxy, earlyData=True)
+        d = endpoint.connect(wrappedFac)
+        d.addCallback(self.assertEqual, wrappedFac.proto)
+        wrappedFac.proto.transport.write('early')
+        self.assertEqual(proxy.transport.value(),
+                         '\x04\x01\x00\x00\x7f\x00\x00\x01\x00early')
+        return d
+
+    def test_resolver(self):
+        proxy = FakeEndpoint()
+        names = FakeResolver()
+        endpoint = client.SOCKS4ClientEndpoint(
+            'spam.com', 0, proxy, resolver=names)
+        d = endpoint.connect(FakeFactory())
+        names.lookups[0][2].callback('10.0.0.5')
+        self.assertEqual(proxy.transport.value(), '\x04\x01\x00\x00\x0a\x00\x00\x05\x00')
+        proxy.proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00')
+        self.successResultOf(d)
+
+    def test_resolverIPv6Result(self):
+        proxy = FakeEndpoint()
+        names = FakeResolver()
+        endpoint = client.SOCKS4ClientEndpoint(
+            'spam.com', 0, proxy, resolver=names)
+        d = endpoint.connect(FakeFactory())
+        names.lookups[0][2].callback('::1')
+        self.failureResultOf(d, DNSLookupError)
+        self.assertEqual(proxy.connections, [])
+
     def test_invalidIPs(self):
         self.assertRaises(ValueError, client.SOCKS4ClientEndpoint, '0.0.0.1', 0, None)
         self.assertRaises(ValueError, client.SOCKS4ClientEndpoint, '0.0.0.255', 0, None)
+
+
+class IdleProtocol(protocol.Protocol):
+    pass
+
+
+class IdleFactory(protocol.ClientFactory):
+    protocol = IdleProtocol
+
+
+class ForgetfulEndpoint(object):
+    """Connects the protocol to a transport, keeping nothing but the transport.
+
+    The transport has no ``protocol`` attribute, as with wrapping transports,
+    so the whole client protocol stays referenced for the tunnel's lifetime.
+
+    """
+
+    def __init__(self):
+        self.transports = []
+
+    def connect(self, fac):
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        transport.wrappedProtocol = proto
+        proto.makeConnection(transport)
+        self.transports.append(transport)
+        return defer.succeed(proto)
+
+
+class TunnelMemoryTestCase(unittest.TestCase):
+    tunnels = 500
+    # On 64-bit CPython 2.7, a tunnel negotiated with the fast parser costs
+    # about 1.6k on top of the connection to the proxy and the proxied
+    # protocol.
+    budget = 2048
+
+    def setUp(self):
+        if platform.python_implementation() != 'CPython':
+            raise unittest.SkipTest('object sizes are only known on CPython')
+
+    def bytesPerConnection(self, connect):
+        kept = []
+        gc.collect()
+        before = set(map(id, gc.get_objects()))
+        for x in xrange(self.tunnels):
+            kept.append(connect())
+        gc.collect()
+        new = sum(
+            sys.getsizeof(o) for o in gc.get_objects() if id(o) not in before)
+        return new / self.tunnels
+
+    def plainConnection(self):
+        proto = IdleProtocol()
+        transport = proto_helpers.StringTransport()
+        transport.wrappedProtocol = proto
+        proto.makeConnection(transport)
+        return transport
+
+    def assertWithinBudget(self, endpoint, proxy, reply):
+        fac = IdleFactory()
+
+        def connect():
+            endpoint.connect(fac)
+            transport = proxy.transports.pop()
+            transport.wrappedProtocol.dataReceived(reply)
+            return transport
+
+        overhead = (
+            self.bytesPerConnection(connect)
+            - self.bytesPerConnection(self.plainConnection))
+        self.assert_(overhead < self.budget, overhead)
+
+    def test_SOCKS5(self):
+        proxy = ForgetfulEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'spam.com', 80, proxy, methods={'login': ('spam', 'eggs')},
+            parser='fast')
+        self.assertWithinBudget(
+            endpoint, proxy, '\x05\x02\x01\x00\x05\x00\x00\x01444422')
+
+    def test_SOCKS4(self):
+        proxy = ForgetfulEndpoint()
+        endpoint = client.SOCKS4ClientEndpoint(
+            '127.0.0.1', 80, proxy, parser='fast')
+        self.assertWithinBudget(
+            endpoint, proxy, '\x00\x5a\x00\x00\x00\x00\x00\x00')
+
+    def test_handshakeStateReleased(self):
+        proxy = ForgetfulEndpoint()
+        proxyFac = client.SOCKS5ClientFactory('spam.com', 80, IdleFactory())
+        d = proxy.connect(proxyFac)
+        proxy.transports[0].wrappedProtocol.dataReceived(
+            '\x05\x00\x05\x00\x00\x01444422')
+        factoryRef = weakref.ref(proxyFac)
+        del proxyFac, d
+        gc.collect()
+        self.assertIdentical(factoryRef(), None)
+
+    def test_methodTablesSharedPerEndpoint(self):
+        proxy = FakeEndpoint()
+        endpoint = client.SOCKS5ClientEndpoint(
+            'spam.com', 80, proxy, methods={'login': ('spam', 'eggs')})
+        endpoint.connect(IdleFactory())
+        first = proxy.factory
+        endpoint.connect(IdleFactory())
+        self.assertIdentical(proxy.factory.methods, first.methods)
+        self.assertEqual(first.methods, {c.AUTH_LOGIN: ('spam', 'eggs')})
+        other = client.SOCKS5ClientEndpoint(
+            'spam.com', 80, proxy, methods={'login': ('spam', 'eggs')})
+        other.connect(IdleFactory())
+        self.assertNotIdentical(proxy.factory.methods, first.methods)
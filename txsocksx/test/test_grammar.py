@@ -49,6 +49,8 @@ class TestGrammar(unittest.TestCase):
         self.assertEqual(parse('\x01'), 'tcp-connect')
         self.assertEqual(parse('\x02'), 'tcp-bind')
         self.assertEqual(parse('\x03'), 'udp-associate')
+        self.assertEqual(parse('\xf0'), 'tor-resolve')
+        self.assertEqual(parse('\xf1'), 'tor-resolve-ptr')
         self.assertRaises(ParseError, parse, '\x00')
         self.assertRaises(ParseError, parse, '\x04')
 
@@ -1,13 +1,19 @@
 # Copyright (c) Aaron Gallagher <_@habnab.it>
 # See COPYING for details.
 
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionRefusedError
 from twisted.python.versions import Version
+from twisted.test import proto_helpers
 from twisted.trial import unittest
 import twisted
 
 from txsocksx.test.util import FakeEndpoint, UppercaseWrapperFactory
+from txsocksx.test.test_client import connectionLostFailure
+from txsocksx.client import SOCKS4ClientEndpoint, SOCKS5ClientEndpoint
 from txsocksx.http import SOCKS4Agent, SOCKS5Agent
-from txsocksx.tls import TLSWrapClientEndpoint
+from txsocksx.metrics import MetricsCollector
+from txsocksx.tls import TLSSessionCache, TLSWrapClientEndpoint
 
 
 if twisted.version < Version('twisted', 12, 1, 0):
@@ -15,6 +21,18 @@ if twisted.version < Version('twisted', 12, 1, 0):
 else:
     skip = None
 
+if (Version('twisted', 12, 1, 0) <= twisted.version
+        < Version('twisted', 21, 0, 0)):
+    poolSkip = None
+    from txsocksx.http import SOCKSHTTPConnectionPool
+else:
+    poolSkip = 'SOCKSHTTPConnectionPool requires Twisted 12.1 to 20.3'
+
+if twisted.version < Version('twisted', 14, 0, 0):
+    sessionSkip = 'TLS session caching requires Twisted 14.0 or newer'
+else:
+    sessionSkip = None
+
 
 class AgentTestCase(unittest.TestCase):
     def setUp(self):
@@ -22,8 +40,8 @@ class AgentTestCase(unittest.TestCase):
         self.agent = self.agentType(None, proxyEndpoint=self.endpoint)
         self.agent._tlsWrapper = self._tlsWrapper
 
-    def _tlsWrapper(self, *a):
-        wrapper = TLSWrapClientEndpoint(*a)
+    def _tlsWrapper(self, *a, **kw):
+        wrapper = TLSWrapClientEndpoint(*a, **kw)
         wrapper._wrapper = UppercaseWrapperFactory
         return wrapper
 
@@ -50,6 +68,90 @@ class TestSOCKS5Agent(AgentTestCase):
         self.assert_('GET /EGGS HTTP/1.1' in request)
         self.assert_('HOST: SPAM.COM' in request)
 
+    def test_defaultPool(self):
+        pool = getattr(self.agent, '_wrappedAgent', self.agent)._pool
+        self.assertIsInstance(pool, SOCKSHTTPConnectionPool)
+        self.assertFalse(pool.persistent)
+
+    test_defaultPool.skip = poolSkip
+
+    def test_metrics(self):
+        metrics = MetricsCollector()
+        agent = self.agentType(
+            None, proxyEndpoint=self.endpoint, metrics=metrics)
+        agent._tlsWrapper = self._tlsWrapper
+        endpoint = agent._getEndpoint('https', 'spam.com', 443)
+        self.assertIdentical(endpoint.metrics, metrics)
+        self.assertIdentical(endpoint.wrappedEndpoint.metrics, metrics)
+        agent.request('GET', 'http://spam.com/eggs')
+        self.assertEqual(metrics.connectsAttempted, 1)
+
+    def test_tlsSessionCache(self):
+        cache = TLSSessionCache(reactor=task.Clock())
+        agent = self.agentType(
+            None, proxyEndpoint=self.endpoint, tlsSessionCache=cache)
+        endpoint = agent._getEndpoint('https', 'spam.com', 443)
+        self.assertIdentical(endpoint.sessionCache, cache)
+        self.assertEqual(
+            endpoint.sessionKey,
+            ('spam.com', 443, endpoint.wrappedEndpoint._proxyIdentity()))
+        endpoint = agent._getEndpoint('http', 'spam.com', 80)
+        self.assertFalse(isinstance(endpoint, TLSWrapClientEndpoint))
+
+    test_tlsSessionCache.skip = sessionSkip
+
+
+class CountingPolicy(object):
+    def __init__(self):
+        self.created = []
+
+    def creatorForNetloc(self, host, port):
+        self.created.append((host, port))
+        return object()
+
+
+class TLSPolicyCacheTestCase(unittest.TestCase):
+    skip = skip
+
+    def setUp(self):
+        self.policy = CountingPolicy()
+        self.agent = SOCKS5Agent(
+            None, proxyEndpoint=FakeEndpoint(), tlsPolicyCacheSize=2)
+        self.agent._policyForHTTPS = self.policy
+
+    def test_cachedPerNetloc(self):
+        first = self.agent._getEndpoint('https', 'spam.com', 443)
+        second = self.agent._getEndpoint('https', 'spam.com', 443)
+        self.agent._getEndpoint('https', 'spam.com', 8443)
+        self.assertIdentical(first.contextFactory, second.contextFactory)
+        self.assertEqual(
+            self.policy.created, [('spam.com', 443), ('spam.com', 8443)])
+
+    def test_bounded(self):
+        for host in 'abc':
+            self.agent._getEndpoint('https', host, 443)
+        self.agent._getEndpoint('https', 'a', 443)
+        self.assertEqual(len(self.policy.created), 4)
+
+    def test_invalidate(self):
+        self.agent._getEndpoint('https', 'spam.com', 443)
+        self.agent._getEndpoint('https', 'eggs.com', 443)
+        self.agent.invalidateTLSPolicies('spam.com', 443)
+        self.agent._getEndpoint('https', 'spam.com', 443)
+        self.agent._getEndpoint('https', 'eggs.com', 443)
+        self.assertEqual(len(self.policy.created), 3)
+        self.agent.invalidateTLSPolicies()
+        self.agent._getEndpoint('https', 'eggs.com', 443)
+        self.assertEqual(len(self.policy.created), 4)
+
+    def test_disabled(self):
+        agent = SOCKS5Agent(
+            None, proxyEndpoint=FakeEndpoint(), tlsPolicyCacheSize=0)
+        agent._policyForHTTPS = self.policy
+        agent._getEndpoint('https', 'spam.com', 443)
+        agent._getEndpoint('https', 'spam.com', 443)
+        self.assertEqual(len(self.policy.created), 2)
+
 
 class TestSOCKS4Agent(AgentTestCase):
     skip = skip
@@ -81,3 +183,161 @@ class TestSOCKS4Agent(AgentTestCase):
         request = received[18:].splitlines()
         self.assert_('GET /EGGS HTTP/1.1' in request)
         self.assert_('HOST: SPAM.COM' in request)
+
+
+class FakeConnection(object):
+    state = 'QUIESCENT'
+
+    def __init__(self):
+        self.transport = proto_helpers.StringTransport()
+
+
+class SOCKSHTTPConnectionPoolTestCase(unittest.TestCase):
+    skip = poolSkip
+    hostKey = 'http', 'spam.com', 80
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = SOCKSHTTPConnectionPool(
+            self.clock, maxPersistentPerProxy=2, cachedConnectionTimeout=30)
+        self.pool.retryAutomatically = False
+        self.newConnections = []
+        self.pool._newConnection = self.newConnection
+        self.proxy = FakeEndpoint()
+        self.endpoint = SOCKS5ClientEndpoint('spam.com', 80, self.proxy)
+
+    def newConnection(self, key, endpoint):
+        self.newConnections.append(key)
+        return defer.Deferred()
+
+    def keyFor(self, endpoint, hostKey=hostKey):
+        self.pool.getConnection(hostKey, endpoint)
+        return self.newConnections.pop()
+
+    def test_keyIncludesProxyAndAuth(self):
+        keys = set([
+            self.keyFor(self.endpoint),
+            self.keyFor(SOCKS5ClientEndpoint('spam.com', 80, FakeEndpoint())),
+            self.keyFor(SOCKS5ClientEndpoint(
+                'spam.com', 80, self.proxy, {'login': ('spam', 'eggs')})),
+            self.keyFor(SOCKS4ClientEndpoint('spam.com', 80, self.proxy)),
+        ])
+        self.assertEqual(len(keys), 4)
+        for key in keys:
+            self.assertEqual(key[:3], self.hostKey)
+
+    def test_keyLooksThroughWrappers(self):
+        wrapped = TLSWrapClientEndpoint(None, self.endpoint)
+        self.assertEqual(self.keyFor(wrapped), self.keyFor(self.endpoint))
+
+    def test_reusedOnlyThroughTheSameProxy(self):
+        connection = FakeConnection()
+        self.pool._putConnection(self.keyFor(self.endpoint), connection)
+        other = SOCKS5ClientEndpoint('spam.com', 80, FakeEndpoint())
+        self.pool.getConnection(self.hostKey, other)
+        self.assertEqual(len(self.newConnections), 1)
+        d = self.pool.getConnection(self.hostKey, self.endpoint)
+        self.assertIdentical(self.successResultOf(d), connection)
+
+    def test_maxPersistentPerProxy(self):
+        connections = []
+        for port in xrange(3):
+            key = self.keyFor(self.endpoint, ('http', 'spam.com', port))
+            connection = FakeConnection()
+            connections.append(connection)
+            self.pool._putConnection(key, connection)
+            self.clock.advance(1)
+        otherKey = self.keyFor(
+            SOCKS5ClientEndpoint('spam.com', 80, FakeEndpoint()))
+        otherConnection = FakeConnection()
+        self.pool._putConnection(otherKey, otherConnection)
+        self.assertEqual(
+            [c.transport.disconnecting for c in connections],
+            [True, False, False])
+        self.assertFalse(otherConnection.transport.disconnecting)
+        self.assertEqual(len(self.pool._timeouts), 3)
+
+    def test_idleTimeout(self):
+        connection = FakeConnection()
+        self.pool._putConnection(self.keyFor(self.endpoint), connection)
+        self.clock.advance(30)
+        self.assert_(connection.transport.disconnecting)
+        self.assertEqual(self.pool._timeouts, {})
+
+    def test_agentUsesPool(self):
+        agent = SOCKS5Agent(
+            self.clock, proxyEndpoint=self.proxy, pool=self.pool)
+        agent.request('GET', 'http://spam.com/eggs')
+        [key] = self.newConnections
+        self.assertEqual(key, self.keyFor(self.endpoint))
+
+
+class CoalescingPoolTestCase(unittest.TestCase):
+    skip = poolSkip
+    grantedReply = '\x05\x00\x05\x00\x00\x01444422'
+    response = 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxy = FakeEndpoint()
+        self.pool = SOCKSHTTPConnectionPool(
+            self.clock, maxConnectionsPerHost=1)
+        self.agent = SOCKS5Agent(
+            self.clock, proxyEndpoint=self.proxy, pool=self.pool)
+
+    def test_requestsShareOneHandshake(self):
+        ds = [self.agent.request('GET', 'http://spam.com/%d' % (x,))
+              for x in xrange(3)]
+        self.proxy.proto.dataReceived(self.grantedReply)
+        for x in xrange(3):
+            self.proxy.proto.dataReceived(self.response)
+            self.clock.advance(0)
+        self.assertEqual(len(self.proxy.connections), 1)
+        self.assertEqual(
+            [self.successResultOf(d).code for d in ds], [200, 200, 200])
+        requests = self.proxy.transport.value().count('GET /')
+        self.assertEqual(requests, 3)
+        self.assertEqual(self.pool.coalesced, 2)
+
+    def test_otherHostsNotLimited(self):
+        self.agent.request('GET', 'http://spam.com/')
+        self.agent.request('GET', 'http://eggs.com/')
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.assertEqual(self.pool.coalesced, 0)
+
+    def test_failureShared(self):
+        self.proxy.deferred = defer.Deferred()
+        ds = [self.agent.request('GET', 'http://spam.com/%d' % (x,))
+              for x in xrange(3)]
+        self.proxy.deferred.errback(ConnectionRefusedError())
+        for d in ds:
+            self.failureResultOf(d)
+        self.assertEqual(self.pool.sharedFailures, 2)
+        self.assertEqual(self.pool._waiting, {})
+        self.assertEqual(self.pool._connecting, {})
+
+    def test_lostConnectionServesWaiting(self):
+        first = self.agent.request('GET', 'http://spam.com/')
+        second = self.agent.request('GET', 'http://spam.com/')
+        self.proxy.proto.dataReceived(self.grantedReply)
+        self.proxy.proto.connectionLost(connectionLostFailure)
+        self.failureResultOf(first)
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.proxy.proto.dataReceived(self.grantedReply)
+        self.proxy.proto.dataReceived(self.response)
+        self.assertEqual(self.successResultOf(second).code, 200)
+
+    def test_cancelWaiting(self):
+        self.agent.request('GET', 'http://spam.com/')
+        waiting = self.agent.request('GET', 'http://spam.com/')
+        waiting.cancel()
+        self.failureResultOf(waiting, defer.CancelledError)
+        self.assertEqual(self.pool._waiting, {})
+
+    def test_invalidLimits(self):
+        self.assertRaises(
+            ValueError, SOCKSHTTPConnectionPool, self.clock,
+            maxConnectionsPerHost=0)
+        self.assertRaises(
+            ValueError, SOCKSHTTPConnectionPool, self.clock,
+            persistent=False, maxConnectionsPerHost=1)
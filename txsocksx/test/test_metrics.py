@@ -0,0 +1,204 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import error, interfaces, protocol, task
+from twisted.python import failure
+from zope.interface import directlyProvides
+
+from txsocksx.test.util import (
+    FakeEndpoint, SyncDeferredsTestCase, UppercaseWrapperFactory)
+from txsocksx import client, errors
+from txsocksx.metrics import Histogram, MetricsCollector, failureReasons
+from txsocksx.tls import TLSWrapClientEndpoint
+
+
+class Accumulator(protocol.Protocol):
+    def __init__(self):
+        self.data = ''
+        self.lost = None
+
+    def dataReceived(self, data):
+        self.data += data
+
+    def connectionLost(self, reason):
+        self.lost = reason
+
+
+class AccumulatorFactory(protocol.ClientFactory):
+    protocol = Accumulator
+
+
+class HistogramTestCase(SyncDeferredsTestCase):
+    def test_observe(self):
+        histogram = Histogram([1, 0.5, 2])
+        for value in [0.1, 0.5, 0.7, 2, 3, 30]:
+            histogram.observe(value)
+        self.assertEqual(histogram.buckets, (0.5, 1, 2))
+        self.assertEqual(histogram.counts, [2, 1, 1, 2])
+        self.assertEqual(histogram.count, 6)
+        self.assertAlmostEqual(histogram.sum, 36.3)
+
+
+class MetricsCollectorTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.metrics = MetricsCollector(latencyBuckets=[0.1, 1])
+
+    def test_failuresPreallocated(self):
+        self.assertEqual(
+            self.metrics.failures, dict.fromkeys(failureReasons, 0))
+        self.assertIn('HostUnreachable', failureReasons)
+        self.assertIn('IdentdMismatch', failureReasons)
+
+    def test_handshakeFinished(self):
+        self.metrics.handshakeFinished('proto', 0.5)
+        reasons = [
+            errors.HostUnreachable(), errors.HandshakeTimeout('auth'),
+            error.ConnectionRefusedError(), ValueError()]
+        for reason in reasons:
+            f = failure.Failure(reason)
+            self.assertIdentical(self.metrics.handshakeFinished(f, 9), f)
+        self.assertEqual(self.metrics.connectsSucceeded, 1)
+        self.assertEqual(self.metrics.connectsFailed, 4)
+        self.assertEqual(self.metrics.handshakeLatency.counts, [0, 1, 0])
+        failures = self.metrics.failures
+        self.assertEqual(failures['HostUnreachable'], 1)
+        self.assertEqual(failures['HandshakeTimeout'], 1)
+        self.assertEqual(failures['ConnectError'], 1)
+        self.assertEqual(failures['other'], 1)
+
+    def test_exposition(self):
+        self.metrics.handshakeStarted()
+        self.metrics.handshakeFinished('proto', 0.05)
+        self.metrics.handshakeFinished('proto', 2)
+        self.metrics.handshakeFinished(
+            failure.Failure(errors.ConnectionRefused()), 0)
+        self.metrics.tunnelOpened()
+        self.metrics.bytesSent += 10
+        lines = self.metrics.exposition(prefix='spam').splitlines()
+        for expected in [
+                '# TYPE spam_connects_attempted_total counter',
+                'spam_connects_attempted_total 1',
+                'spam_connect_failures_total{reason="ConnectionRefused"} 1',
+                'spam_connect_failures_total{reason="TTLExpired"} 0',
+                '# TYPE spam_handshake_seconds histogram',
+                'spam_handshake_seconds_bucket{le="0.1"} 1',
+                'spam_handshake_seconds_bucket{le="1.0"} 1',
+                'spam_handshake_seconds_bucket{le="+Inf"} 2',
+                'spam_handshake_seconds_sum 2.05',
+                'spam_handshake_seconds_count 2',
+                '# TYPE spam_open_tunnels gauge',
+                'spam_open_tunnels 1',
+                'spam_sent_bytes_total 10']:
+            self.assertIn(expected, lines)
+        for line in lines:
+            if not line.startswith('#'):
+                self.assertEqual(len(line.split(' ')), 2)
+
+
+class EndpointMetricsTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(client, '_now', self.clock.seconds)
+        self.metrics = MetricsCollector()
+        self.proxy = FakeEndpoint()
+
+    def test_SOCKS5Tunnel(self):
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, self.proxy, metrics=self.metrics)
+        d = endpoint.connect(AccumulatorFactory())
+        self.assertEqual(self.metrics.connectsAttempted, 1)
+        self.clock.advance(0.2)
+        self.proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422spam')
+        proto = self.successResultOf(d)
+        self.assertEqual(self.metrics.connectsSucceeded, 1)
+        self.assertEqual(self.metrics.handshakeLatency.sum, 0.2)
+        self.assertEqual(self.metrics.openTunnels, 1)
+
+        self.proxy.proto.dataReceived('eggs')
+        self.proxy.transport.clear()
+        proto.transport.write('ham')
+        proto.transport.writeSequence(['a', 'bc'])
+        self.assertEqual(proto.data, 'spameggs')
+        self.assertEqual(self.proxy.transport.value(), 'hamabc')
+        self.assertEqual(self.metrics.bytesReceived, 8)
+        self.assertEqual(self.metrics.bytesSent, 6)
+
+        reason = failure.Failure(error.ConnectionDone())
+        self.proxy.proto.connectionLost(reason)
+        self.assertIdentical(proto.lost, reason)
+        self.assertEqual(self.metrics.openTunnels, 0)
+
+    def test_transportInterfaces(self):
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, self.proxy, metrics=self.metrics)
+        d = endpoint.connect(AccumulatorFactory())
+        directlyProvides(self.proxy.transport, interfaces.ITLSTransport)
+        self.proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422')
+        transport = self.successResultOf(d).transport
+        self.assertIsInstance(transport, client._MeteredTransport)
+        for iface in [interfaces.ITLSTransport, interfaces.IConsumer,
+                      interfaces.IPushProducer]:
+            self.assert_(iface.providedBy(transport), iface)
+        self.assert_(interfaces.ITransport.providedBy(
+            client._MeteredTransport(object(), self.metrics)))
+
+    def test_SOCKS5EarlyData(self):
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, self.proxy, optimistic=True, earlyData=True,
+            metrics=self.metrics)
+        proto = self.successResultOf(endpoint.connect(AccumulatorFactory()))
+        proto.transport.write('early')
+        self.assertEqual(self.metrics.bytesSent, 5)
+        self.proxy.proto.dataReceived('\x05\x00\x05\x00\x00\x01444422spam')
+        self.assertEqual(proto.data, 'spam')
+        self.assertEqual(self.metrics.bytesReceived, 4)
+        self.proxy.proto.connectionLost(
+            failure.Failure(error.ConnectionDone()))
+        self.assertEqual(self.metrics.openTunnels, 0)
+
+    def test_SOCKS5ReplyCode(self):
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, self.proxy, metrics=self.metrics)
+        d = endpoint.connect(AccumulatorFactory())
+        self.proxy.proto.dataReceived('\x05\x00\x05\x04\x00\x01444422')
+        self.failureResultOf(d, errors.HostUnreachable)
+        self.assertEqual(self.metrics.connectsFailed, 1)
+        self.assertEqual(self.metrics.failures['HostUnreachable'], 1)
+        self.assertEqual(self.metrics.handshakeLatency.count, 0)
+        self.assertEqual(self.metrics.openTunnels, 0)
+
+    def test_proxyUnreachable(self):
+        proxy = FakeEndpoint(
+            failure=failure.Failure(error.ConnectionRefusedError()))
+        endpoint = client.SOCKS5ClientEndpoint(
+            'host', 0x47, proxy, metrics=self.metrics)
+        d = endpoint.connect(AccumulatorFactory())
+        self.failureResultOf(d, error.ConnectionRefusedError)
+        self.assertEqual(self.metrics.failures['ConnectError'], 1)
+
+    def test_SOCKS4(self):
+        endpoint = client.SOCKS4ClientEndpoint(
+            '127.0.0.1', 0x47, self.proxy, metrics=self.metrics)
+        d = endpoint.connect(AccumulatorFactory())
+        self.proxy.proto.dataReceived('\x00\x5b\x00\x00\x00\x00\x00\x00')
+        self.failureResultOf(d, errors.RequestRejectedOrFailed)
+        self.assertEqual(self.metrics.failures['RequestRejectedOrFailed'], 1)
+
+        d = endpoint.connect(AccumulatorFactory())
+        self.proxy.proto.dataReceived('\x00\x5a\x00\x00\x00\x00\x00\x00')
+        self.successResultOf(d)
+        self.assertEqual(self.metrics.connectsAttempted, 2)
+        self.assertEqual(self.metrics.openTunnels, 1)
+
+    def test_TLSWrapClientEndpoint(self):
+        wrapper = TLSWrapClientEndpoint(
+            object(), FakeEndpoint(failure=failure.Failure(FakeError())),
+            metrics=self.metrics)
+        wrapper._wrapper = UppercaseWrapperFactory
+        self.failureResultOf(wrapper.connect(AccumulatorFactory()), FakeError)
+        self.assertEqual(self.metrics.tlsConnectsAttempted, 1)
+        self.assertEqual(self.metrics.tlsConnectsFailed, 1)
+
+
+class FakeError(Exception):
+    pass
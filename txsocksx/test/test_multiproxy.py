@@ -0,0 +1,205 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionRefusedError
+
+from txsocksx.client import SOCKS4ClientEndpoint, SOCKS5ClientEndpoint
+from txsocksx.multiproxy import ProxyPool, RacingSOCKSClientEndpoint
+from txsocksx.test.util import FakeEndpoint, SyncDeferredsTestCase
+from txsocksx.test.test_client import FakeFactory, connectionRefusedFailure
+from txsocksx import errors
+
+
+grantedReply = '\x05\x00\x05\x00\x00\x01444422'
+
+
+class RacingSOCKSClientEndpointTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxies = [FakeEndpoint() for x in xrange(3)]
+
+    def makeEndpoint(self, **kw):
+        return RacingSOCKSClientEndpoint(
+            'spam.com', 80, self.proxies, delay=1, reactor=self.clock, **kw)
+
+    def test_staggeredStarts(self):
+        self.makeEndpoint().connect(FakeFactory())
+        self.assertEqual([len(p.connections) for p in self.proxies], [1, 0, 0])
+        self.clock.advance(1)
+        self.assertEqual([len(p.connections) for p in self.proxies], [1, 1, 0])
+        self.clock.advance(1)
+        self.assertEqual([len(p.connections) for p in self.proxies], [1, 1, 1])
+
+    def test_firstGrantedWins(self):
+        wrappedFac = FakeFactory()
+        d = self.makeEndpoint().connect(wrappedFac)
+        self.clock.advance(1)
+        self.proxies[1].proto.dataReceived(grantedReply + 'xxxxx')
+        self.assertIdentical(self.successResultOf(d), wrappedFac.proto)
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+        # the slow negotiation was canceled and no more were started
+        self.assert_(self.proxies[0].aborted)
+        self.assertFalse(self.proxies[1].aborted)
+        self.clock.advance(5)
+        self.assertEqual(len(self.proxies[2].connections), 0)
+
+    def test_failureStartsNextImmediately(self):
+        self.makeEndpoint().connect(FakeFactory())
+        self.proxies[0].proto.dataReceived('\x05\x00\x05\x05\x00\x01444422')
+        self.assertEqual([len(p.connections) for p in self.proxies], [1, 1, 0])
+
+    def test_allFail(self):
+        for proxy in self.proxies:
+            proxy.failure = connectionRefusedFailure
+        d = self.makeEndpoint().connect(FakeFactory())
+        self.failureResultOf(d, ConnectionRefusedError)
+
+    def test_lastFailureReported(self):
+        d = self.makeEndpoint().connect(FakeFactory())
+        self.clock.advance(2)
+        self.proxies[0].proto.dataReceived('\x05\x00\x05\x05\x00\x01444422')
+        self.proxies[2].proto.dataReceived('\x05\x00\x05\x04\x00\x01444422')
+        self.assertNoResult(d)
+        self.proxies[1].proto.dataReceived('\x05\x00\x05\x03\x00\x01444422')
+        self.failureResultOf(d, errors.NetworkUnreachable)
+
+    def test_cancellation(self):
+        d = self.makeEndpoint().connect(FakeFactory())
+        self.clock.advance(1)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assert_(self.proxies[0].aborted)
+        self.assert_(self.proxies[1].aborted)
+        self.clock.advance(5)
+        self.assertEqual(len(self.proxies[2].connections), 0)
+
+    def test_endpointFactory(self):
+        self.proxies = self.proxies[:1]
+        self.makeEndpoint(
+            endpointFactory=SOCKS4ClientEndpoint,
+            endpointArgs={'user': 'spam'}).connect(FakeFactory())
+        self.assertEqual(self.proxies[0].transport.value(),
+                         '\x04\x01\x00\x50\x00\x00\x00\x01spam\x00spam.com\x00')
+
+    def test_noProxies(self):
+        self.assertRaises(
+            ValueError, RacingSOCKSClientEndpoint, 'spam.com', 80, [])
+
+
+class ProxyPoolTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxies = [FakeEndpoint() for x in xrange(3)]
+
+    def makePool(self, **kw):
+        self.pool = ProxyPool(self.proxies, reactor=self.clock, **kw)
+        return SOCKS5ClientEndpoint('spam.com', 80, self.pool)
+
+    def counts(self):
+        return [len(p.connections) for p in self.proxies]
+
+    def test_leastOutstanding(self):
+        endpoint = self.makePool()
+        for x in xrange(3):
+            endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1, 1, 1])
+        self.proxies[1].proto.dataReceived(grantedReply)
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1, 2, 1])
+
+    def test_ewma(self):
+        endpoint = self.makePool(strategy='ewma')
+        for proxy, delay in zip(self.proxies, [6, 1, 1.5]):
+            endpoint.connect(FakeFactory())
+            self.clock.advance(delay)
+            proxy.proto.dataReceived(grantedReply)
+        self.assertEqual(self.counts(), [1, 1, 1])
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1, 2, 1])
+        # with one negotiation in progress, the next fastest is preferred
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1, 2, 2])
+
+    def test_unhealthyAfterRepeatedFailures(self):
+        self.proxies[0].failure = connectionRefusedFailure
+        endpoint = self.makePool(maxFailures=2, retryAfter=10)
+        for x in xrange(2):
+            d = endpoint.connect(FakeFactory())
+            self.failureResultOf(d, ConnectionRefusedError)
+        self.assertFalse(self.pool.healthy(self.proxies[0]))
+        for x in xrange(4):
+            endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [0, 2, 2])
+
+    def test_SOCKSErrorsCount(self):
+        self.proxies = self.proxies[:1]
+        endpoint = self.makePool(maxFailures=1)
+        d = endpoint.connect(FakeFactory())
+        self.proxies[0].proto.dataReceived('\x05\x00\x05\x01\x00\x01444422')
+        self.failureResultOf(d, errors.ServerFailure)
+        self.assertFalse(self.pool.healthy(self.proxies[0]))
+
+    def test_cancellationDoesNotCount(self):
+        self.proxies = self.proxies[:1]
+        endpoint = self.makePool(maxFailures=1)
+        d = endpoint.connect(FakeFactory())
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assert_(self.pool.healthy(self.proxies[0]))
+
+    def test_timeoutsCount(self):
+        self.proxies = self.proxies[:1]
+        self.pool = ProxyPool(self.proxies, maxFailures=2, reactor=self.clock)
+        endpoint = SOCKS5ClientEndpoint(
+            'spam.com', 80, self.pool, timeouts={'total': 1},
+            reactor=self.clock)
+        # one stalls while connecting, the other after connecting
+        self.proxies[0].deferred = defer.Deferred()
+        d = endpoint.connect(FakeFactory())
+        self.clock.advance(1)
+        self.failureResultOf(d, errors.HandshakeTimeout)
+        self.assert_(self.pool.healthy(self.proxies[0]))
+        self.proxies[0].deferred = None
+        d = endpoint.connect(FakeFactory())
+        self.clock.advance(1)
+        self.failureResultOf(d, errors.HandshakeTimeout)
+        self.assertFalse(self.pool.healthy(self.proxies[0]))
+
+    def test_probedBackIn(self):
+        self.proxies[0].failure = connectionRefusedFailure
+        endpoint = self.makePool(maxFailures=1, retryAfter=10)
+        self.failureResultOf(endpoint.connect(FakeFactory()), ConnectionRefusedError)
+        self.clock.advance(10)
+        self.proxies[0].failure = None
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1, 0, 0])
+        # only one probe at a time
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1, 1, 0])
+        self.proxies[0].proto.dataReceived(grantedReply)
+        self.assert_(self.pool.healthy(self.proxies[0]))
+
+    def test_failedProbe(self):
+        self.proxies = self.proxies[:2]
+        self.proxies[0].failure = connectionRefusedFailure
+        endpoint = self.makePool(maxFailures=1, retryAfter=10)
+        self.failureResultOf(endpoint.connect(FakeFactory()), ConnectionRefusedError)
+        self.clock.advance(10)
+        self.failureResultOf(endpoint.connect(FakeFactory()), ConnectionRefusedError)
+        self.clock.advance(5)
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [0, 1])
+
+    def test_allUnhealthy(self):
+        self.proxies = self.proxies[:1]
+        self.proxies[0].failure = connectionRefusedFailure
+        endpoint = self.makePool(maxFailures=1)
+        self.failureResultOf(endpoint.connect(FakeFactory()), ConnectionRefusedError)
+        self.proxies[0].failure = None
+        endpoint.connect(FakeFactory())
+        self.assertEqual(self.counts(), [1])
+
+    def test_invalidArguments(self):
+        self.assertRaises(ValueError, ProxyPool, [])
+        self.assertRaises(ValueError, ProxyPool, self.proxies, strategy='spam')
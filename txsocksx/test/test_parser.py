@@ -0,0 +1,174 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+import itertools
+import random
+
+from parsley import makeProtocol
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txsocksx import grammar, parser
+
+
+class RecordingSender(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+
+class RecordingReceiver(object):
+    """A receiver which records every rule action it sees.
+
+    After the first action, the receiver moves into ``SOCKSState_readData`` so
+    that trailing bytes are recorded too.
+
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.actions = []
+        self.data = ''
+        self.error = None
+
+    def prepareParsing(self, parser):
+        pass
+
+    def finishParsing(self, reason):
+        if not reason.check(ConnectionDone):
+            self.error = reason
+
+    def dataReceived(self, data):
+        self.data += data
+
+    def _record(self, name, *args):
+        self.actions.append((name, args))
+        self.currentRule = 'SOCKSState_readData'
+
+    def serverResponse(self, *args):
+        self._record('serverResponse', *args)
+
+    def authSelected(self, *args):
+        self._record('authSelected', *args)
+
+    def loginResponse(self, *args):
+        self._record('loginResponse', *args)
+
+
+def receiverForRule(rule):
+    return type('Receiver', (RecordingReceiver,), {'currentRule': rule})
+
+
+def parseWith(protoFactory, data, chunkSize):
+    proto = protoFactory()
+    transport = proto_helpers.StringTransport()
+    transport.abortConnection = lambda: None
+    proto.makeConnection(transport)
+    for x in xrange(0, len(data), chunkSize):
+        proto.dataReceived(data[x:x + chunkSize])
+    proto.connectionLost(failure.Failure(ConnectionDone()))
+    receiver = proto.receiver
+    return receiver.actions, receiver.data, receiver.error is not None
+
+
+def addressBodies():
+    yield '\x01\x7f\x00\x00\x01'
+    yield '\x01\xff\xff\xff\xff'
+    yield '\x03\x00'
+    yield '\x03\x0bexample.com'
+    yield '\x04' + '\x00' * 15 + '\x01'
+    yield '\x04\xfe\x80' + '\x00' * 13 + '\x01'
+    for atyp in '\x00\x02\x05\xff':
+        yield atyp + '\x01\x02\x03\x04'
+
+
+def socks5Responses():
+    for ver, status, rsv in itertools.product(
+            '\x04\x05\x00', '\x00\x01\x08\xff', '\x00\x01'):
+        for address in addressBodies():
+            yield ver + status + rsv + address + '\x01\xbb'
+
+
+def socks4Responses():
+    for null, status in itertools.product('\x00\x04', '\x00\x5a\x5b\x5d'):
+        yield null + status + '\x00\x50\x7f\x00\x00\x01'
+        yield null + status + '\xff' * 6
+
+
+def socks5AuthSelections():
+    for first, second in itertools.product('\x00\x04\x05\xff', '\x00\x02\xff'):
+        yield first + second
+
+
+def socks5LoginResponses():
+    for first, second in itertools.product('\x00\x01\x05', '\x00\x01\xff'):
+        yield first + second
+
+
+class DifferentialTestCase(unittest.TestCase):
+    """
+    The fast parsers agree with the reference grammar on every reply.
+
+    For each reply, every prefix and the reply followed by trailing data is
+    fed to both parsers in several chunkings, and the receiver actions, the
+    data passed through, and whether parsing failed must all be identical.
+    """
+
+    def assertAgree(self, rule, replies):
+        receiver = receiverForRule(rule)
+        reference = makeProtocol(
+            grammar.grammarSource, RecordingSender, receiver, grammar.bindings)
+        fast = parser.makeFastProtocol(RecordingSender, receiver)
+        checked = 0
+        for reply in replies:
+            candidates = [reply[:x] for x in xrange(len(reply))]
+            candidates.append(reply + 'trailing data')
+            for data, chunkSize in itertools.product(candidates, (1, 3, 1024)):
+                expected = parseWith(reference, data, chunkSize)
+                self.assertEqual(
+                    parseWith(fast, data, chunkSize), expected,
+                    '%s disagreed on %r in chunks of %d' % (
+                        rule, data, chunkSize))
+                checked += 1
+        self.assert_(checked)
+
+    def test_SOCKS4Response(self):
+        self.assertAgree('SOCKS4ClientState_initial', socks4Responses())
+
+    def test_SOCKS5ServerAuthSelection(self):
+        self.assertAgree('SOCKS5ClientState_initial', socks5AuthSelections())
+
+    def test_SOCKS5ServerLoginResponse(self):
+        self.assertAgree(
+            'SOCKS5ClientState_readLoginResponse', socks5LoginResponses())
+
+    def test_SOCKS5ServerResponse(self):
+        self.assertAgree('SOCKS5ClientState_readResponse', socks5Responses())
+
+    def test_randomReplies(self):
+        rng = random.Random(0x50c5)
+        for rule in parser.clientRules:
+            replies = [
+                ''.join(chr(rng.choice([0, 1, 3, 4, 5, 0x5a, rng.randrange(256)]))
+                        for x in xrange(rng.randrange(1, 24)))
+                for y in xrange(40)]
+            self.assertAgree(rule, replies)
+
+
+class FastParserProtocolTestCase(unittest.TestCase):
+    def test_unknownRule(self):
+        receiver = receiverForRule('spam')
+        actions, data, failed = parseWith(
+            parser.makeFastProtocol(RecordingSender, receiver), 'x', 1)
+        self.assert_(failed)
+
+    def test_parserErrors(self):
+        self.assertRaises(
+            parser.e.ParsingError, parser.parseSOCKS5ServerResponse, '\x04', 0)
+        self.assertRaises(
+            parser.e.ParsingError, parser.parseSOCKS4Response, '\x01', 0)
+
+    def test_incompleteReplies(self):
+        self.assertEqual(parser.parseSOCKS5ServerResponse('\x05\x00\x00', 0), None)
+        self.assertEqual(parser.parseSOCKS4Response('\x00\x5a', 0), None)
@@ -0,0 +1,254 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+
+from txsocksx.client import SOCKS4ClientEndpoint, SOCKS5ClientEndpoint
+from txsocksx.pool import (
+    PrewarmedProxyConnections, SOCKSConnectionPool, _WarmTunnel)
+from txsocksx.test.util import FakeEndpoint, SyncDeferredsTestCase
+from txsocksx import errors
+from txsocksx.test.test_client import FakeFactory, connectionLostFailure
+
+
+grantedReply = '\x05\x00\x05\x00\x00\x01444422'
+
+
+class SOCKSConnectionPoolTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxy = FakeEndpoint()
+        self.endpoint = SOCKS5ClientEndpoint('spam.com', 80, self.proxy)
+        self.pool = SOCKSConnectionPool(self.clock, size=2, idleTimeout=30)
+        self.addCleanup(self.pool.close)
+
+    def grantAll(self):
+        for proto, transport in self.proxy.connections:
+            if proto.receiver.otherProtocol is None:
+                proto.dataReceived(grantedReply)
+                transport.clear()
+
+    def test_missOpensFreshConnection(self):
+        wrappedFac = FakeFactory()
+        d = self.pool.connect(self.endpoint, wrappedFac)
+        self.assertEqual(self.pool.misses, 1)
+        self.assertEqual(len(self.proxy.connections), 3)
+        self.proxy.connections[0][0].dataReceived(grantedReply)
+        self.assertIdentical(self.successResultOf(d), wrappedFac.proto)
+
+    def test_hitUsesWarmTunnel(self):
+        self.pool.prime(self.endpoint)
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.grantAll()
+        wrappedFac = FakeFactory()
+        d = self.pool.connect(self.endpoint, wrappedFac)
+        proto = self.successResultOf(d)
+        self.assertIdentical(proto, wrappedFac.proto)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 0))
+        # one new tunnel was opened to replace the one handed out
+        self.assertEqual(len(self.proxy.connections), 3)
+
+        socksProto, transport = self.proxy.connections[1]
+        proto.transport.write('xxxxx')
+        self.assertEqual(transport.value(), 'xxxxx')
+        socksProto.dataReceived('yyyyy')
+        self.assertEqual(proto.data, 'yyyyy')
+
+    def test_dataBufferedWhileIdle(self):
+        self.pool.prime(self.endpoint)
+        self.grantAll()
+        socksProto, transport = self.proxy.connections[1]
+        socksProto.dataReceived('banner')
+        wrappedFac = FakeFactory()
+        proto = self.successResultOf(self.pool.connect(self.endpoint, wrappedFac))
+        self.assertEqual(proto.data, 'banner')
+
+    def test_keyedOnDestinationAndAuth(self):
+        self.pool.prime(self.endpoint)
+        self.grantAll()
+        other = SOCKS5ClientEndpoint(
+            'spam.com', 80, self.proxy, methods={'login': ('spam', 'eggs')})
+        self.pool.connect(other, FakeFactory())
+        self.assertEqual((self.pool.hits, self.pool.misses), (0, 1))
+        other = SOCKS4ClientEndpoint('spam.com', 80, self.proxy)
+        self.pool.connect(other, FakeFactory())
+        self.assertEqual((self.pool.hits, self.pool.misses), (0, 2))
+
+    def test_idleEviction(self):
+        self.pool.prime(self.endpoint)
+        self.grantAll()
+        self.clock.advance(25)
+        self.assertEqual(self.pool.evictions, 0)
+        self.clock.advance(10)
+        self.assertEqual(self.pool.evictions, 2)
+        for proto, transport in self.proxy.connections:
+            self.assert_(transport.disconnecting)
+        self.pool.connect(self.endpoint, FakeFactory())
+        self.assertEqual(self.pool.misses, 1)
+
+    def test_lostIdleTunnelIsDropped(self):
+        self.pool.prime(self.endpoint)
+        self.grantAll()
+        for proto, transport in self.proxy.connections:
+            proto.connectionLost(connectionLostFailure)
+        self.pool.connect(self.endpoint, FakeFactory())
+        self.assertEqual((self.pool.hits, self.pool.misses), (0, 1))
+
+    def test_failedTunnelIsNotPooled(self):
+        self.proxy.deferred = defer.Deferred()
+        self.pool.prime(self.endpoint)
+        self.proxy.deferred.errback(connectionLostFailure)
+        self.proxy.deferred = None
+        self.pool.connect(self.endpoint, FakeFactory())
+        self.assertEqual(self.pool.misses, 1)
+
+    def test_failedTunnelIsCounted(self):
+        self.proxy.failure = connectionLostFailure
+        self.pool.prime(self.endpoint)
+        self.assertEqual(self.pool.failures, 2)
+        self.assertEqual(self.pool._pending, {})
+
+    def test_closeCancelsPendingTunnels(self):
+        self.pool.prime(self.endpoint)
+        self.pool.close()
+        self.assertEqual(len(self.proxy.aborted), 2)
+        self.assertEqual(self.pool._pending, {})
+        self.assertEqual(self.pool.failures, 0)
+
+    def test_tunnelFinishedAfterClose(self):
+        self.pool.close()
+        tunnel = _WarmTunnel(self.pool, 'key')
+        tunnel.makeConnection(proto_helpers.StringTransport())
+        self.pool._tunnelFinished(tunnel, 'key', None)
+        self.assert_(tunnel.transport.disconnecting)
+        self.assertEqual(self.pool._idle, {})
+
+    def test_noReplenishAfterClose(self):
+        self.pool.close()
+        self.pool.connect(self.endpoint, FakeFactory())
+        self.assertEqual(len(self.proxy.connections), 1)
+
+    def test_noProtocolFromFactory(self):
+        self.pool.prime(self.endpoint)
+        self.grantAll()
+        d = self.pool.connect(self.endpoint, FakeFactory(returnNoProtocol=True))
+        self.failureResultOf(d, defer.CancelledError)
+        self.assert_(self.proxy.connections[1][1].disconnecting)
+
+    def test_endpointFor(self):
+        self.pool.prime(self.endpoint)
+        self.grantAll()
+        wrappedFac = FakeFactory()
+        endpoint = self.pool.endpointFor(self.endpoint)
+        self.assertIdentical(
+            self.successResultOf(endpoint.connect(wrappedFac)), wrappedFac.proto)
+        self.assertEqual(self.pool.hits, 1)
+
+
+class PrewarmedProxyConnectionsTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.proxy = FakeEndpoint()
+        self.methods = {'login': ('spam', 'eggs')}
+        self.prewarmed = PrewarmedProxyConnections(
+            self.proxy, self.methods, size=1)
+        self.endpoint = SOCKS5ClientEndpoint(
+            'spam.com', 80, self.proxy, self.methods,
+            prewarmed=self.prewarmed)
+
+    def authenticate(self):
+        self.prewarmed.start()
+        proto, transport = self.proxy.connections[-1]
+        self.assertEqual(transport.value(), '\x05\x01\x02')
+        proto.dataReceived('\x05\x02')
+        self.assertEqual(transport.value(), '\x05\x01\x02\x01\x04spam\x04eggs')
+        proto.dataReceived('\x01\x00')
+        transport.clear()
+        return proto, transport
+
+    def test_onlyRequestSentOnConnect(self):
+        proto, transport = self.authenticate()
+        self.assertEqual(transport.value(), '')
+        wrappedFac = FakeFactory()
+        d = self.endpoint.connect(wrappedFac)
+        self.assertEqual(transport.value(),
+                         '\x05\x01\x00\x03\x08spam.com\x00\x50')
+        self.assertEqual(self.prewarmed.hits, 1)
+        proto.dataReceived('\x05\x00\x00\x01444422xxxxx')
+        self.assertIdentical(self.successResultOf(d), wrappedFac.proto)
+        self.assertEqual(wrappedFac.proto.data, 'xxxxx')
+        # a replacement was opened
+        self.assertEqual(len(self.proxy.connections), 2)
+
+    def test_rejectedRequest(self):
+        proto, transport = self.authenticate()
+        d = self.endpoint.connect(FakeFactory())
+        proto.dataReceived('\x05\x05\x00\x01444422')
+        self.failureResultOf(d, errors.ConnectionRefused)
+
+    def test_missFallsBackToFullNegotiation(self):
+        wrappedFac = FakeFactory()
+        d = self.endpoint.connect(wrappedFac)
+        self.assertEqual(self.prewarmed.misses, 1)
+        proto, transport = self.proxy.connections[0]
+        self.assertEqual(transport.value(), '\x05\x01\x02')
+        self.assertNoResult(d)
+
+    def test_lostWhileIdle(self):
+        proto, transport = self.authenticate()
+        proto.connectionLost(connectionLostFailure)
+        self.assertIdentical(self.prewarmed.take(), None)
+
+    def test_lostWhileIdleIsReplaced(self):
+        proto, transport = self.authenticate()
+        proto.connectionLost(connectionLostFailure)
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.authenticate()
+        self.assertNotIdentical(self.prewarmed.take(), None)
+
+    def test_closeWhileNegotiating(self):
+        self.prewarmed.start()
+        self.prewarmed.close()
+        self.assertEqual(self.proxy.aborted, [True])
+        self.assertEqual(self.prewarmed._pending, [])
+        self.prewarmed.start()
+        self.assertEqual(len(self.proxy.connections), 1)
+
+    def test_closeClosesReady(self):
+        proto, transport = self.authenticate()
+        self.prewarmed.close()
+        self.assert_(transport.disconnecting)
+        self.assertIdentical(self.prewarmed.take(), None)
+        self.assertEqual(len(self.proxy.connections), 1)
+
+    def test_dataWhileIdleIsAnError(self):
+        proto, transport = self.authenticate()
+        proto.dataReceived('\x05')
+        self.assertIdentical(self.prewarmed.take(), None)
+
+    def test_authenticationFailure(self):
+        self.prewarmed.start()
+        proto, transport = self.proxy.connections[-1]
+        proto.dataReceived('\x05\x02\x01\x01')
+        self.assertIdentical(self.prewarmed.take(), None)
+
+    def test_mismatchedEndpoint(self):
+        self.assertRaises(
+            ValueError, SOCKS5ClientEndpoint, 'spam.com', 80, FakeEndpoint(),
+            self.methods, prewarmed=self.prewarmed)
+        self.assertRaises(
+            ValueError, SOCKS5ClientEndpoint, 'spam.com', 80, self.proxy,
+            prewarmed=self.prewarmed)
+
+    def test_optimisticOrEarlyDataRejected(self):
+        self.assertRaises(
+            ValueError, SOCKS5ClientEndpoint, 'spam.com', 80, self.proxy,
+            self.methods, optimistic=True, prewarmed=self.prewarmed)
+        self.assertRaises(
+            ValueError, SOCKS5ClientEndpoint, 'spam.com', 80, self.proxy,
+            self.methods, earlyData=True, prewarmed=self.prewarmed)
+
+    def test_grammarParserRejected(self):
+        self.assertRaises(
+            ValueError, PrewarmedProxyConnections, self.proxy, self.methods,
+            parser='grammar')
@@ -0,0 +1,217 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+import json
+import os
+import signal
+
+from twisted.internet import defer, error, interfaces, protocol, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+from twisted.python import failure, usage
+from twisted.trial import unittest
+
+from txsocksx.test.util import SyncDeferredsTestCase
+from txsocksx import client, prefork
+
+
+class FakeProcessTransport(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class FakeProcessReactor(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, proto, executable, args, env, childFDs):
+        self.spawned.append((proto, args, childFDs))
+        proto.makeConnection(FakeProcessTransport(len(self.spawned)))
+
+
+processDone = failure.Failure(error.ProcessDone(0))
+processTerminated = failure.Failure(error.ProcessTerminated(signal=9))
+
+
+class SOCKSServerWorkersTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.workers = prefork.SOCKSServerWorkers(
+            0, '127.0.0.1', workers=3, serverArgs={'maxTunnels': 10},
+            restartDelay=2, reactor=self.reactor)
+        self.workers.start()
+        self.addCleanup(self.closeSocket)
+
+    def closeSocket(self):
+        if self.workers.socket is not None:
+            self.workers.socket.close()
+
+    def test_start(self):
+        self.assertEqual(len(self.reactor.spawned), 3)
+        self.assertEqual(len(self.workers.processes), 3)
+        self.assertNotEqual(self.workers.getPort(), 0)
+        fd = self.workers.socket.fileno()
+        for proto, args, childFDs in self.reactor.spawned:
+            self.assertEqual(childFDs[fd], fd)
+            self.assertEqual(childFDs[1], 'r')
+            self.assertEqual(args[args.index('--fd') + 1], str(fd))
+            self.assertEqual(
+                json.loads(args[args.index('--server-args') + 1]),
+                {'maxTunnels': 10})
+
+    def test_restartCrashedWorker(self):
+        proto = self.reactor.spawned[0][0]
+        proto.processEnded(processTerminated)
+        self.assertEqual(len(self.workers.processes), 2)
+        self.assertEqual(self.workers.restarts, 1)
+        self.reactor.advance(2)
+        self.assertEqual(len(self.reactor.spawned), 4)
+        self.assertEqual(len(self.workers.processes), 3)
+
+    def test_stats(self):
+        for n, (proto, args, childFDs) in enumerate(self.reactor.spawned):
+            stats = {'pid': n, 'openTunnels': n, 'totalTunnels': 10 * n,
+                     'refusedTunnels': 1}
+            line = json.dumps(stats) + '\n'
+            proto.outReceived(line[:5])
+            proto.outReceived(line[5:])
+        stats = self.workers.stats()
+        self.assertEqual(stats['workers'], 3)
+        self.assertEqual(stats['openTunnels'], 3)
+        self.assertEqual(stats['totalTunnels'], 30)
+        self.assertEqual(stats['refusedTunnels'], 3)
+        self.assertEqual([s['pid'] for s in stats['perWorker']], [0, 1, 2])
+
+    def test_statsIncludeExitedWorkers(self):
+        proto = self.reactor.spawned[2][0]
+        proto.outReceived(json.dumps({'openTunnels': 4, 'totalTunnels': 7}))
+        proto.outReceived('\n')
+        proto.processEnded(processTerminated)
+        stats = self.workers.stats()
+        self.assertEqual(stats['openTunnels'], 0)
+        self.assertEqual(stats['totalTunnels'], 7)
+        self.assertEqual(stats['restarts'], 1)
+
+    def test_badStatsLine(self):
+        proto = self.reactor.spawned[0][0]
+        proto.outReceived('spam\n')
+        self.assertEqual(proto.stats, {})
+        self.flushLoggedErrors()
+
+    def test_stop(self):
+        d = self.workers.stop()
+        self.assertNoResult(d)
+        self.assertIdentical(self.workers.socket, None)
+        for proto, args, childFDs in self.reactor.spawned:
+            self.assertEqual(proto.transport.signals, ['TERM'])
+            proto.processEnded(processDone)
+        self.successResultOf(d)
+        self.reactor.advance(2)
+        self.assertEqual(len(self.reactor.spawned), 3)
+        self.assertEqual(self.workers.restarts, 0)
+
+
+
+class OptionsTestCase(unittest.TestCase):
+    def parse(self, argv):
+        config = prefork.Options()
+        config.parseOptions(argv)
+        return config
+
+    def test_loopbackByDefault(self):
+        self.assertEqual(self.parse([])['interface'], '127.0.0.1')
+        self.assertEqual(
+            prefork.SOCKSServerWorkers(0, reactor=object()).interface,
+            '127.0.0.1')
+
+    def test_interface(self):
+        self.assertEqual(self.parse(['-i', '::1'])['interface'], '::1')
+
+    def test_allInterfaces(self):
+        self.assertEqual(self.parse(['--all-interfaces'])['interface'], '')
+        self.assertRaises(
+            usage.UsageError, self.parse,
+            ['--all-interfaces', '--interface', '10.0.0.1'])
+
+class Echo(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class Collector(protocol.Protocol):
+    def __init__(self):
+        self.data = ''
+        self.done = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.data += data
+        if self.data == 'hello':
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.done.callback(self.data)
+
+
+class CollectorFactory(protocol.ClientFactory):
+    protocol = Collector
+
+
+def waitFor(reactor, condition, timeout=15):
+    d = defer.Deferred()
+    start = reactor.seconds()
+
+    def check():
+        if condition():
+            call.stop()
+            d.callback(None)
+        elif reactor.seconds() - start > timeout:
+            call.stop()
+            d.errback(AssertionError('timed out waiting'))
+    call = task.LoopingCall(check)
+    call.start(0.05)
+    return d
+
+
+class SOCKSServerWorkersProcessTestCase(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet import reactor
+        if not interfaces.IReactorSocket.providedBy(reactor):
+            raise unittest.SkipTest('the reactor cannot adopt sockets')
+        self.reactor = reactor
+
+    @defer.inlineCallbacks
+    def test_relayAndRestart(self):
+        echoFactory = protocol.Factory()
+        echoFactory.protocol = Echo
+        echoPort = yield TCP4ServerEndpoint(
+            self.reactor, 0, interface='127.0.0.1').listen(echoFactory)
+        self.addCleanup(echoPort.stopListening)
+        workers = prefork.SOCKSServerWorkers(
+            0, '127.0.0.1', workers=2, statsInterval=0.1, restartDelay=0.1)
+        workers.start()
+        self.addCleanup(workers.stop)
+
+        proxyEndpoint = TCP4ClientEndpoint(
+            self.reactor, '127.0.0.1', workers.getPort())
+        endpoint = client.SOCKS5ClientEndpoint(
+            '127.0.0.1', echoPort.getHost().port, proxyEndpoint)
+        proto = yield endpoint.connect(CollectorFactory())
+        proto.transport.write('hello')
+        data = yield proto.done
+        self.assertEqual(data, 'hello')
+        yield waitFor(
+            self.reactor, lambda: workers.stats()['totalTunnels'] == 1)
+
+        pid = workers.processes[0].transport.pid
+        os.kill(pid, signal.SIGKILL)
+        yield waitFor(
+            self.reactor, lambda: workers.restarts == 1
+            and len(workers.processes) == 2)
+        proto = yield endpoint.connect(CollectorFactory())
+        proto.transport.write('hello')
+        data = yield proto.done
+        self.assertEqual(data, 'hello')
@@ -0,0 +1,231 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+
+from txsocksx.test.util import (
+    FakeEndpoint, FakeResolver, SyncDeferredsTestCase)
+from txsocksx import errors, resolver
+
+
+resolvedReply = '\x05\x00\x05\x00\x00\x01\x0a\x00\x00\x07\x00\x00'
+
+
+class SOCKS5ResolverTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxy = FakeEndpoint()
+        self.resolver = resolver.SOCKS5Resolver(
+            self.proxy, cacheTTL=30, reactor=self.clock)
+
+    def test_request(self):
+        self.resolver.getHostByName('Spam.com')
+        self.proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            self.proxy.transport.value(),
+            '\x05\x01\x00' '\x05\xf0\x00\x03\x08spam.com\x00\x00')
+
+    def test_getHostByName(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived(resolvedReply)
+        self.assertEqual(self.successResultOf(d), '10.0.0.7')
+        self.assert_(self.proxy.transport.disconnecting)
+
+    def test_getHostByNameIPv6(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived(
+            '\x05\x00\x05\x00\x00\x04' + '\0' * 15 + '\x01\x00\x00')
+        self.assertEqual(self.successResultOf(d), '::1')
+
+    def test_getHostByNameAddress(self):
+        self.assertEqual(
+            self.successResultOf(self.resolver.getHostByName('10.0.0.1')),
+            '10.0.0.1')
+        self.assertEqual(
+            self.successResultOf(self.resolver.getHostByName('::1')), '::1')
+        self.assertEqual(self.proxy.connections, [])
+
+    def test_getNameByAddress(self):
+        d = self.resolver.getNameByAddress('10.0.0.7')
+        self.proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            self.proxy.transport.value()[3:],
+            '\x05\xf1\x00\x01\x0a\x00\x00\x07\x00\x00')
+        self.proxy.proto.dataReceived(
+            '\x05\x00\x00\x03\x08spam.com\x00\x00')
+        self.assertEqual(self.successResultOf(d), 'spam.com')
+
+    def test_cached(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived(resolvedReply)
+        self.successResultOf(d)
+        d = self.resolver.getHostByName('SPAM.com')
+        self.assertEqual(self.successResultOf(d), '10.0.0.7')
+        self.assertEqual(len(self.proxy.connections), 1)
+        self.assertEqual((self.resolver.hits, self.resolver.misses), (1, 1))
+
+    def test_cacheExpires(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived(resolvedReply)
+        self.successResultOf(d)
+        self.clock.advance(30)
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.proxy.connections), 2)
+
+    def test_invalidate(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived(resolvedReply)
+        self.successResultOf(d)
+        self.resolver.invalidate('Spam.com')
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.proxy.connections), 2)
+
+    def test_coalesced(self):
+        d1 = self.resolver.getHostByName('spam.com')
+        d2 = self.resolver.getHostByName('spam.com')
+        d3 = self.resolver.getHostByName('eggs.com')
+        self.assertEqual(len(self.proxy.connections), 2)
+        self.assertEqual(self.resolver.coalesced, 1)
+        self.proxy.connections[0][0].dataReceived(resolvedReply)
+        self.assertEqual(self.successResultOf(d1), '10.0.0.7')
+        self.assertEqual(self.successResultOf(d2), '10.0.0.7')
+        self.assertNoResult(d3)
+
+    def test_failureIsDNSLookupError(self):
+        d1 = self.resolver.getHostByName('spam.com')
+        d2 = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived('\x05\x00\x05\x04\x00\x01' + '\0' * 6)
+        self.failureResultOf(d1, error.DNSLookupError)
+        self.failureResultOf(d2, error.DNSLookupError)
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.proxy.connections), 2)
+
+    def test_proxyConnectionFailed(self):
+        self.proxy.failure = failure.Failure(error.ConnectionRefusedError())
+        d = self.resolver.getHostByName('spam.com')
+        self.failureResultOf(d, error.ConnectionRefusedError)
+
+    def test_authFailed(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived('\x05\xff')
+        self.failureResultOf(d, errors.MethodsNotAcceptedError)
+
+    def test_cancelOneWaiter(self):
+        d1 = self.resolver.getHostByName('spam.com')
+        d2 = self.resolver.getHostByName('spam.com')
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        self.assertEqual(self.proxy.aborted, [])
+        self.proxy.proto.dataReceived(resolvedReply)
+        self.assertEqual(self.successResultOf(d2), '10.0.0.7')
+
+    def test_cancelEveryWaiter(self):
+        d1 = self.resolver.getHostByName('spam.com')
+        d2 = self.resolver.getHostByName('spam.com')
+        d1.cancel()
+        d2.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        self.failureResultOf(d2, defer.CancelledError)
+        self.assertEqual(self.proxy.aborted, [True])
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.proxy.connections), 2)
+
+    def test_timeout(self):
+        self.resolver = resolver.SOCKS5Resolver(
+            self.proxy, timeouts={'total': 5}, reactor=self.clock)
+        d = self.resolver.getHostByName('spam.com')
+        self.clock.advance(5)
+        self.failureResultOf(d, errors.HandshakeTimeout)
+
+    def test_grammarParser(self):
+        self.resolver = resolver.SOCKS5Resolver(
+            self.proxy, parser='grammar', reactor=self.clock)
+        d = self.resolver.getHostByName('spam.com')
+        self.proxy.proto.dataReceived(resolvedReply)
+        self.assertEqual(self.successResultOf(d), '10.0.0.7')
+
+    def test_invalidArguments(self):
+        self.assertRaises(
+            ValueError, resolver.SOCKS5Resolver, self.proxy, methods={})
+        self.assertRaises(
+            ValueError, resolver.SOCKS5Resolver, self.proxy, parser='spam')
+        self.assertRaises(
+            ValueError, resolver.SOCKS5Resolver, self.proxy,
+            timeouts={'spam': 1})
+
+
+class CachingResolverTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.upstream = FakeResolver()
+        self.resolver = resolver.CachingResolver(
+            self.upstream, cacheTTL=30, reactor=self.clock)
+
+    def test_getHostByName(self):
+        d = self.resolver.getHostByName('Spam.com', timeout=(1, 3))
+        [(name, timeout, lookup)] = self.upstream.lookups
+        self.assertEqual((name, timeout), ('spam.com', (1, 3)))
+        lookup.callback('10.0.0.7')
+        self.assertEqual(self.successResultOf(d), '10.0.0.7')
+
+    def test_getHostByNameAddress(self):
+        self.assertEqual(
+            self.successResultOf(self.resolver.getHostByName('10.0.0.1')),
+            '10.0.0.1')
+        self.assertEqual(
+            self.successResultOf(self.resolver.getHostByName('::1')), '::1')
+        self.assertEqual(self.upstream.lookups, [])
+
+    def test_cached(self):
+        d = self.resolver.getHostByName('spam.com')
+        self.upstream.lookups[0][2].callback('10.0.0.7')
+        self.successResultOf(d)
+        d = self.resolver.getHostByName('SPAM.com')
+        self.assertEqual(self.successResultOf(d), '10.0.0.7')
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.assertEqual((self.resolver.hits, self.resolver.misses), (1, 1))
+
+    def test_cacheExpires(self):
+        self.resolver.getHostByName('spam.com')
+        self.upstream.lookups[0][2].callback('10.0.0.7')
+        self.clock.advance(30)
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.upstream.lookups), 2)
+
+    def test_invalidate(self):
+        self.resolver.getHostByName('spam.com')
+        self.upstream.lookups[0][2].callback('10.0.0.7')
+        self.resolver.invalidate('Spam.com')
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.upstream.lookups), 2)
+
+    def test_coalesced(self):
+        d1 = self.resolver.getHostByName('spam.com')
+        d2 = self.resolver.getHostByName('Spam.com')
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.assertEqual(self.resolver.coalesced, 1)
+        self.upstream.lookups[0][2].callback('10.0.0.7')
+        self.assertEqual(self.successResultOf(d1), '10.0.0.7')
+        self.assertEqual(self.successResultOf(d2), '10.0.0.7')
+
+    def test_failureNotCached(self):
+        d1 = self.resolver.getHostByName('spam.com')
+        d2 = self.resolver.getHostByName('spam.com')
+        self.upstream.lookups[0][2].errback(error.DNSLookupError('spam.com'))
+        self.failureResultOf(d1, error.DNSLookupError)
+        self.failureResultOf(d2, error.DNSLookupError)
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(len(self.upstream.lookups), 2)
+
+    def test_cancelEveryWaiter(self):
+        d = self.resolver.getHostByName('spam.com')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.upstream.canceled, ['spam.com'])
+
+    def test_reactorResolver(self):
+        self.clock.resolver = self.upstream
+        self.resolver = resolver.CachingResolver(reactor=self.clock)
+        self.resolver.getHostByName('spam.com')
+        self.assertEqual(self.upstream.lookups[0][:2], ('spam.com', None))
@@ -0,0 +1,303 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, protocol
+from twisted.internet.address import IPv6Address
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txsocksx.test.util import FakeEndpoint, SyncDeferredsTestCase
+from txsocksx import client, server
+
+
+class FakeSOCKSServerFactory(server.SOCKSServerFactory):
+    def __init__(self, endpoint=None, **kw):
+        server.SOCKSServerFactory.__init__(self, reactor=object(), **kw)
+        self.endpoint = endpoint or FakeEndpoint()
+        self.requested = []
+
+    def endpointFor(self, host, port):
+        self.requested.append((host, port))
+        return self.endpoint
+
+
+class SOCKSServerTestCase(SyncDeferredsTestCase):
+    def makeServer(self, endpoint=None, **kw):
+        fac = FakeSOCKSServerFactory(endpoint, **kw)
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return fac, proto, transport
+
+    def test_SOCKS5Connect(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x00')
+        self.assertEqual(transport.value(), '\x05\x00')
+        transport.clear()
+        proto.dataReceived('\x05\x01\x00\x03\x08spam.com\x00\x50')
+        self.assertEqual(fac.requested, [('spam.com', 80)])
+        self.assertEqual(
+            transport.value(), '\x05\x00\x00\x01\x0a\x00\x00\x01\x30\x39')
+
+    def test_SOCKS5ConnectIPv6Address(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x00')
+        transport.clear()
+        proto.dataReceived(
+            '\x05\x01\x00\x04' + '\x00' * 15 + '\x01\x00\x50')
+        self.assertEqual(fac.requested, [('::1', 80)])
+
+    def test_SOCKS5ReplyWithIPv6Address(self):
+        sender = server.SOCKS5ServerSender(proto_helpers.StringTransport())
+        sender.sendReply(0, IPv6Address('TCP', '::1', 80))
+        self.assertEqual(
+            sender.transport.value(),
+            '\x05\x00\x00\x04' + '\x00' * 15 + '\x01\x00\x50')
+
+    def test_SOCKS4aConnect(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x04\x01\x00\x50\x00\x00\x00\x01egg\x00spam.com\x00')
+        self.assertEqual(fac.requested, [('spam.com', 80)])
+        self.assertEqual(
+            transport.value(), '\x00\x5a\x30\x39\x0a\x00\x00\x01')
+
+    def test_SOCKS4Connect(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        self.assertEqual(fac.requested, [('127.0.0.1', 80)])
+        self.assertEqual(
+            transport.value(), '\x00\x5a\x30\x39\x0a\x00\x00\x01')
+
+    def test_relay(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x00\x05\x01\x00\x03\x08spam.com\x00\x50')
+        transport.clear()
+        proto.dataReceived('hello')
+        self.assertEqual(fac.endpoint.transport.value(), 'hello')
+        fac.endpoint.proto.dataReceived('world')
+        self.assertEqual(transport.value(), 'world')
+
+    def test_relaySkipsTheParser(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x00\x05\x01\x00\x03\x08spam.com\x00\x50')
+        upstream = fac.endpoint.transport
+        self.assertEqual(proto.dataReceived, upstream.write)
+        self.assertEqual(fac.endpoint.proto.dataReceived, transport.write)
+
+    def test_splicedProducers(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        upstream = fac.endpoint.transport
+        self.assertIdentical(transport.producer, upstream)
+        self.assertIdentical(upstream.producer, transport)
+        self.assert_(transport.streaming)
+        self.assert_(upstream.streaming)
+
+    def test_bufferSize(self):
+        fac, proto, transport = self.makeServer(bufferSize=1024)
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        self.assertEqual(transport.bufferSize, 1024)
+        self.assertEqual(fac.endpoint.transport.bufferSize, 1024)
+
+    def test_dataWithRequest(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived(
+            '\x05\x01\x00\x05\x01\x00\x03\x08spam.com\x00\x50hello')
+        self.assertEqual(fac.endpoint.transport.value(), 'hello')
+
+    def test_dataBeforeConnecting(self):
+        endpoint = FakeEndpoint()
+        endpoint.deferred = defer.Deferred()
+        fac, proto, transport = self.makeServer(endpoint)
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00hello')
+        proto.dataReceived(' world')
+        self.assertEqual(transport.value(), '')
+        upstream = endpoint.factory.buildProtocol(None)
+        upstreamTransport = proto_helpers.StringTransport()
+        upstream.makeConnection(upstreamTransport)
+        endpoint.deferred.callback(upstream)
+        self.assertEqual(upstreamTransport.value(), 'hello world')
+        self.assertEqual(
+            transport.value(), '\x00\x5a\x30\x39\x0a\x00\x00\x01')
+
+    def test_dataBeforeConnectingIsLimited(self):
+        endpoint = FakeEndpoint()
+        endpoint.deferred = defer.Deferred()
+        fac, proto, transport = self.makeServer(endpoint, bufferSize=8)
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x0012345678')
+        self.failIf(transport.disconnecting)
+        proto.dataReceived('9')
+        self.assert_(transport.disconnected)
+
+    def test_noAcceptableMethods(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x02')
+        self.assertEqual(transport.value(), '\x05\xff')
+        self.assert_(transport.disconnecting)
+
+    def test_SOCKS5CommandNotSupported(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x00')
+        transport.clear()
+        proto.dataReceived('\x05\x02\x00\x03\x08spam.com\x00\x50')
+        self.assertEqual(fac.requested, [])
+        self.assertEqual(transport.value()[:2], '\x05\x07')
+        self.assert_(transport.disconnecting)
+
+    def test_SOCKS4CommandNotSupported(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x04\x02\x00\x50\x7f\x00\x00\x01\x00')
+        self.assertEqual(fac.requested, [])
+        self.assertEqual(transport.value()[:2], '\x00\x5b')
+        self.assert_(transport.disconnecting)
+
+    def test_SOCKS5ConnectionRefused(self):
+        fac, proto, transport = self.makeServer(
+            FakeEndpoint(failure.Failure(ConnectionRefusedError())))
+        proto.dataReceived('\x05\x01\x00')
+        transport.clear()
+        proto.dataReceived('\x05\x01\x00\x03\x08spam.com\x00\x50')
+        self.assertEqual(
+            transport.value(), '\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+        self.assert_(transport.disconnecting)
+
+    def test_SOCKS5GeneralFailure(self):
+        fac, proto, transport = self.makeServer(
+            FakeEndpoint(failure.Failure(ValueError())))
+        proto.dataReceived('\x05\x01\x00\x05\x01\x00\x03\x08spam.com\x00\x50')
+        self.assertEqual(transport.value()[2:4], '\x05\x01')
+
+    def test_SOCKS4ConnectionRefused(self):
+        fac, proto, transport = self.makeServer(
+            FakeEndpoint(failure.Failure(ConnectionRefusedError())))
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        self.assertEqual(
+            transport.value(), '\x00\x5b\x00\x00\x00\x00\x00\x00')
+        self.assert_(transport.disconnecting)
+
+    def test_unknownVersion(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x06\x01\x00')
+        self.assert_(transport.disconnected)
+
+    def test_invalidRequest(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x05\x01\x00\x05\x01\x00\x09')
+        self.assert_(transport.disconnecting)
+        self.assertEqual(fac.requested, [])
+
+    def test_clientLostWhileConnecting(self):
+        canceled = []
+        endpoint = FakeEndpoint()
+        endpoint.deferred = defer.Deferred(canceled.append)
+        fac, proto, transport = self.makeServer(endpoint)
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(canceled, [endpoint.deferred])
+        self.assertEqual(transport.value(), '')
+
+    def test_clientLostClosesUpstream(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        upstream = fac.endpoint.transport
+        proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assert_(upstream.disconnecting)
+        self.assertIdentical(upstream.producer, None)
+
+    def test_upstreamLostClosesClient(self):
+        fac, proto, transport = self.makeServer()
+        proto.dataReceived('\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+        fac.endpoint.proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assert_(transport.disconnecting)
+        self.assertIdentical(transport.producer, None)
+
+    def test_maxTunnels(self):
+        fac = FakeSOCKSServerFactory(maxTunnels=2)
+        protos = [fac.buildProtocol(None) for x in xrange(3)]
+        self.assertIdentical(protos[2], None)
+        self.assertEqual(fac.openTunnels, 2)
+        self.assertEqual(fac.totalTunnels, 2)
+        self.assertEqual(fac.refusedTunnels, 1)
+        protos[0].makeConnection(proto_helpers.StringTransport())
+        protos[0].connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(fac.openTunnels, 1)
+        self.assertNotIdentical(fac.buildProtocol(None), None)
+
+    def test_endpointFor(self):
+        fac = server.SOCKSServerFactory(reactor=object(), connectTimeout=5)
+        endpoint = fac.endpointFor('spam.com', 80)
+        self.assertEqual(endpoint._host, 'spam.com')
+        self.assertEqual(endpoint._timeout, 5)
+        self.assertIsInstance(
+            fac.endpointFor('::1', 80), server.TCP6ClientEndpoint)
+
+
+class Echo(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class Collector(protocol.Protocol):
+    def __init__(self):
+        self.data = ''
+        self.done = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.data += data
+        if len(self.data) >= self.expected:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.done.callback(self.data)
+
+
+class CollectorFactory(protocol.ClientFactory):
+    def __init__(self, expected):
+        self.expected = expected
+        self.proto = None
+
+    def buildProtocol(self, addr):
+        self.proto = Collector()
+        self.proto.expected = self.expected
+        return self.proto
+
+
+class SOCKSServerLoopbackTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        from twisted.internet import reactor
+        self.reactor = reactor
+        echoFactory = protocol.Factory()
+        echoFactory.protocol = Echo
+        self.echoPort = yield TCP4ServerEndpoint(
+            reactor, 0, interface='127.0.0.1').listen(echoFactory)
+        self.serverFactory = server.SOCKSServerFactory(bufferSize=4096)
+        self.socksPort = yield TCP4ServerEndpoint(
+            reactor, 0, interface='127.0.0.1').listen(self.serverFactory)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.echoPort.stopListening()
+        yield self.socksPort.stopListening()
+
+    @defer.inlineCallbacks
+    def assertEchoes(self, endpointClass):
+        proxyEndpoint = TCP4ClientEndpoint(
+            self.reactor, '127.0.0.1', self.socksPort.getHost().port)
+        endpoint = endpointClass(
+            '127.0.0.1', self.echoPort.getHost().port, proxyEndpoint)
+        payload = ''.join(chr(x % 251) for x in xrange(1 << 20))
+        fac = CollectorFactory(len(payload))
+        proto = yield endpoint.connect(fac)
+        proto.transport.write(payload)
+        data = yield proto.done
+        self.assertEqual(data, payload)
+
+    def test_SOCKS5(self):
+        return self.assertEchoes(client.SOCKS5ClientEndpoint)
+
+    def test_SOCKS4(self):
+        return self.assertEchoes(client.SOCKS4ClientEndpoint)
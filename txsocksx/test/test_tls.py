@@ -1,12 +1,24 @@
 # Copyright (c) Aaron Gallagher <_@habnab.it>
 # See COPYING for details.
 
-from twisted.internet import defer, protocol
+from OpenSSL import SSL
+from twisted.internet import defer, protocol, ssl, task
+from twisted.protocols import tls
 from twisted.protocols.basic import NetstringReceiver
+from twisted.python.filepath import FilePath
+from twisted.python.versions import Version
+from twisted.test import proto_helpers
+import twisted.test
 
 from txsocksx.test.util import (
     FakeEndpoint, SyncDeferredsTestCase, UppercaseWrapperFactory)
-from txsocksx.tls import TLSWrapClientEndpoint
+from txsocksx.tls import TLSSessionCache, TLSWrapClientEndpoint
+
+
+if twisted.version < Version('twisted', 14, 0, 0):
+    sessionSkip = 'TLS session caching requires Twisted 14.0 or newer'
+else:
+    sessionSkip = None
 
 
 class NetstringTracker(NetstringReceiver):
@@ -78,3 +90,110 @@ class TLSWrapClientEndpointTestCase(SyncDeferredsTestCase):
         """
         self.successResultOf(self.wrapper.connect(self.factory))
         self.assertIdentical(self.context, self.endpoint.factory.context)
+
+
+class TLSSessionCacheTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = TLSSessionCache(size=2, maxAge=60, reactor=self.clock)
+
+    def test_hitsAndMisses(self):
+        self.assertEqual(self.cache.hitRate(), None)
+        self.assertIdentical(self.cache.get('spam'), None)
+        self.cache.put('spam', 'session')
+        self.assertEqual(self.cache.get('spam'), 'session')
+        self.assertEqual(
+            (self.cache.hits, self.cache.misses, self.cache.stored), (1, 1, 1))
+        self.assertEqual(self.cache.hitRate(), 0.5)
+
+    def test_maxAge(self):
+        self.cache.put('spam', 'session')
+        self.clock.advance(60)
+        self.assertIdentical(self.cache.get('spam'), None)
+
+    def test_size(self):
+        for key in 'abc':
+            self.cache.put(key, 'session')
+        self.assertEqual(len(self.cache), 2)
+        self.assertIdentical(self.cache.get('a'), None)
+
+    def test_invalidate(self):
+        self.cache.put('spam', 'session')
+        self.cache.invalidate('spam')
+        self.assertIdentical(self.cache.get('spam'), None)
+
+
+class Echo(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class Accumulator(protocol.Protocol):
+    data = ''
+
+    def dataReceived(self, data):
+        self.data += data
+
+
+class SessionResumptionTestCase(SyncDeferredsTestCase):
+    skip = sessionSkip
+
+    def setUp(self):
+        pem = FilePath(twisted.test.__file__).sibling('server.pem').getContent()
+        serverOptions = ssl.PrivateCertificate.loadPEM(pem).options()
+        # A resumed handshake is one where the server didn't send its
+        # certificate.
+        self.sentCertificate = set()
+        serverOptions.getContext().set_info_callback(self._serverInfo)
+        self.serverFactory = tls.TLSMemoryBIOFactory(
+            serverOptions, False, protocol.Factory.forProtocol(Echo))
+        self.clientOptions = ssl.optionsForClientTLS(
+            u'localhost', trustRoot=ssl.Certificate.loadPEM(pem))
+        self.cache = TLSSessionCache(reactor=task.Clock())
+
+    def connect(self, key=('localhost', 443)):
+        endpoint = FakeEndpoint()
+        wrapper = TLSWrapClientEndpoint(
+            self.clientOptions, endpoint, self.cache, key)
+        proto = self.successResultOf(wrapper.connect(
+            protocol.Factory.forProtocol(Accumulator)))
+        server = self.serverFactory.buildProtocol(None)
+        serverTransport = proto_helpers.StringTransport()
+        server.makeConnection(serverTransport)
+        proto.transport.write('spam')
+        while endpoint.transport.value() or serverTransport.value():
+            data = endpoint.transport.value()
+            endpoint.transport.clear()
+            server.dataReceived(data)
+            data = serverTransport.value()
+            serverTransport.clear()
+            endpoint.proto.dataReceived(data)
+        self.assertEqual(proto.data, 'spam')
+        return endpoint.proto, server
+
+    def _serverInfo(self, connection, where, ret):
+        if (where & SSL.SSL_CB_LOOP
+                and 'write certificate' in connection.get_state_string()):
+            self.sentCertificate.add(connection)
+
+    def sessionReused(self, server):
+        return server._tlsConnection not in self.sentCertificate
+
+    def test_resumption(self):
+        client, server = self.connect()
+        self.assertFalse(self.sessionReused(server))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(len(self.cache), 1)
+        client, server = self.connect()
+        self.assert_(self.sessionReused(server))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_keyed(self):
+        self.connect()
+        client, server = self.connect(key=('localhost', 8443))
+        self.assertFalse(self.sessionReused(server))
+
+    def test_requiresKey(self):
+        self.assertRaises(
+            ValueError, TLSWrapClientEndpoint, self.clientOptions,
+            FakeEndpoint(), self.cache)
@@ -0,0 +1,213 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import protocol, task
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.python import failure
+
+from txsocksx.test.util import FakeEndpoint, SyncDeferredsTestCase
+from txsocksx import errors, udp
+
+
+class FakeUDPPort(object):
+    def __init__(self, proto, interface):
+        self.proto = proto
+        self.interface = interface
+        self.written = []
+        self.stopped = False
+
+    def write(self, datagram, addr):
+        self.written.append((datagram, addr))
+
+    def getHost(self):
+        return IPv4Address('UDP', self.interface or '0.0.0.0', 5353)
+
+    def stopListening(self):
+        self.stopped = True
+
+
+class FakeUDPReactor(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.ports = []
+
+    def listenUDP(self, port, proto, interface='', maxPacketSize=8192):
+        port = FakeUDPPort(proto, interface)
+        self.ports.append(port)
+        return port
+
+
+class RecordingDatagramProtocol(protocol.DatagramProtocol):
+    stopped = False
+
+    def __init__(self):
+        self.received = []
+
+    def datagramReceived(self, data, addr):
+        self.received.append((data, addr))
+
+    def stopProtocol(self):
+        self.stopped = True
+
+
+class UDPHeaderTestCase(SyncDeferredsTestCase):
+    def test_packIPv4(self):
+        self.assertEqual(
+            udp.packUDPHeader('127.0.0.1', 53),
+            '\0\0\0\x01\x7f\0\0\x01\0\x35')
+
+    def test_packIPv6(self):
+        self.assertEqual(
+            udp.packUDPHeader('::1', 53),
+            '\0\0\0\x04' + '\0' * 15 + '\x01\0\x35')
+
+    def test_packHostname(self):
+        self.assertEqual(
+            udp.packUDPHeader('spam.com', 53),
+            '\0\0\0\x03\x08spam.com\0\x35')
+
+    def test_roundTrip(self):
+        for addr in [('127.0.0.1', 53), ('::1', 443), ('spam.com', 1)]:
+            self.assertEqual(
+                udp.parseUDPHeader(udp.packUDPHeader(*addr) + 'eggs'),
+                ('eggs', addr))
+
+    def test_parseRejectsFragments(self):
+        self.assertEqual(
+            udp.parseUDPHeader('\0\0\x01\x01\x7f\0\0\x01\0\x35eggs'), None)
+
+    def test_parseRejectsMalformed(self):
+        for data in ['', '\0\0\0', '\0\0\0\x01\x7f\0', '\0\0\0\x03\x08spam',
+                     '\0\0\0\x05\x7f\0\0\x01\0\x35']:
+            self.assertEqual(udp.parseUDPHeader(data), None)
+
+
+class SOCKS5UDPAssociateEndpointTestCase(SyncDeferredsTestCase):
+    def setUp(self):
+        self.reactor = FakeUDPReactor()
+        self.proxy = FakeEndpoint()
+        self.endpoint = udp.SOCKS5UDPAssociateEndpoint(
+            self.proxy, headerCacheSize=2, reactor=self.reactor)
+        self.proto = RecordingDatagramProtocol()
+
+    def associate(self, reply='\x05\x00\x00\x01\x0a\x00\x00\x02\x04\x38'):
+        d = self.endpoint.associate(self.proto)
+        self.proxy.proto.dataReceived('\x05\x00' + reply)
+        return d
+
+    def test_request(self):
+        self.endpoint.associate(self.proto)
+        self.proxy.proto.dataReceived('\x05\x00')
+        self.assertEqual(
+            self.proxy.transport.value(),
+            '\x05\x01\x00' '\x05\x03\x00\x01\x00\x00\x00\x00\x14\xe9')
+
+    def test_associate(self):
+        association = self.successResultOf(self.associate())
+        self.assertIdentical(self.proto.transport, association)
+        self.assertEqual(association.relayAddress, ('10.0.0.2', 1080))
+        self.assertEqual(association.getHost().port, 5353)
+
+    def test_unspecifiedRelayAddress(self):
+        association = self.successResultOf(
+            self.associate('\x05\x00\x00\x01\x00\x00\x00\x00\x04\x38'))
+        self.assertEqual(association.relayAddress, ('192.168.1.1', 1080))
+
+    def test_write(self):
+        association = self.successResultOf(self.associate())
+        association.write('query', ('127.0.0.1', 53))
+        self.assertEqual(self.reactor.ports[0].written, [
+            ('\0\0\0\x01\x7f\0\0\x01\0\x35query', ('10.0.0.2', 1080))])
+
+    def test_writeBatch(self):
+        association = self.successResultOf(self.associate())
+        association.writeBatch([
+            ('a', ('127.0.0.1', 53)),
+            ('b', ('spam.com', 443)),
+            ('c', ('127.0.0.1', 53)),
+        ])
+        self.assertEqual(self.reactor.ports[0].written, [
+            ('\0\0\0\x01\x7f\0\0\x01\0\x35a', ('10.0.0.2', 1080)),
+            ('\0\0\0\x03\x08spam.com\x01\xbbb', ('10.0.0.2', 1080)),
+            ('\0\0\0\x01\x7f\0\0\x01\0\x35c', ('10.0.0.2', 1080)),
+        ])
+
+    def test_headerCacheIsBounded(self):
+        association = self.successResultOf(self.associate())
+        for port in xrange(10):
+            association.write('x', ('127.0.0.1', port))
+        self.assertEqual(len(association._headers), 2)
+        self.assertEqual(len(self.reactor.ports[0].written), 10)
+
+    def test_receive(self):
+        self.successResultOf(self.associate())
+        relay = self.reactor.ports[0].proto
+        relay.datagramReceived(
+            '\0\0\0\x01\x7f\0\0\x01\0\x35answer', ('10.0.0.2', 1080))
+        self.assertEqual(self.proto.received, [('answer', ('127.0.0.1', 53))])
+
+    def test_receiveDropsOtherSources(self):
+        self.successResultOf(self.associate())
+        relay = self.reactor.ports[0].proto
+        relay.datagramReceived(
+            '\0\0\0\x01\x7f\0\0\x01\0\x35answer', ('10.0.0.3', 1080))
+        relay.datagramReceived('\0\0\x01\x01\x7f\0\0\x01\0\x35answer',
+                               ('10.0.0.2', 1080))
+        self.assertEqual(self.proto.received, [])
+
+    def test_receiveOverIPv6(self):
+        association = self.successResultOf(self.associate(
+            '\x05\x00\x00\x04' + '\x20\x01\x0d\xb8' + '\0' * 11 + '\x02'
+            '\x04\x38'))
+        self.assertEqual(association.relayAddress, ('2001:db8::2', 1080))
+        relay = self.reactor.ports[0].proto
+        relay.datagramReceived(
+            '\0\0\0\x01\x7f\0\0\x01\0\x35answer', ('2001:db8::2', 1080, 0, 0))
+        self.assertEqual(self.proto.received, [('answer', ('127.0.0.1', 53))])
+
+    def test_controlConnectionLost(self):
+        self.successResultOf(self.associate())
+        self.proxy.proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assert_(self.reactor.ports[0].stopped)
+        self.assert_(self.proto.stopped)
+
+    def test_stopListening(self):
+        association = self.successResultOf(self.associate())
+        association.stopListening()
+        self.assert_(self.proxy.transport.disconnecting)
+        self.assert_(self.reactor.ports[0].stopped)
+        self.assert_(self.proto.stopped)
+
+    def test_rejected(self):
+        d = self.associate('\x05\x07\x00\x01\0\0\0\0\0\0')
+        self.failureResultOf(d, errors.CommandNotSupported)
+        self.assert_(self.reactor.ports[0].stopped)
+        self.assertIdentical(self.proto.transport, None)
+
+    def test_proxyConnectionFailed(self):
+        self.proxy.failure = failure.Failure(ConnectionRefusedError())
+        d = self.endpoint.associate(self.proto)
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assert_(self.reactor.ports[0].stopped)
+
+    def test_proxyConnectRaises(self):
+        def connect(fac):
+            raise ConnectionRefusedError()
+        self.proxy.connect = connect
+        d = self.endpoint.associate(self.proto)
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assert_(self.reactor.ports[0].stopped)
+
+    def test_interface(self):
+        endpoint = udp.SOCKS5UDPAssociateEndpoint(
+            self.proxy, interface='10.0.0.9', reactor=self.reactor)
+        endpoint.associate(self.proto)
+        self.assertEqual(self.reactor.ports[0].interface, '10.0.0.9')
+
+    def test_invalidArguments(self):
+        self.assertRaises(
+            ValueError, udp.SOCKS5UDPAssociateEndpoint, self.proxy, methods={})
+        self.assertRaises(
+            ValueError, udp.SOCKS5UDPAssociateEndpoint, self.proxy,
+            parser='spam')
@@ -12,6 +12,7 @@ class FakeEndpoint(object):
     def __init__(self, failure=None):
         self.failure = failure
         self.deferred = None
+        self.connections = []
 
     def connect(self, fac):
         self.factory = fac
@@ -27,9 +28,21 @@ class FakeEndpoint(object):
         transport.startTLS = lambda ctx: self.tlsStarts.append(ctx)
         self.proto.makeConnection(transport)
         self.transport = transport
+        self.connections.append((self.proto, transport))
         return defer.succeed(self.proto)
 
 
+class FakeResolver(object):
+    def __init__(self):
+        self.lookups = []
+        self.canceled = []
+
+    def getHostByName(self, name, timeout=None):
+        d = defer.Deferred(lambda d: self.canceled.append(name))
+        self.lookups.append((name, timeout, d))
+        return d
+
+
 class UppercaseWrapperProtocol(policies.ProtocolWrapper):
     def dataReceived(self, data):
         policies.ProtocolWrapper.dataReceived(self, data.upper())
@@ -10,6 +10,148 @@ from twisted.protocols import tls
 from twisted.internet import interfaces
 from zope.interface import implementer
 
+from txsocksx._cache import _ExpiringLRUCache
+
+
+_IClientCreator = getattr(interfaces, 'IOpenSSLClientConnectionCreator', None)
+
+
+class TLSSessionCache(object):
+    """TLS sessions which can be resumed, keyed by destination.
+
+    Pass this as *sessionCache* to `TLSWrapClientEndpoint`. Resuming a session
+    skips the certificate exchange and a round trip of the TLS handshake.
+
+    :param size: The number of sessions to keep. The least recently used
+        sessions are evicted first.
+    :param maxAge: The number of seconds a session is kept for. Servers don't
+        resume sessions older than their own limit, which is commonly five
+        minutes to a day.
+    :param reactor: The `IReactorTime`__ used for *maxAge*. Defaults to the
+        global reactor.
+
+    The ``hits`` and ``misses`` attributes count the connections which were
+    and were not offered a session to resume; ``stored`` counts the sessions
+    stored.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+
+    """
+
+    hits = misses = stored = 0
+
+    def __init__(self, size=256, maxAge=3600, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.maxAge = maxAge
+        self._sessions = _ExpiringLRUCache(size, reactor)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def hitRate(self):
+        """Return the fraction of connections offered a session, or ``None``
+        if there haven't been any.
+
+        """
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return self.hits / float(total)
+
+    def get(self, key):
+        """Return the session for *key*, or ``None``.
+
+        """
+        session = self._sessions.get(key)
+        if session is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return session
+
+    def put(self, key, session):
+        """Store *session* for *key*, replacing any older one.
+
+        """
+        self.stored += 1
+        self._sessions.set(key, session, self.maxAge)
+
+    def invalidate(self, key):
+        """Forget the session for *key*.
+
+        """
+        self._sessions.invalidate(key)
+
+    def clear(self):
+        """Forget every session.
+
+        """
+        self._sessions.clear()
+
+
+class _ResumingConnectionCreator(object):
+    def __init__(self, contextFactory, sessionCache, sessionKey):
+        self.contextFactory = contextFactory
+        self.sessionCache = sessionCache
+        self.sessionKey = sessionKey
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        if _IClientCreator.providedBy(self.contextFactory):
+            connection = self.contextFactory.clientConnectionForTLS(
+                tlsProtocol)
+        else:
+            from OpenSSL import SSL
+            connection = SSL.Connection(
+                self.contextFactory.getContext(), None)
+        session = self.sessionCache.get(self.sessionKey)
+        if session is not None:
+            connection.set_session(session)
+        return connection
+
+if _IClientCreator is not None:
+    _ResumingConnectionCreator = implementer(_IClientCreator)(
+        _ResumingConnectionCreator)
+
+
+class _SessionCachingTLSProtocol(tls.TLSMemoryBIOProtocol):
+    # With TLS 1.3, the session isn't resumable until the server's session
+    # tickets arrive, which is after the handshake. They're sent with the
+    # server's first flight after the handshake, so the session is stored
+    # after the data which finishes the handshake and again after the next.
+    _sessionStores = 2
+
+    def _storeSession(self):
+        session = self._tlsConnection.get_session()
+        if session is not None:
+            self.factory.sessionCache.put(self.factory.sessionKey, session)
+
+    def dataReceived(self, data):
+        tls.TLSMemoryBIOProtocol.dataReceived(self, data)
+        if self._sessionStores and self._handshakeDone:
+            self._sessionStores -= 1
+            self._storeSession()
+
+    def connectionLost(self, reason):
+        # The server can send new session tickets at any time; keep the last.
+        if self._handshakeDone:
+            self._storeSession()
+        tls.TLSMemoryBIOProtocol.connectionLost(self, reason)
+
+
+class _SessionCachingTLSFactory(tls.TLSMemoryBIOFactory):
+    protocol = _SessionCachingTLSProtocol
+
+    def __init__(self, sessionCache, sessionKey, contextFactory, isClient,
+                 wrappedFactory):
+        tls.TLSMemoryBIOFactory.__init__(
+            self,
+            _ResumingConnectionCreator(
+                contextFactory, sessionCache, sessionKey),
+            isClient, wrappedFactory)
+        self.sessionCache = sessionCache
+        self.sessionKey = sessionKey
+
 
 @implementer(interfaces.IStreamClientEndpoint)
 class TLSWrapClientEndpoint(object):
@@ -17,6 +159,15 @@ class TLSWrapClientEndpoint(object):
 
     :param contextFactory: A `ContextFactory`__ instance.
     :param wrappedEndpoint: The endpoint to wrap.
+    :param sessionCache: A `TLSSessionCache`. If given, each connection
+        resumes the last session stored under *sessionKey*, if any, and
+        stores its own session there once the handshake is done. This requires
+        Twisted 14.0 or greater.
+    :param sessionKey: The key of this endpoint's sessions in *sessionCache*,
+        such as the destination host and port. Only endpoints which should be
+        allowed to resume each other's sessions should share a key.
+    :param metrics: A ``txsocksx.metrics.MetricsCollector`` to count
+        connections and failed connections in.
 
     __ http://twistedmatrix.com/documents/current/api/twisted.internet.protocol.ClientFactory.html
 
@@ -24,9 +175,19 @@ class TLSWrapClientEndpoint(object):
 
     _wrapper = tls.TLSMemoryBIOFactory
 
-    def __init__(self, contextFactory, wrappedEndpoint):
+    def __init__(self, contextFactory, wrappedEndpoint, sessionCache=None,
+                 sessionKey=None, metrics=None):
+        if sessionCache is not None:
+            if _IClientCreator is None:
+                raise NotImplementedError(
+                    'TLS session caching requires twisted 14.0 or greater')
+            if sessionKey is None:
+                raise ValueError('a sessionCache requires a sessionKey')
         self.contextFactory = contextFactory
         self.wrappedEndpoint = wrappedEndpoint
+        self.sessionCache = sessionCache
+        self.sessionKey = sessionKey
+        self.metrics = metrics
 
     def connect(self, fac):
         """Connect to the wrapped endpoint, then start TLS.
@@ -41,8 +202,16 @@ class TLSWrapClientEndpoint(object):
         __ http://twistedmatrix.com/documents/current/api/twisted.protocols.tls.html
 
         """
-        fac = self._wrapper(self.contextFactory, True, fac)
-        return self.wrappedEndpoint.connect(fac).addCallback(self._unwrapProtocol)
+        if self.sessionCache is None:
+            fac = self._wrapper(self.contextFactory, True, fac)
+        else:
+            fac = _SessionCachingTLSFactory(
+                self.sessionCache, self.sessionKey, self.contextFactory, True,
+                fac)
+        d = self.wrappedEndpoint.connect(fac)
+        if self.metrics is not None:
+            d.addBoth(self.metrics.tlsConnectFinished)
+        return d.addCallback(self._unwrapProtocol)
 
     def _unwrapProtocol(self, proto):
         return proto.wrappedProtocol
@@ -0,0 +1,256 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""SOCKS5 ``UDP ASSOCIATE`` support.
+
+"""
+
+
+import socket
+import struct
+
+from twisted.internet import defer, protocol
+
+import txsocksx.constants as c
+from txsocksx.client import (
+    SOCKS5ClientFactory, _connectThroughProxy, _isIPAddress, _makeTimer,
+    socks_host, validateTimeouts)
+
+
+_short = struct.Struct('!H')
+_addressLengths = {c.ATYP_IPV4: 4, c.ATYP_IPV6: 16}
+_addressFamilies = {c.ATYP_IPV4: socket.AF_INET, c.ATYP_IPV6: socket.AF_INET6}
+
+
+def packUDPHeader(host, port):
+    """Build the RFC 1928 header for a datagram to *host* and *port*.
+
+    IP addresses are sent as such; anything else is sent as a hostname.
+
+    """
+    return '\0\0\0' + socks_host(host) + _short.pack(port)
+
+
+def parseUDPHeader(data):
+    """Split a datagram from the relay into its source and payload.
+
+    :returns: A tuple of the payload and a ``(host, port)`` tuple, or ``None``
+        if the datagram is malformed or a fragment, neither of which are
+        supported.
+
+    """
+    if len(data) < 4 or data[2] != '\0':
+        return None
+    addressType = ord(data[3])
+    if addressType == c.ATYP_DOMAINNAME:
+        if len(data) < 5:
+            return None
+        start = 5
+        end = start + ord(data[4])
+        host = data[start:end]
+    elif addressType in _addressLengths:
+        start = 4
+        end = start + _addressLengths[addressType]
+        host = None
+    else:
+        return None
+    if len(data) < end + 2:
+        return None
+    if host is None:
+        host = socket.inet_ntop(_addressFamilies[addressType], data[start:end])
+    port, = _short.unpack_from(data, end)
+    return data[end + 2:], (host, port)
+
+
+class _UDPControlProtocol(protocol.Protocol):
+    """The TCP connection whose lifetime is the association's."""
+
+    association = None
+
+    def connectionLost(self, reason):
+        if self.association is not None:
+            self.association._controlLost()
+
+
+class _UDPControlFactory(protocol.ClientFactory):
+    protocol = _UDPControlProtocol
+
+
+class _UDPRelayProtocol(protocol.DatagramProtocol):
+    association = None
+
+    def datagramReceived(self, data, addr):
+        if self.association is not None:
+            self.association._datagramReceived(data, addr)
+
+
+class SOCKS5UDPAssociation(object):
+    """The transport of a datagram protocol associated through SOCKS5.
+
+    Datagrams are written with `write` or `writeBatch` and received by the
+    protocol's ``datagramReceived`` as with any UDP transport; the SOCKS5 UDP
+    header is added and removed here. Headers are kept for up to
+    *headerCacheSize* destinations, so that datagrams to the same destination
+    only cost a string concatenation.
+
+    Datagrams which don't come from the relay, and fragments, are dropped.
+
+    """
+
+    disconnected = False
+
+    def __init__(self, port, control, relayAddress, datagramProtocol,
+                 headerCacheSize=256):
+        self._port = port
+        self._control = control
+        self.relayAddress = relayAddress
+        self.protocol = datagramProtocol
+        self.headerCacheSize = headerCacheSize
+        self._headers = {}
+
+    def _header(self, addr):
+        header = self._headers.get(addr)
+        if header is None:
+            if len(self._headers) >= self.headerCacheSize:
+                self._headers.popitem()
+            header = self._headers[addr] = packUDPHeader(*addr)
+        return header
+
+    def write(self, datagram, addr):
+        """Send *datagram* to *addr*, a ``(host, port)`` tuple, via the relay.
+
+        """
+        self._port.write(self._header(addr) + datagram, self.relayAddress)
+
+    def writeBatch(self, datagrams):
+        """Send each ``(datagram, (host, port))`` pair in *datagrams*.
+
+        This is the same as calling `write` for each; every datagram is still
+        sent with its own ``write`` on the UDP port.
+
+        """
+        write = self._port.write
+        relayAddress = self.relayAddress
+        headers = self._headers
+        for datagram, addr in datagrams:
+            header = headers.get(addr)
+            if header is None:
+                header = self._header(addr)
+            write(header + datagram, relayAddress)
+
+    def getHost(self):
+        """Return the address of the local UDP port.
+
+        """
+        return self._port.getHost()
+
+    def _datagramReceived(self, data, addr):
+        # IPv6 addresses come with a flow info and scope ID as well.
+        if addr[:2] != self.relayAddress:
+            return
+        parsed = parseUDPHeader(data)
+        if parsed is None:
+            return
+        self.protocol.datagramReceived(*parsed)
+
+    def _controlLost(self):
+        if self.disconnected:
+            return
+        self.disconnected = True
+        self._port.stopListening()
+        self.protocol.doStop()
+
+    def stopListening(self):
+        """End the association.
+
+        The TCP connection to the SOCKS5 server is closed, along with the
+        local UDP port.
+
+        """
+        self._control.transport.loseConnection()
+        self._controlLost()
+
+    loseConnection = stopListening
+
+
+class SOCKS5UDPAssociateEndpoint(object):
+    """Sends and receives datagrams through a SOCKS5 server.
+
+    :param proxyEndpoint: The endpoint of the SOCKS5 server. This must provide
+        `IStreamClientEndpoint`__.
+    :param methods: The authentication methods to try, as for
+        |SOCKS5ClientEndpoint|.
+    :param interface: The local address to bind the UDP port to. It must be of
+        the same family as the relay address the SOCKS5 server gives.
+    :param headerCacheSize: The number of destinations whose SOCKS5 UDP
+        headers are kept.
+    :param parser: Which parser to use for the server's replies, as for
+        |SOCKS5ClientEndpoint|.
+    :param timeouts: Handshake timeouts, as for |SOCKS5ClientEndpoint|.
+    :param reactor: The `IReactorUDP`__ provider used to listen for datagrams.
+        Defaults to the global reactor.
+
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamClientEndpoint.html
+    __ http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorUDP.html
+
+    """
+
+    def __init__(self, proxyEndpoint, methods={'anonymous': ()}, interface='',
+                 headerCacheSize=256, parser='grammar', timeouts=None,
+                 reactor=None):
+        if not methods:
+            raise ValueError('no auth methods were specified')
+        validateTimeouts(timeouts)
+        if parser not in SOCKS5ClientFactory.protocols:
+            raise ValueError('unknown parser %r' % (parser,))
+        if reactor is None:
+            from twisted.internet import reactor
+        self.proxyEndpoint = proxyEndpoint
+        self.methods = methods
+        self.interface = interface
+        self.headerCacheSize = headerCacheSize
+        self.parser = parser
+        self.timeouts = timeouts
+        self.reactor = reactor
+
+    def associate(self, datagramProtocol):
+        """Associate *datagramProtocol* with a UDP relay.
+
+        A local UDP port is opened and a ``UDP ASSOCIATE`` request is sent for
+        it. Returns a ``Deferred`` which fires with a `SOCKS5UDPAssociation`
+        once the server grants the request; by then, *datagramProtocol* has
+        been connected to it. The association lasts until the TCP connection
+        to the SOCKS5 server closes or the association's ``stopListening`` is
+        called.
+
+        If the request fails, the ``Deferred`` errbacks as for
+        ``SOCKS5ClientEndpoint.connect``, and the UDP port is closed.
+
+        """
+        relay = _UDPRelayProtocol()
+        port = self.reactor.listenUDP(0, relay, interface=self.interface)
+        proxyFac = SOCKS5ClientFactory(
+            self.interface or '0.0.0.0', port.getHost().port,
+            _UDPControlFactory(), self.methods, parser=self.parser)
+        proxyFac.command = c.CMD_UDP_ASSOCIATE
+        d = defer.maybeDeferred(
+            _connectThroughProxy, self.proxyEndpoint, proxyFac,
+            _makeTimer(self.reactor, self.timeouts))
+
+        def associated(control):
+            host, relayPort = proxyFac.boundAddress
+            if host in ('0.0.0.0', '::') or not _isIPAddress(host):
+                host = control.transport.getPeer().host
+            association = SOCKS5UDPAssociation(
+                port, control, (host, relayPort), datagramProtocol,
+                self.headerCacheSize)
+            relay.association = control.association = association
+            datagramProtocol.makeConnection(association)
+            return association
+
+        def failed(reason):
+            port.stopListening()
+            return reason
+
+        d.addCallbacks(associated, failed)
+        return d